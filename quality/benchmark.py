@@ -0,0 +1,308 @@
+'''
+Benchmarks for the stages of a quality contest, run against a synthetic
+source tree and matching coverage.xml.
+
+Run it as `python -m quality.benchmark`; see --help for the corpus size
+options.  Each stage is timed separately, and the timings can be saved as
+a baseline, and compared against on later runs, to catch slowdowns.
+'''
+
+import quality.cmdline
+import quality.complexity
+import quality.core
+import quality.crap
+import quality.liason
+import quality.lint
+import quality.report
+import quality.tabnanny
+
+import ast
+import json
+import optparse
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import xml.etree.ElementTree
+
+# stages, in the order they're run; see run_benchmark
+STAGES = ['parse', 'annotate', 'complexity', 'coverage', 'lint', 'tabnanny', 'formula', 'report']
+
+# the default size of the synthetic corpus; see generate_corpus
+DEFAULT_CORPUS = {
+    'files': 50,
+    'functions': 20,
+    'depth': 3,
+    'lines': 4,
+}
+
+# how much slower than the baseline a stage may get before it's reported as
+# a regression, as a fraction of the baseline time
+DEFAULT_THRESHOLD = 0.2
+
+def _block_source(rng, depth, lines, indent):
+    'Return a list of lines of code for a block, with compound statements nested `depth` deep'
+    block = ['%sx = x + %d' % (indent, rng.randint(0, 100)) for i in range(lines)]
+    if depth > 0:
+        compound = rng.choice([
+            'if x > %d:' % rng.randint(0, 100),
+            'for i in range(%d):' % rng.randint(1, 10),
+            'while x < %d:' % rng.randint(0, 100),
+            'try:',
+        ])
+        block.append(indent + compound)
+        block += _block_source(rng, depth - 1, lines, indent + '    ')
+        if compound == 'try:':
+            block += [indent + 'except ValueError:', indent + '    pass']
+    return block
+
+def function_source(rng, name, depth, lines, indent=''):
+    'Return a list of lines of code defining a generated function'
+    source = ['%sdef %s(x, y):' % (indent, name), '%s    \'generated function %s\'' % (indent, name)]
+    source += _block_source(rng, depth, lines, indent + '    ')
+    source.append('%s    return x' % indent)
+    return source
+
+def generate_corpus(root, files, functions, depth, lines, seed=0):
+    '''
+    Write a package of generated modules under `root`, and return a list of
+    their paths.  The same arguments always generate the same code.
+
+    Args:
+    * `files` - the number of modules
+    * `functions` - the number of functions in each module; every fourth one
+        is a method of a class
+    * `depth` - how deeply compound statements are nested in each function
+    * `lines` - the number of simple statements in each block
+    '''
+    rng = random.Random(seed)
+    package_dir = os.path.join(root, 'generated')
+    os.makedirs(package_dir)
+    src_paths = [os.path.join(package_dir, '__init__.py')]
+    open(src_paths[0], 'w').close()
+
+    for i in range(files):
+        source = ['\'generated module %d\'' % i, '', 'import os', '']
+        methods = []
+        for j in range(functions):
+            if j % 4 == 3:
+                methods.append(j)
+            else:
+                source += function_source(rng, 'function_%d' % j, depth, lines) + ['']
+        if methods:
+            source += ['class Generated(object):']
+            for j in methods:
+                source += function_source(rng, 'method_%d' % j, depth, lines, '    ') + ['']
+
+        src_paths.append(os.path.join(package_dir, 'module_%d.py' % i))
+        with open(src_paths[-1], 'w') as fobj:
+            fobj.write('\n'.join(source) + '\n')
+    return src_paths
+
+def statement_lines(src_path):
+    'Return a sorted list of the line numbers of the statements in a module'
+    with open(src_path) as fobj:
+        tree = ast.parse(fobj.read(), filename=src_path)
+    return sorted(set(node.lineno for node in ast.walk(tree) if isinstance(node, ast.stmt)))
+
+def generate_coverage_xml(coverage_path, src_paths, hit_ratio=0.8, seed=0):
+    '''
+    Write a coverage.xml to `coverage_path` for `src_paths`, in the format
+    produced by coverage.py, marking about `hit_ratio` of the statements in
+    each module as hit.  Filenames are relative to the coverage.xml.
+    '''
+    rng = random.Random(seed)
+    coverage_dir = os.path.dirname(os.path.abspath(coverage_path))
+    root = xml.etree.ElementTree.Element('coverage', version='quality.benchmark')
+    sources = xml.etree.ElementTree.SubElement(root, 'sources')
+    xml.etree.ElementTree.SubElement(sources, 'source').text = coverage_dir
+    packages = xml.etree.ElementTree.SubElement(root, 'packages')
+    package = xml.etree.ElementTree.SubElement(packages, 'package', name='generated')
+    classes = xml.etree.ElementTree.SubElement(package, 'classes')
+    for src_path in src_paths:
+        filename = os.path.relpath(os.path.abspath(src_path), coverage_dir)
+        class_elem = xml.etree.ElementTree.SubElement(classes, 'class', filename=filename,
+            name=os.path.basename(filename))
+        xml.etree.ElementTree.SubElement(class_elem, 'methods')
+        lines_elem = xml.etree.ElementTree.SubElement(class_elem, 'lines')
+        for line in statement_lines(src_path):
+            xml.etree.ElementTree.SubElement(lines_elem, 'line', number=str(line),
+                hits='1' if rng.random() < hit_ratio else '0')
+    xml.etree.ElementTree.ElementTree(root).write(coverage_path)
+
+class NullOutput(object):
+    'A file-like object that throws away everything written to it'
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+def best_time(fn, repeat):
+    'Call `fn` `repeat` times, and return the shortest time taken, in seconds'
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        fn()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+def run_benchmark(src_paths, coverage_path, stages=STAGES, repeat=3):
+    '''
+    Time each of `stages` over the modules in `src_paths`, and return a dict
+    mapping stage names to the best of `repeat` times, in seconds.
+
+    Stages:
+    * parse - ast.parse for each module
+    * annotate - quality.core.annotate for each module's tree
+    * complexity - quality.complexity.complexity for each contestant
+    * coverage - building a CoverageIndex from the coverage.xml
+    * lint - one pylint run over all the modules
+    * tabnanny - tokenizing each module, and checking the tokens
+    * formula - evaluating the default formula over every contestant
+    * report - print_report for every contestant, to a null stream
+
+    Stages that need the results of earlier ones, e.g. annotate needing
+    parsed trees, get them even when the earlier stages aren't being timed.
+    Files are read before any timing starts.
+    '''
+    sources = [quality.core.SourceFile(src_path) for src_path in src_paths]
+    for source in sources:
+        source.data
+
+    trees = [ast.parse(source.data, filename=source.path) for source in sources]
+    contestants = []
+    for tree, source in zip(trees, sources):
+        contestants += quality.core.annotate(tree, source.path)
+
+    rng = random.Random(0)
+    judge_names = ('crap', 'lint', 'tabnanny')
+    records = [quality.core.ScoreRecord(contestant.src_file, contestant.name, judge_names,
+        (rng.random() * 100, rng.randint(0, 20), rng.randint(0, 1))) for contestant in contestants]
+    formula = compile(quality.cmdline.default_quality_formula(), '<formula>', 'eval')
+    quality.core.evaluate_formula(formula, records)
+    results = {}
+    for record in records:
+        results.setdefault(record.src_file, []).append(record)
+
+    def report():
+        with quality.liason.RedirectContext('stdout', NullOutput()):
+            quality.report.print_report(results)
+
+    stage_fns = {
+        'parse': lambda: [ast.parse(source.data, filename=source.path) for source in sources],
+        'annotate': lambda: [quality.core.annotate(tree, source.path) for tree, source in zip(trees, sources)],
+        'complexity': lambda: [quality.complexity.complexity(contestant.node) for contestant in contestants],
+        'coverage': lambda: quality.crap.CoverageIndex(quality.crap.iterparse_line_records(coverage_path), coverage_path),
+        'lint': lambda: quality.lint.run_pylint_batch(src_paths),
+        'tabnanny': lambda: [quality.tabnanny.check_tokens(quality.core.SourceFile(source.path, source.data).iter_tokens())
+            for source in sources],
+        'formula': lambda: quality.core.evaluate_formula(formula, records),
+        'report': report,
+    }
+    return dict((stage, best_time(stage_fns[stage], repeat)) for stage in stages)
+
+def find_regressions(timings, baseline, threshold=DEFAULT_THRESHOLD):
+    '''
+    Return a list of (stage, baseline time, current time) for each stage in
+    both `timings` and `baseline` that got more than `threshold` slower.
+    '''
+    return [(stage, baseline[stage], timings[stage]) for stage in sorted(timings)
+        if stage in baseline and timings[stage] > baseline[stage] * (1 + threshold)]
+
+def format_change(before, after):
+    'Return the change from `before` to `after` as a percentage, or n/a if `before` is 0'
+    if before == 0:
+        return 'n/a'
+    return '%+.1f%%' % ((after / before - 1) * 100)
+
+def load_baseline(path, corpus):
+    '''
+    Return the timings saved at `path` by save_baseline, or None if there are
+    none for the same corpus parameters.
+    '''
+    try:
+        with open(path) as fobj:
+            saved = json.load(fobj)
+    except IOError:
+        return None
+    if saved.get('corpus') != corpus:
+        return None
+    return saved['timings']
+
+def save_baseline(path, corpus, timings):
+    'Save `timings`, for a corpus generated with `corpus` parameters, as a baseline'
+    with open(path, 'w') as fobj:
+        json.dump({'corpus': corpus, 'timings': timings}, fobj, indent=2, sort_keys=True)
+
+def main(args=None):
+    '''
+    Generate a corpus, time the stages, and compare them with a baseline.
+
+    Returns 1 if any stage is slower than its baseline by more than the
+    threshold, or 0 otherwise.
+    '''
+    parser = optparse.OptionParser(usage='%prog [options]', description='Benchmark the stages of a quality contest')
+    for name, default in sorted(DEFAULT_CORPUS.items()):
+        parser.add_option('--' + name, action='store', type='int', default=default,
+            help='Corpus size: %s (default %d)' % (name, default))
+    parser.add_option('--stage', action='append', choices=STAGES, type='choice', dest='stages',
+        help='Only time this stage; can be specified multiple times')
+    parser.add_option('--repeat', action='store', type='int', default=3,
+        help='Time each stage this many times, and keep the best')
+    parser.add_option('--baseline', action='store', metavar='PATH',
+        help='Compare timings with the baseline saved in this file')
+    parser.add_option('--save-baseline', action='store_true', default=False,
+        help='Save these timings to the --baseline file')
+    parser.add_option('--threshold', action='store', type='float', default=DEFAULT_THRESHOLD,
+        help='Report stages more than this fraction slower than the baseline')
+    parser.add_option('--corpus-dir', action='store', metavar='PATH',
+        help='Generate the corpus in this new directory, and keep it')
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.error('Unexpected arguments: %s' % ' '.join(args))
+    if opts.save_baseline and not opts.baseline:
+        parser.error('--save-baseline requires --baseline')
+
+    corpus = dict((name, getattr(opts, name)) for name in DEFAULT_CORPUS)
+    root = opts.corpus_dir or tempfile.mkdtemp()
+    try:
+        if opts.corpus_dir:
+            os.makedirs(root)
+        src_paths = generate_corpus(root, **corpus)
+        coverage_path = os.path.join(root, 'coverage.xml')
+        generate_coverage_xml(coverage_path, src_paths)
+        timings = run_benchmark(src_paths, coverage_path, [stage for stage in STAGES
+            if not opts.stages or stage in opts.stages], opts.repeat)
+    finally:
+        if not opts.corpus_dir:
+            shutil.rmtree(root)
+
+    baseline = None
+    if opts.baseline:
+        baseline = load_baseline(opts.baseline, corpus)
+
+    chart = [['Stage', 'Seconds', 'Baseline', 'Change']]
+    for stage in STAGES:
+        if stage in timings:
+            if baseline and stage in baseline:
+                chart.append([stage, timings[stage], baseline[stage], format_change(baseline[stage], timings[stage])])
+            else:
+                chart.append([stage, timings[stage], '-', '-'])
+    quality.report.write_minimal_columns(chart, sys.stdout)
+
+    if opts.save_baseline:
+        save_baseline(opts.baseline, corpus, timings)
+    if baseline:
+        regressions = find_regressions(timings, baseline, opts.threshold)
+        for stage, before, after in regressions:
+            sys.stdout.write('Regression in %s: %.3fs, up from %.3fs\n' % (stage, after, before))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
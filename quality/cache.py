@@ -0,0 +1,164 @@
+'''
+A persistent, on-disk cache of contest results.
+'''
+
+import quality.core
+
+import cPickle
+import errno
+import hashlib
+import marshal
+import os
+import os.path
+import tempfile
+
+def judge_keys(src_path, options, recruited_judges):
+    '''
+    Return the name, version and `cache_key` of each judge in
+    `recruited_judges`, for scoring `src_path` with the given options.  These
+    are the parts of a ResultCache key that don't depend on the file's
+    contents or the formula.
+    '''
+    keys = []
+    for judge in recruited_judges:
+        judge_name = judge._quality_judge_name
+        judge_options = quality.core.extract_judge_kwargs(judge_name, options)
+        if hasattr(judge, 'cache_key'):
+            judge_key = judge.cache_key(src_path, **judge_options)
+        else:
+            judge_key = sorted(judge_options.items())
+        keys.append((judge_name, getattr(judge, '_quality_judge_version', None), judge_key))
+    return keys
+
+def run_keys(options, recruited_judges):
+    '''
+    Return the name, version and `run_key` of each judge in 
+    `recruited_judges`: whatever can influence the scores of any file in a 
+    run, such as the coverage data, taken once for the whole run, rather 
+    than per file as with judge_keys.  Judges without a `run_key` method are
+    keyed by their options.
+    '''
+    keys = []
+    for judge in recruited_judges:
+        judge_name = judge._quality_judge_name
+        judge_options = quality.core.extract_judge_kwargs(judge_name, options)
+        if hasattr(judge, 'run_key'):
+            judge_key = judge.run_key(**judge_options)
+        else:
+            judge_key = sorted(judge_options.items())
+        keys.append((judge_name, getattr(judge, '_quality_judge_version', None), judge_key))
+    return keys
+
+class ResultCache(object):
+    '''
+    Stores the contestants scored from each source file, so unchanged files
+    needn't be parsed or judged again on the next run.
+
+    Entries are keyed by everything that can influence the scores in a file:
+    its path and contents, the name and version of each judge, each judge's
+    options, and the formula.  Judges may narrow down their options by
+    providing a `cache_key` method, which receives the source path and the
+    judge's options and returns any picklable value; CrapJudge uses this to
+    key entries by the coverage data for the one file, rather than by the
+    whole coverage.xml.
+
+    Each entry is a pickle file under `path`.  Reading an entry touches its
+    modification time, so when the cache grows beyond `max_size` bytes, prune
+    discards the least recently used entries first.
+
+    Attributes:
+    * path - directory containing the cache entries
+    * max_size - size limit in bytes, or None for no limit
+    '''
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, src_path, src_text, options, formula, recruited_judges):
+        '''
+        Return the key for the results of scoring `src_path`, with contents
+        `src_text`, using the given options, formula and judges.
+        '''
+        parts = [src_path, hashlib.sha1(src_text).hexdigest(), marshal.dumps(formula)]
+        parts.extend(judge_keys(src_path, options, recruited_judges))
+        return hashlib.sha1(cPickle.dumps(parts, cPickle.HIGHEST_PROTOCOL)).hexdigest()
+
+    def entry_path(self, key):
+        'Return the path to the file that stores the entry for `key`'
+        # fan entries out into subdirectories, to keep directory listings short
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key):
+        'Return the contestants stored under `key`, or None if there are none'
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path, 'rb') as fobj:
+                contestants = cPickle.load(fobj)
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return None
+        except Exception:
+            # a truncated or otherwise unreadable entry is just a miss
+            self.discard(entry_path)
+            return None
+
+        # mark this entry as recently used
+        os.utime(entry_path, None)
+        return contestants
+
+    def put(self, key, contestants):
+        'Store `contestants` under `key`'
+        entry_path = self.entry_path(key)
+        entry_dir = os.path.dirname(entry_path)
+        try:
+            os.makedirs(entry_dir)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        # write to a temp file and rename it into place, so that readers never
+        # see a partially-written entry
+        fd, temp_path = tempfile.mkstemp(dir=entry_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                cPickle.dump(contestants, fobj, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, entry_path)
+        except Exception:
+            self.discard(temp_path)
+            raise
+
+    def discard(self, entry_path):
+        'Remove one entry file, ignoring the case where it\'s already gone'
+        try:
+            os.remove(entry_path)
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def prune(self):
+        '''
+        Discard the least recently used entries until the cache fits within
+        `max_size`.
+        '''
+        if self.max_size is None:
+            return
+
+        entries = []
+        total_size = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                entry_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, entry_path in entries:
+            if total_size <= self.max_size:
+                break
+            self.discard(entry_path)
+            total_size -= size
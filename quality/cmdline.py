@@ -2,27 +2,174 @@
 Command-line interface to quality calculation
 '''
 
+import quality.cache
 import quality.core
+import quality.crap
 import quality.report
+import quality.timing
+import quality.watch
 
 
+import cPickle
+import errno
+import itertools
+import marshal
 import optparse
 import os
 import os.path
 import re
 import StringIO
+import subprocess
+import sys
 import token
 import tokenize
+import warnings
+
+# reporters for the --format option that write results as files are scored; 
+# each is called with the path given by --output
+STREAMING_FORMATS = {
+    'jsonl': lambda path: open_file_reporter(quality.report.JsonLinesReporter, path),
+    'csv': lambda path: open_file_reporter(quality.report.CsvReporter, path),
+    'sqlite': lambda path: quality.report.SqliteReporter(path),
+}
+
+def open_file_reporter(reporter_cls, path):
+    '''
+    Return a `reporter_cls` writing to a new file at `path`, or to stdout if
+    `path` is None
+    '''
+    if path is None:
+        return reporter_cls(sys.stdout)
+    return reporter_cls(open(path, 'wb'), close_output=True)
 
 def default_quality_formula():
     'the stock formula, used with simple_parse_args'
     return 'crap + lint + 25*tabnanny'
 
+def formula_judge_names(formula, judge_names):
+    'Return a list of the names in `judge_names` that appear in the text of `formula`'
+    return [toktext for toktype, toktext, (_, _), (_, _), _ in tokenize.generate_tokens(StringIO.StringIO(formula).readline)
+        if toktype == token.NAME and toktext in judge_names]
+
 class FixedHelpFormatter(optparse.IndentedHelpFormatter):
     'Don\'t re-wrap description text'
     def format_description(self, description):
         return description
 
+# scandir avoids a stat call per directory entry; it's in the standard 
+# library from Python 3.5, and available as a package before that
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# regex syntax whose meaning depends on what follows a match; patterns using 
+# any of these can't be used to rule out whole directories
+END_SENSITIVE_SYNTAX = ['$', '\\Z', '(?=', '(?!', '\\b', '\\B']
+
+def combine_patterns(patterns):
+    '''
+    Return a function of one string that returns True if any of `patterns`, 
+    a list of compiled regexes, matches somewhere in the string.
+
+    Where possible, the patterns are combined into a single regex, so each
+    string is only scanned once.  Patterns that can't be safely combined, 
+    because they use groups (which backreferences may refer to by number), 
+    differing flags or verbose mode, are tried one at a time.
+    '''
+    combinable = [i for i in patterns if i.groups == 0 and i.flags == patterns[0].flags 
+        and not i.flags & re.VERBOSE]
+    others = [i for i in patterns if i not in combinable]
+    if len(combinable) > 1:
+        combinable = [re.compile('|'.join('(?:%s)' % i.pattern for i in combinable), patterns[0].flags)]
+
+    regexes = combinable + others
+    if len(regexes) == 1:
+        search = regexes[0].search
+        return lambda x: search(x) is not None
+    return lambda x: any(regex.search(x) for regex in regexes)
+
+def iter_source_files(source_dir, exclude=None, include=None):
+    '''
+    Like find_source_files, but returns an iterator that yields paths as 
+    they're found, so callers can start on the first files before the whole 
+    tree has been searched.  Bad arguments still raise ValueError straight 
+    away, rather than on the first call to next().
+
+    Directories are pruned before they're searched, when an `exclude` 
+    pattern matches the directory's path followed by a separator: every file
+    beneath it would be excluded anyway.  Patterns that look at what comes 
+    after the match, like '$' or lookaheads, are never used to prune.
+    '''
+    if os.path.isfile(source_dir) and source_dir.endswith('.py'):
+        # source_dir is a single file
+        return iter([source_dir])
+
+    if not os.path.isdir(source_dir) and not source_dir.endswith('.py'):
+        raise ValueError('Is neither a directory, nor a Python source file: %s' % source_dir)
+
+    if exclude and include:
+        raise ValueError('cannot handle both exclude and include patterns')
+
+    keep_file = lambda x: True
+    prune_dir = lambda x: False
+    if exclude:
+        excluded = combine_patterns(exclude)
+        keep_file = lambda x: not excluded(x)
+        prunable = [i for i in exclude if not any(syntax in i.pattern for syntax in END_SENSITIVE_SYNTAX)]
+        if prunable:
+            pruned = combine_patterns(prunable)
+            prune_dir = lambda x: pruned(os.path.join(x, ''))
+    elif include:
+        keep_file = combine_patterns(include)
+
+    if prune_dir(source_dir):
+        return iter([])
+    if scandir is None:
+        return _walk_source_files(source_dir, keep_file, prune_dir)
+    return _scan_source_files(source_dir, keep_file, prune_dir)
+
+def _walk_source_files(source_dir, keep_file, prune_dir):
+    'iter_source_files, for when scandir isn\'t available'
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        # os.walk only descends into directories left in dirnames
+        dirnames[:] = sorted(i for i in dirnames if not prune_dir(os.path.join(dirpath, i)))
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if filename.endswith('.py') and os.path.isfile(path) and keep_file(path):
+                yield path
+
+def _scan_source_files(source_dir, keep_file, prune_dir):
+    '''
+    iter_source_files, using scandir; this visits directories and files in 
+    the same order as _walk_source_files, including not following symlinks
+    to directories.
+    '''
+    stack = [source_dir]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = sorted(scandir(dirpath), key=lambda entry: entry.name)
+        except OSError:
+            # os.walk skips unreadable directories, too
+            continue
+
+        subdirs = []
+        for entry in entries:
+            path = os.path.join(dirpath, entry.name)
+            if entry.is_dir():
+                if not entry.is_symlink() and not prune_dir(path):
+                    subdirs.append(path)
+            elif entry.name.endswith('.py') and entry.is_file() and keep_file(path):
+                yield path
+
+        # push in reverse, so subdirectories are searched in order
+        subdirs.reverse()
+        stack.extend(subdirs)
+
 def find_source_files(source_dir, exclude=None, include=None):
     '''
     Return a list of paths to Python source files in `source_dir`
@@ -38,41 +185,99 @@ def find_source_files(source_dir, exclude=None, include=None):
     If `source_dir` is not a directory, only raise an error if it
     doesn't look like a Python source file.
     '''
-    if os.path.isfile(source_dir) and source_dir.endswith('.py'):
-        # source_dir is a single file
-        return [source_dir]
+    return list(iter_source_files(source_dir, exclude, include))
 
-    if not os.path.isdir(source_dir) and not source_dir.endswith('.py'):
-        raise ValueError('Is neither a directory, nor a Python source file: %s' % source_dir)
+def timed_discovery(profile, src_paths):
+    '''
+    Yield the paths from the iterator `src_paths`, timing the search for 
+    each one with `profile`, as the discover stage
+    '''
+    while True:
+        with profile.timed('discover'):
+            src_path = next(src_paths, None)
+        if src_path is None:
+            return
+        yield src_path
+
+def run_git(args, cwd):
+    '''
+    Run git with `args` in the directory `cwd`, and return its stdout.
 
-    if exclude and include:
-        raise ValueError('cannot handle both exclude and include patterns')
+    Raises ValueError if git fails.
+    '''
+    try:
+        proc = subprocess.Popen(['git'] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, exc:
+        raise ValueError('Could not run git: %s' % exc)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise ValueError('git %s failed: %s' % (' '.join(args), err.strip()))
+    return out
+
+def _git_dir(source_dir):
+    'Return the directory to run git in, for the files found in `source_dir`'
+    return source_dir if os.path.isdir(source_dir) else os.path.dirname(os.path.abspath(source_dir))
+
+def changed_source_files(ref, source_dir, source_files):
+    '''
+    Return the members of `source_files` that git reports as changed since
+    the commit `ref`.  This includes uncommitted changes and untracked files.
 
-    # make a function to encapsulate any filtering
-    # there's probably a clever way to do exclude and include using generators,
-    # but I can't think of a way to guarantee it short-circuits
-    if exclude:
-        def filter_fn(x):
-            for regex in exclude:
-                if regex.search(x):
-                    return False
-            return True
-    elif include:
-        def filter_fn(x):
-            for regex in include:
-                if regex.search(x):
-                    return True
-            return False
-    else:
-        filter_fn = lambda x: True
+    `source_dir` is the directory or file that `source_files` were found in; it
+    must be inside a git work tree.
+    '''
+    git_dir = _git_dir(source_dir)
+    toplevel = run_git(['rev-parse', '--show-toplevel'], git_dir).strip()
 
-    source_files = []
-    for dirpath, dirnames, filenames in os.walk(source_dir):
-        source_files += [os.path.join(dirpath, filename) for filename in 
-            filenames if filename.endswith('.py') and os.path.isfile(os.path.join(dirpath, filename))
-            and filter_fn(os.path.join(dirpath, filename))]
+    # both of these report paths relative to the top of the work tree
+    changed = run_git(['diff', '--name-only', ref, '--'], git_dir).splitlines()
+    changed += run_git(['ls-files', '--others', '--exclude-standard', '--full-name'], git_dir).splitlines()
+    changed = frozenset(os.path.realpath(os.path.join(toplevel, i)) for i in changed)
+
+    return [i for i in source_files if os.path.realpath(i) in changed]
 
-    return source_files
+def head_commit(source_dir):
+    'Return the SHA of the commit checked out in the git work tree holding `source_dir`'
+    return run_git(['rev-parse', '--verify', 'HEAD'], _git_dir(source_dir)).strip()
+
+def load_baseline(path, formula, run_keys):
+    '''
+    Return the baseline stored in the file at `path`, as a dict with keys:
+    * commit - SHA of the commit that the baseline's files were scored at
+    * results - dict mapping source paths to their results
+
+    Returns None if there is no baseline, or if it was scored with a different
+    formula, or different `run_keys`, as returned by quality.cache.run_keys, 
+    e.g. because the coverage data has changed, and so can't be combined 
+    with new results.
+    '''
+    try:
+        with open(path, 'rb') as fobj:
+            baseline = cPickle.load(fobj)
+    except IOError, exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return None
+
+    if baseline.get('formula') != marshal.dumps(formula) or baseline.get('run_keys') != run_keys:
+        warnings.warn('Baseline %s was scored with a different formula, judges or coverage data; ignoring it' % path)
+        return None
+    return baseline
+
+def save_baseline(path, commit, results, formula, run_keys):
+    '''
+    Store `results` in the baseline file at `path`, for later use with 
+    load_baseline.  `results` should only hold files whose contents match 
+    `commit`.
+    '''
+    baseline = {
+        'formula': marshal.dumps(formula),
+        'run_keys': run_keys,
+        'commit': commit,
+        'results': results,
+    }
+    with open(path, 'wb') as fobj:
+        cPickle.dump(baseline, fobj, cPickle.HIGHEST_PROTOCOL)
 
 def simple_parse_args(judge_names):
     'parse command-line args while making a lot of assumptions; quick-start mode'
@@ -81,7 +286,8 @@ def simple_parse_args(judge_names):
 
 Arguments:
     * source_dir: path to a directory, under which to score all contained modules
-    * coverage_path: path to the coverage.xml with data for the above modules
+    * coverage_path: path to the coverage.xml with data for the above modules,
+        or to the .coverage data file written by coverage.py 5 or later
 ''',
         usage='%prog [options] coverage_path source_dir',
         formatter=FixedHelpFormatter(),
@@ -92,6 +298,43 @@ Arguments:
         help='Exclude source files matching this pattern; can be specified multiple times')
     parser.add_option('-i', '--include', action='append',
         help='Include only source files matching this pattern; can be specified multiple times')
+    parser.add_option('-j', '--jobs', action='store', type='int', default=1,
+        help='Number of worker processes used to score files; 0 means one per CPU')
+    parser.add_option('--lint-jobs', action='store', type='int', default=1,
+        help='Number of long-lived pylint worker processes; 0 means one per CPU')
+    parser.add_option('--lint-timeout', action='store', type='float', metavar='SECONDS',
+        help='How long to wait for a pylint worker process to lint a batch of files, before linting them '
+            'in this process instead')
+    parser.add_option('--cache-dir', action='store',
+        help='Keep results in this directory, and only rescore files that changed since they were cached')
+    parser.add_option('--cache-size', action='store', type='int', default=256,
+        help='Size limit for the result cache, in megabytes; least recently used results are discarded first')
+    parser.add_option('--since', action='store', metavar='REF',
+        help='Only score files that git reports as changed since this commit, and only report on those, '
+            'unless there\'s a --baseline')
+    parser.add_option('--baseline', action='store', metavar='PATH',
+        help='File holding the results of a previous run; it is updated with the results of this run.  With '
+            '--since, the report covers the whole tree: files changed since REF, or since the commit the baseline '
+            'was scored at, are rescored, and the rest come from the baseline')
+    parser.add_option('--top', action='store', type='int', metavar='N',
+        help='Only report the N items with the highest final scores')
+    parser.add_option('--format', action='store', type='choice', choices=['table'] + sorted(STREAMING_FORMATS), 
+        default='table',
+        help='Report format: a text table once the run is done (the default), or JSON Lines, CSV or SQLite, '
+            'written as each file is scored')
+    parser.add_option('-o', '--output', action='store', metavar='PATH',
+        help='Write the report here, rather than stdout; required for --format=sqlite')
+    parser.add_option('--watch', action='store_true', default=False,
+        help='Keep running, and rescore files as they change; only the rows for changed files are reprinted')
+    parser.add_option('--watch-interval', action='store', type='float', default=quality.watch.DEFAULT_INTERVAL,
+        metavar='SECONDS', help='How often --watch checks for changes, when inotify isn\'t available')
+    parser.add_option('--profile', action='store_true', default=False,
+        help='Print the time taken by each stage, judge and file to stderr, once the run is done')
+    parser.add_option('--profile-json', action='store', metavar='PATH',
+        help='Write the same timings as --profile to this file, as JSON')
+    parser.add_option('--profile-top', action='store', type='int', metavar='N', 
+        default=quality.timing.DEFAULT_TOP_FILES,
+        help='Number of slowest files listed by --profile and --profile-json')
     
     opts, args = parser.parse_args()
 
@@ -104,14 +347,55 @@ Arguments:
     # validate args
     if not os.path.isfile(coverage_file):
         parser.error('Invalid coverage file argument: %s' % coverage_file)
+    if quality.crap.is_sqlite_file(coverage_file):
+        try:
+            quality.crap.SqliteCoverageIndex(coverage_file)
+        except ValueError, exc:
+            parser.error('Invalid coverage file argument: %s' % exc)
     source_options = {'crap:coverage_file': coverage_file}
+    if opts.lint_jobs != 1:
+        source_options['lint:jobs'] = opts.lint_jobs
+    if opts.lint_timeout is not None:
+        source_options['lint:timeout'] = opts.lint_timeout
 
     # validate formula
-    judges = [toktext for toktype, toktext, (_, _), (_, _), _ in tokenize.generate_tokens(StringIO.StringIO(opts.formula).readline)
-        if toktype == token.NAME and toktext in judge_names]
+    judges = formula_judge_names(opts.formula, judge_names)
     if judges == []:
         parser.error('Provided formula doesn\'t include any known metric names: %s' % opts.formula)
 
+    if opts.jobs < 0:
+        parser.error('Invalid number of jobs: %d' % opts.jobs)
+    if opts.lint_jobs < 0:
+        parser.error('Invalid number of pylint jobs: %d' % opts.lint_jobs)
+    if opts.lint_jobs != 1 and opts.jobs != 1:
+        parser.error('--lint-jobs can\'t be combined with --jobs')
+    if opts.lint_timeout is not None and opts.lint_timeout <= 0:
+        parser.error('Invalid pylint timeout: %s' % opts.lint_timeout)
+    if opts.cache_size <= 0:
+        parser.error('Invalid cache size: %d' % opts.cache_size)
+    if opts.top is not None and opts.top <= 0:
+        parser.error('Invalid number of items to report: %d' % opts.top)
+    if opts.top is not None and opts.format != 'table':
+        parser.error('--top can only be used with --format=table')
+    if opts.format == 'sqlite' and not opts.output:
+        parser.error('--format=sqlite requires --output')
+    if opts.format == 'table' and opts.output:
+        parser.error('--output can\'t be used with --format=table')
+    if opts.profile_top < 0:
+        parser.error('Invalid number of files to profile: %d' % opts.profile_top)
+    if opts.watch:
+        if opts.watch_interval <= 0:
+            parser.error('Invalid watch interval: %s' % opts.watch_interval)
+        # judges only stay warm in this process, and results are reprinted as
+        # a table, for one tree at a time
+        for option, conflict in [('--jobs', opts.jobs != 1), ('--format', opts.format != 'table'), 
+                ('--since', opts.since), ('--baseline', opts.baseline), 
+                ('--profile', opts.profile or opts.profile_json)]:
+            if conflict:
+                parser.error('--watch can\'t be combined with %s' % option)
+    opts.source_dir = source_dir
+    opts.coverage_file = coverage_file
+
     # validate include/exclude
     if opts.exclude and opts.include:
         parser.error('Cannot combine both \'exclude\' and \'include\' options')
@@ -123,10 +407,29 @@ Arguments:
     except re.error, exc:
         parser.error('Error parsing regular expression: %s' % exc.args[0])
 
-    # find Python source files
-    source_files = find_source_files(source_dir, exclude=opts.exclude, include=opts.include)
-    if source_files == []:
+    # timings start here, so that they include finding the files
+    opts.profiler = None
+    if opts.profile or opts.profile_json:
+        opts.profiler = quality.timing.Profile()
+
+    # find Python source files; unless the whole list is needed up front, 
+    # they're handed on as they're found, so that scoring starts straight away
+    source_files = timed_discovery(opts.profiler or quality.timing.NULL_PROFILE, 
+        iter_source_files(source_dir, exclude=opts.exclude, include=opts.include))
+    first_file = next(source_files, None)
+    if first_file is None:
         parser.error('Did not find any files ending in .py within %s' % source_dir)
+    source_files = itertools.chain([first_file], source_files)
+    if opts.since or opts.baseline or opts.watch:
+        source_files = list(source_files)
+
+    # narrow down to the files that changed
+    opts.changed_files = None
+    if opts.since:
+        try:
+            opts.changed_files = changed_source_files(opts.since, source_dir, source_files)
+        except ValueError, exc:
+            parser.error(str(exc))
 
     # compile the formula for final scoring
     opts.formula = compile(opts.formula, filename='<formula>', mode='eval')
@@ -138,16 +441,129 @@ Arguments:
 
 
 
+def watch(source_files, source_options, opts, recruited_judges, cache):
+    '''
+    --watch mode: report on all of `source_files`, then keep reporting on 
+    whichever files change, until interrupted.
+    '''
+    watcher = quality.watch.make_watcher(opts.source_dir, 
+        lambda: find_source_files(opts.source_dir, exclude=opts.exclude, include=opts.include), 
+        [opts.coverage_file], opts.watch_interval)
+
+    reports = []
+    def on_rescore(results, rescored, removed, elapsed):
+        if not reports:
+            quality.report.print_report(results, top=opts.top)
+        else:
+            for src_path in removed:
+                sys.stdout.write('Removed: %s\n' % src_path)
+            quality.report.print_report(dict((src_path, results[src_path]) for src_path in rescored 
+                if src_path in results))
+        reports.append(elapsed)
+        sys.stdout.flush()
+        sys.stderr.write('Scored %d files in %.3fs; watching for changes\n' % (len(rescored), elapsed))
+
+    try:
+        quality.watch.watch_contest(watcher, source_files, source_options, opts.formula, recruited_judges, 
+            on_rescore, coverage_file=opts.coverage_file, cache=cache)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        for judge in recruited_judges:
+            if hasattr(judge, 'close'):
+                judge.close()
+
 def main():
     judges = quality.core.load_judges()
 
     (source_files, source_options), opts, recruited_judge_names = simple_parse_args([judge._quality_judge_name for judge in judges])
     recruited_judges = [judge for judge in judges if judge._quality_judge_name in recruited_judge_names]
 
-    results = quality.core.run_contest(source_files, source_options, opts.formula, recruited_judges)
-
-    # todo: allow for different types of reporters, and to get configuration options to them
-
-    reporters = [quality.report.print_report]
-    for reporter in reporters:
-        reporter(results)
\ No newline at end of file
+    cache = None
+    if opts.cache_dir:
+        cache = quality.cache.ResultCache(opts.cache_dir, opts.cache_size * 1024 * 1024)
+
+    if opts.watch:
+        watch(source_files, source_options, opts, recruited_judges, cache)
+        return
+
+    run_keys = None
+    baseline = None
+    if opts.baseline:
+        run_keys = quality.cache.run_keys(source_options, recruited_judges)
+    if opts.since and opts.baseline:
+        baseline = load_baseline(opts.baseline, opts.formula, run_keys)
+    if baseline is not None:
+        # files changed since --since are rescored, and so are those changed 
+        # since the baseline was scored, whose results there are out of date
+        try:
+            stale = frozenset(changed_source_files(baseline['commit'], opts.source_dir, source_files))
+        except ValueError, exc:
+            warnings.warn('Baseline %s can\'t be compared with this tree (%s); ignoring it' % (opts.baseline, exc))
+            baseline = None
+
+    reused = {}
+    if baseline is not None:
+        changed = frozenset(opts.changed_files)
+        for src_path in source_files:
+            if src_path in baseline['results'] and src_path not in changed and src_path not in stale:
+                reused[src_path] = baseline['results'][src_path]
+        targets = [src_path for src_path in source_files if src_path not in reused]
+    elif opts.since and not opts.baseline:
+        targets = opts.changed_files
+    else:
+        # score everything
+        targets = source_files
+
+    streaming_reporter = None
+    if opts.format in STREAMING_FORMATS:
+        streaming_reporter = STREAMING_FORMATS[opts.format](opts.output)
+
+    # results only need to be kept for the table, or the baseline
+    results = quality.core.run_contest(targets, source_options, opts.formula, recruited_judges, 
+        jobs=opts.jobs, cache=cache, compact=True, on_file=streaming_reporter,
+        collect_results=streaming_reporter is None or bool(opts.baseline), profile=opts.profiler)
+    profile = opts.profiler or quality.timing.NULL_PROFILE
+
+    if baseline is not None:
+        # fill in the rest of the tree from the baseline
+        new_results = results
+        results = {}
+        for src_path in source_files:
+            if src_path in new_results:
+                results[src_path] = new_results[src_path]
+            elif src_path in reused:
+                results[src_path] = reused[src_path]
+                if streaming_reporter is not None:
+                    with profile.timed('report', src_path):
+                        streaming_reporter(src_path, reused[src_path])
+
+    if opts.baseline:
+        # files with uncommitted changes are left out, so that they're 
+        # rescored next time, even if they're changed back
+        try:
+            commit = head_commit(opts.source_dir)
+            uncommitted = frozenset(changed_source_files(commit, opts.source_dir, list(results)))
+        except ValueError, exc:
+            warnings.warn('Baseline %s not saved: %s' % (opts.baseline, exc))
+        else:
+            save_baseline(opts.baseline, commit, dict((src_path, src_results) 
+                for src_path, src_results in results.iteritems() if src_path not in uncommitted), 
+                opts.formula, run_keys)
+
+    for judge in recruited_judges:
+        if hasattr(judge, 'close'):
+            judge.close()
+
+    with profile.timed('report'):
+        if streaming_reporter is not None:
+            streaming_reporter.close()
+        else:
+            quality.report.print_report(results, top=opts.top)
+
+    if opts.profile:
+        opts.profiler.write_summary(sys.stderr, opts.profile_top)
+    if opts.profile_json:
+        with open(opts.profile_json, 'w') as fobj:
+            opts.profiler.write_json(fobj, opts.profile_top)
@@ -9,8 +9,8 @@ correct-ish.
 
 import ast
 
-# a list of things that bump up complexity scores
-_CC_NODE_TYPES = [
+# a set of things that bump up complexity scores
+_CC_NODE_TYPES = frozenset([
     'FunctionDef', # is this correct? Does this really add a path through the code?
     'ClassDef', # and this as well?
     'For',
@@ -22,9 +22,13 @@ _CC_NODE_TYPES = [
     'SetComp',
     'DictComp',
     'BoolOp',
-]
+])
 
 
+def branch_count(node):
+    'Return the complexity added by `node` itself, not counting its children'
+    return 1 if node.__class__.__name__ in _CC_NODE_TYPES else 0
+
 def complexity(node):
     '''
     Descend to child nodes and sum their complexity.  Avoids descending into other 
@@ -33,6 +37,4 @@ def complexity(node):
     child_complexity = sum(complexity(child) for child in ast.iter_child_nodes(node)
         if child.__class__.__name__ not in ['Module', 'FunctionDef', 'ClassDef'])
 
-    cur_complexity = 1 if node.__class__.__name__ in _CC_NODE_TYPES else 0
-
-    return cur_complexity + child_complexity
\ No newline at end of file
+    return branch_count(node) + child_complexity
\ No newline at end of file
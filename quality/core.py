@@ -4,9 +4,21 @@ Code quality analysis for Python.
 
 # general module todo: what about lambdas?
 
+import quality.complexity
+import quality.timing
+
+import __builtin__
 import ast
+import itertools
+import multiprocessing
+import tokenize
 import warnings
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # ###
 # Our concept of "qualified name" : http://www.python.org/dev/peps/pep-3155/
 # until PEP-3155 is ubiquitous, we do that work ourselves in annotate_qualname
@@ -90,6 +102,220 @@ def find_contestants(node, src_path):
 
     return ret
 
+_CONTESTANT_TYPES = frozenset(['Module', 'ClassDef', 'FunctionDef'])
+
+def is_docstring(node):
+    'Return True if `node` is an expression statement consisting of a string'
+    return node.__class__.__name__ == 'Expr' and node.value.__class__.__name__ == 'Str'
+
+def annotate(tree, src_path):
+    '''
+    Annotate `tree` and return a list of Contestants representing its 
+    Modules, ClassDefs, and FunctionDefs, in the same order as find_contestants.
+
+    Each of those nodes receives the 'qualname' attribute of annotate_qualnames,
+    the 'descendant_lines' attribute of annotate_linenums, and a 'complexity'
+    attribute holding the result of quality.complexity.complexity.
+
+    This produces the same results as calling those four functions, but 
+    visits every node exactly once, and uses an explicit stack rather than 
+    recursion, so deeply nested trees don't hit the recursion limit.  The
+    Contestants also share a LineIndex of the file, as `line_index`.
+
+    - `tree` - ast node, usually a Module
+    - `src_path` - filename of the original source
+    '''
+    contestants = []
+
+    # entries are (node, nearest enclosing contestant node, whether the node's 
+    # line number counts toward that contestant)
+    stack = [(tree, None, False)]
+    while stack:
+        node, scope, counted = stack.pop()
+        kind = node.__class__.__name__
+
+        if kind in _CONTESTANT_TYPES:
+            if kind == 'Module':
+                node.qualname = '<module>'
+            elif scope is None or scope.__class__.__name__ == 'Module':
+                node.qualname = node.name
+            else:
+                node.qualname = scope.qualname + '.' + node.name
+            node.descendant_lines = set()
+            node.complexity = quality.complexity.branch_count(node)
+            contestants.append(Contestant(node, src_path))
+
+            # only the body of a class or function contributes line numbers; 
+            # decorators, arguments and base classes only count toward complexity
+            if kind == 'Module':
+                line_children = list(ast.iter_child_nodes(node))
+                other_children = []
+            else:
+                line_children = node.body
+                other_children = []
+                for name, field in ast.iter_fields(node):
+                    if name == 'body':
+                        continue
+                    if isinstance(field, ast.AST):
+                        other_children.append(field)
+                    elif isinstance(field, list):
+                        other_children.extend(child for child in field if isinstance(child, ast.AST))
+            scope = node
+            counted = True
+        else:
+            if counted and hasattr(node, 'lineno'):
+                scope.descendant_lines.add(node.lineno)
+            scope.complexity += quality.complexity.branch_count(node)
+            line_children = list(ast.iter_child_nodes(node))
+            other_children = []
+
+        children = [(child, scope, False) for child in other_children]
+        children += [(child, scope, counted) for child in line_children]
+        if counted and line_children and is_docstring(line_children[0]):
+            # exclude docstrings from line numbers
+            children[len(other_children)] = (line_children[0], scope, False)
+
+        # push in reverse, so children are visited in order
+        children.reverse()
+        stack.extend(children)
+
+    line_index = LineIndex(contestants)
+    for contestant in contestants:
+        contestant.line_index = line_index
+
+    return contestants
+
+class LineIndex(object):
+    '''
+    Maps the line numbers of one source file to the Contestants that own them,
+    so that judges with line-based findings, such as pylint messages or 
+    covered lines, can attribute all the findings for a file in one pass, 
+    rather than testing every finding against every Contestant.
+
+    A line is owned by each Contestant whose `linenums` contain it.  For 
+    Contestants from annotate, that's never more than one, but the index 
+    doesn't depend on it.
+
+    Attributes:
+    * contestants - list of the file's Contestants
+    * owners_by_line - list whose items are tuples of the Contestants owning 
+        the line number used as the index
+    '''
+    def __init__(self, contestants):
+        self.contestants = contestants
+        size = max([max(c.linenums) for c in contestants if c.linenums] or [-1]) + 1
+        self.owners_by_line = [()] * size
+        for contestant in contestants:
+            for line in contestant.linenums:
+                self.owners_by_line[line] += (contestant,)
+
+    def owners(self, line):
+        'Return a tuple of the Contestants owning line number `line`'
+        if 0 <= line < len(self.owners_by_line):
+            return self.owners_by_line[line]
+        return ()
+
+    def bucket(self, findings):
+        '''
+        Sort line-based findings by the Contestants they belong to.
+
+        Args:
+        * `findings` - iterable of (line number, value) pairs
+
+        Returns a dict mapping each of `contestants` to a list of the values
+        found on its lines, in the order they were given.  Findings on lines 
+        that no Contestant owns are dropped.
+        '''
+        buckets = dict((contestant, []) for contestant in self.contestants)
+        owners_by_line = self.owners_by_line
+        size = len(owners_by_line)
+        for line, value in findings:
+            if 0 <= line < size:
+                for owner in owners_by_line[line]:
+                    buckets[owner].append(value)
+        return buckets
+
+class SourceFile(object):
+    '''
+    The contents of one source file, read from disk exactly once, and shared 
+    by everything that needs to look at it during a run: the cache, the 
+    parser, and the judges, via `Contestant.source`.
+
+    Everything besides the raw bytes is derived on first use, and then kept.
+    Pickling keeps only the path and bytes; the rest is derived again after 
+    unpickling, if it's needed.
+
+    Attributes:
+    * path - path to the source file
+    * data - contents of the file, as a byte string
+    * lines - list of the lines in `data`, including line endings
+    * tree - AST of the module; accessing it may raise SyntaxError
+    '''
+    def __init__(self, path, data=None):
+        self.path = path
+        self._data = data
+        self._lines = None
+        self._tokens = None
+        self._tree = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            with open(self.path, 'rb') as fobj:
+                self._data = fobj.read()
+        return self._data
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = self.data.splitlines(True)
+        return self._lines
+
+    def iter_tokens(self):
+        '''
+        Iterate over the tokens of the file, as from tokenize.generate_tokens.
+
+        The file is only tokenized once; later calls replay the same tokens.
+        If tokenizing failed part of the way through, every call yields the 
+        tokens up to the failure, then raises the same exception.
+        '''
+        if self._tokens is None:
+            tokens = []
+            error = None
+            try:
+                tokens.extend(tokenize.generate_tokens(iter(self.lines).next))
+            except (tokenize.TokenError, IndentationError), exc:
+                error = exc
+            self._tokens = (tokens, error)
+
+        tokens, error = self._tokens
+        for token in tokens:
+            yield token
+        if error is not None:
+            raise error
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = ast.parse(self.data, filename=self.path)
+        return self._tree
+
+    def __getstate__(self):
+        return (self.path, self._data)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+class SourceCache(dict):
+    '''
+    A dict mapping paths to SourceFiles, which creates entries as they're 
+    first needed.  Callers should remove each entry once they're done with 
+    its file, so that the cache only holds the files currently in use.
+    '''
+    def __missing__(self, path):
+        self[path] = SourceFile(path)
+        return self[path]
+
 class Contestant(object):
     '''
     An item that can have a quality score:
@@ -107,6 +333,9 @@ class Contestant(object):
     * scorecards - scores from each indivdual judge
     * final_score - combined score from all judges
     * src_file - path to the source file defining this Contestant
+    * line_index - LineIndex shared by all Contestants from the same file, 
+        or None if it hasn't been built
+    * source - SourceFile for the file defining this Contestant, or None
     '''
     def __init__(self, node, src_file):
         self.node = node
@@ -115,6 +344,57 @@ class Contestant(object):
         self.scores = None
         self.final_score = None
         self.src_file = src_file
+        self.line_index = None
+        self.source = None
+
+def _intern(name):
+    'intern() `name` if it\'s a byte string; Python 2 can\'t intern unicode'
+    return intern(name) if type(name) is str else name
+
+class ScoreRecord(object):
+    '''
+    A compact stand-in for a Contestant whose judging is done.  It keeps only
+    what reporters need, and drops the AST node and line numbers.
+
+    File and item names are interned, so that all records for one file share 
+    a single copy of its path; unicode names can't be, and are kept as given.
+    Scores are kept as a tuple ordered like `judge_names`, which is a tuple 
+    shared by all records from the same run; the `scores` property rebuilds 
+    the dict a Contestant would have.
+
+    Attributes:
+    * src_file - path to the source file defining this item
+    * name - qualified name of the item
+    * judge_names - tuple of judge names
+    * score_values - tuple of scores from each judge, in the order of `judge_names`
+    * final_score - combined score from all judges
+    '''
+    __slots__ = ('src_file', 'name', 'judge_names', 'score_values', 'final_score')
+
+    def __init__(self, src_file, name, judge_names, score_values, final_score=None):
+        self.src_file = _intern(src_file)
+        self.name = _intern(name)
+        self.judge_names = judge_names
+        self.score_values = score_values
+        self.final_score = final_score
+
+    @classmethod
+    def from_contestant(cls, contestant, judge_names):
+        'Make a record of `contestant`; `judge_names` is a tuple of the names of its judges'
+        return cls(contestant.src_file, contestant.name, judge_names, 
+            tuple(contestant.scores[judge_name] for judge_name in judge_names), contestant.final_score)
+
+    @property
+    def scores(self):
+        'dict mapping judge names to scores, like Contestant.scores'
+        return dict(itertools.izip(self.judge_names, self.score_values))
+
+    def __getstate__(self):
+        return (self.src_file, self.name, self.judge_names, self.score_values, self.final_score)
+
+    def __setstate__(self, state):
+        # __init__ isn't called when unpickling; make sure names are interned anyway
+        self.__init__(*state)
 
 def extract_judge_kwargs(judge_name, kwargs):
     '''
@@ -127,7 +407,275 @@ def extract_judge_kwargs(judge_name, kwargs):
     filtered = dict((k[len(prefix):], v) for k, v in kwargs.iteritems() if k.startswith(prefix))
     return filtered
 
-def run_contest(src_paths, options, formula, recruited_judges):
+class BoundJudge(object):
+    '''
+    A judge, with its options picked out of the full options dict once, 
+    rather than for every call.
+
+    Called with a list of Contestants from one file, it returns a list of 
+    their scores.  Judges may score a whole file at once by providing a 
+    `judge_file` method, which receives the list and the judge's options, 
+    and returns the scores, in the same order; this lets them share work 
+    between Contestants, and saves a call per Contestant.  Other judges are 
+    called once per Contestant, as judge(contestant, **options).
+
+    Judges that work on files in batches may also report how long each file
+    took, by providing a `pop_file_times` method, which returns a list of 
+    (path, wall seconds, cpu seconds) for the files done since it was last 
+    called.
+
+    Attributes:
+    * judge - the original judge
+    * name - the judge's name
+    * options - dict of the judge's own options, with the prefix removed
+    * pop_file_times - the judge's pop_file_times method, or None
+    '''
+    def __init__(self, judge, options):
+        self.judge = judge
+        self.name = judge._quality_judge_name
+        self.options = extract_judge_kwargs(self.name, options)
+        self.pop_file_times = getattr(judge, 'pop_file_times', None)
+
+    def __call__(self, contestants):
+        if hasattr(self.judge, 'judge_file'):
+            return self.judge.judge_file(contestants, **self.options)
+        judge = self.judge
+        options = self.options
+        return [judge(contestant, **options) for contestant in contestants]
+
+    def prefetch(self, src_paths, profile=quality.timing.NULL_PROFILE):
+        '''
+        Hand `src_paths` to the judge's prefetch method, if it has one, timing
+        it with `profile`
+        '''
+        if hasattr(self.judge, 'prefetch'):
+            with profile.timed('prefetch:' + self.name) as timer:
+                self.judge.prefetch(src_paths, **self.options)
+                self.record_file_times(profile, timer)
+
+    def record_file_times(self, profile, timer=None):
+        '''
+        Record the times from the judge's pop_file_times, if it has one, with
+        `profile`, as its 'prefetch:<judge>' stage for each file.  `timer` is
+        the StageTimer of the prefetch during which the files were done, if 
+        any; their times are left out of its own, so they aren't counted 
+        twice.
+        '''
+        if self.pop_file_times is not None:
+            stage = 'prefetch:' + self.name
+            for src_path, wall, cpu in self.pop_file_times():
+                event = quality.timing.TimingEvent(stage, src_path, wall, cpu)
+                profile.record(event)
+                if timer is not None:
+                    timer.exclude(event)
+
+def bind_judges(recruited_judges, options):
+    'Return a list of BoundJudges for `recruited_judges`'
+    return [BoundJudge(judge, options) for judge in recruited_judges]
+
+def score_file(src_path, options, recruited_judges, compact=False, source=None, bound_judges=None, 
+        profile=quality.timing.NULL_PROFILE):
+    '''
+    Parse a single source file, discover its contestants, and record the 
+    results of each judge applied to them.  Final scores are left for 
+    evaluate_formula.
+
+    `source` is the SourceFile for `src_path`, if the caller already has one;
+    otherwise, the file is read here.  Either way, judges can reach it as 
+    `Contestant.source`.
+
+    `bound_judges` is the result of bind_judges(recruited_judges, options), 
+    for callers scoring many files.
+
+    Reading, parsing and each judge's work are timed with `profile`, a 
+    quality.timing.Profile.
+
+    Returns a list of contestants, or None if the file could not be parsed.
+    If `compact` is True, the list holds ScoreRecords instead, and the 
+    file's AST can be freed as soon as this returns.
+    '''
+    if source is None:
+        source = SourceFile(src_path)
+    with profile.timed('read', src_path):
+        source.data
+    with profile.timed('parse', src_path):
+        contestants = parse_file(src_path, source)
+    if contestants is None:
+        return None
+
+    if bound_judges is None:
+        bound_judges = bind_judges(recruited_judges, options)
+    judge_names = tuple(judge.name for judge in bound_judges)
+    # one list of scores per judge, in the order of contestants
+    score_columns = []
+    for judge in bound_judges:
+        with profile.timed('judge:' + judge.name, src_path):
+            score_columns.append(judge(contestants))
+        # the times for files a judge hands to its own worker processes only
+        # arrive as it collects their results
+        if judge.pop_file_times is not None:
+            judge.record_file_times(profile)
+    score_rows = itertools.izip(*score_columns) if score_columns else itertools.repeat(())
+
+    if compact:
+        return [ScoreRecord(contestant.src_file, contestant.name, judge_names, score_values) 
+            for contestant, score_values in itertools.izip(contestants, score_rows)]
+
+    for contestant, score_values in itertools.izip(contestants, score_rows):
+        contestant.scores = dict(itertools.izip(judge_names, score_values))
+    return contestants
+
+def parse_file(src_path, source=None):
+    '''
+    The first half of score_file: parse a single source file, and return a 
+    list of its contestants, not yet judged, or None if the file could not be 
+    parsed.
+    '''
+    if source is None:
+        source = SourceFile(src_path)
+
+    try:
+        # parse the source with the ast module
+        src_tree = source.tree
+    except (IndentationError, SyntaxError), exc:
+        warnings.warn('Exception encountered while parsing file %s: %s' % (src_path, exc))
+        return None
+    
+    # add linenums, qualnames and complexity to nodes, and build a list of contestants
+    contestants = annotate(src_tree, src_path)
+    for contestant in contestants:
+        contestant.source = source
+    return contestants
+
+def evaluate_formula(formula, contestants, builtins=None):
+    '''
+    Calculate the final, combined score for each of `contestants`, by 
+    evaluating `formula` against its scores.  `builtins` is the dict of 
+    builtins available to the formula; None means all of them.
+
+    If NumPy is available, the scores from each judge are gathered into an 
+    array, and the formula is evaluated once, over whole arrays.  Formulas 
+    that don't work the same way on arrays as on individual scores, e.g.
+    those with conditionals or calls like max(), are evaluated once per 
+    contestant instead.  Either way, the final scores are the same.
+
+    `formula` may be a code object, or a string to be compiled.
+    '''
+    if isinstance(formula, basestring):
+        formula = compile(formula, '<formula>', 'eval')
+
+    if builtins is None:
+        builtins = __builtin__.__dict__
+
+    if numpy is not None and len(contestants) > 1:
+        final_scores = evaluate_formula_columns(formula, contestants, builtins)
+        if final_scores is not None:
+            for contestant, final_score in itertools.izip(contestants, final_scores):
+                contestant.final_score = final_score
+            return
+
+    for contestant in contestants:
+        context = contestant.scores.copy()
+        context['__builtins__'] = builtins
+        contestant.final_score = eval(formula, context)
+
+def evaluate_formula_columns(formula, contestants, builtins=None):
+    '''
+    Evaluate `formula` once, over arrays of the scores of `contestants`, with
+    `builtins` as in evaluate_formula.
+
+    Returns a list of final scores, or None if the formula can't be evaluated
+    this way.  Scores are kept in float arrays only when every score from a
+    judge is a float; otherwise they are kept in object arrays, which apply
+    Python's own arithmetic to each element, so that ints stay ints.
+    '''
+    if isinstance(contestants[0], ScoreRecord):
+        # avoid building a scores dict for every record
+        judge_names = contestants[0].judge_names
+        all_scores = [contestant.score_values for contestant in contestants]
+        keys = range(len(judge_names))
+    else:
+        judge_names = contestants[0].scores.keys()
+        all_scores = [contestant.scores for contestant in contestants]
+        keys = judge_names
+
+    if builtins is None:
+        builtins = __builtin__.__dict__
+    # other names, such as attributes, might mean something different for an array
+    if any(name not in judge_names and name not in builtins for name in formula.co_names):
+        return None
+
+    context = {}
+    for judge_name, key in itertools.izip(judge_names, keys):
+        column = [scores[key] for scores in all_scores]
+        dtype = float if set(itertools.imap(type, column)) == set([float]) else object
+        context[judge_name] = numpy.array(column, dtype=dtype)
+    context['__builtins__'] = builtins
+
+    try:
+        # Python raises on division by zero and the like; make NumPy do the same
+        with numpy.errstate(all='raise'):
+            final_scores = eval(formula, context)
+    except Exception:
+        return None
+
+    if isinstance(final_scores, numpy.ndarray):
+        if final_scores.shape != (len(contestants),):
+            return None
+        return final_scores.tolist()
+
+    if any(name in judge_names for name in formula.co_names):
+        # the formula reduced the arrays to a single value, e.g. with sum()
+        return None
+    # the formula doesn't depend on the scores at all
+    return [final_scores] * len(contestants)
+
+# arguments to score_file, held by each worker process for the length of a run
+_worker_args = None
+
+def _init_worker(options, recruited_judges, compact, profiling=False):
+    'Initializer for worker processes'
+    global _worker_args
+    _worker_args = (options, recruited_judges, compact, bind_judges(recruited_judges, options), profiling)
+
+def _score_files_in_worker(chunk):
+    '''
+    BoundJudge.prefetch and score_file, as invoked inside a worker process, 
+    for a chunk of (path, SourceFile or None) pairs.  Returns the (path, 
+    contestants) pairs, and a list of the TimingEvents recorded along the 
+    way, which is empty unless the run is being profiled.
+    '''
+    options, recruited_judges, compact, bound_judges, profiling = _worker_args
+    events = []
+    profile = quality.timing.Profile([events.append]) if profiling else quality.timing.NULL_PROFILE
+    for judge in bound_judges:
+        judge.prefetch([src_path for src_path, source in chunk], profile)
+    return [(src_path, score_file(src_path, options, recruited_judges, compact, source, bound_judges, profile)) 
+        for src_path, source in chunk], events
+
+def _replay_worker_results(chunk_results, profile):
+    '''
+    Generate the (path, contestants) pairs from _score_files_in_worker 
+    results, recording the workers' TimingEvents with `profile` as each 
+    chunk arrives
+    '''
+    for pairs, events in chunk_results:
+        for event in events:
+            profile.record(event)
+        for pair in pairs:
+            yield pair
+
+# the number of contestants to gather before calculating their final scores 
+# in run_contest; big enough that evaluate_formula can make good use of NumPy
+FORMULA_BATCH_SIZE = 4096
+
+# the number of files run_contest takes from `src_paths` at a time; enough 
+# for judges to prefetch in good-sized batches, but few enough that scoring 
+# starts soon after the first files are found
+SCORING_WINDOW = 256
+
+def run_contest(src_paths, options, formula, recruited_judges, jobs=1, cache=None, compact=False, 
+        on_file=None, collect_results=True, profile=None, builtins=None):
     '''
     Discover contestants inside each of the source files, and 
     record the results of each judge applied to them.  Finally,
@@ -136,31 +684,181 @@ def run_contest(src_paths, options, formula, recruited_judges):
 
     Returns a dictionary mapping source filenames to a list of 
     contestants contained in that file.  The contestants are unordered.
+
+    `src_paths` may be any iterable, such as the generator returned by 
+    quality.cmdline.iter_source_files.  Files are taken from it 
+    SCORING_WINDOW at a time, so scoring starts as soon as the first window 
+    has been found, rather than once the whole tree has been searched.  The 
+    stages for neighbouring windows overlap: while one window is parsed and
+    judged, the next is already being found, looked up in the cache, and 
+    prefetched, which for LintJudge with worker processes means linted in 
+    the background.
+
+    If `jobs` is greater than 1, files are scored by a pool of that many 
+    worker processes; 0 or None means one worker per CPU.  Results are 
+    collected in the order of `src_paths`, so the output doesn't depend on
+    the number of workers.  Each worker judges with its own copy of 
+    `recruited_judges`: state that judges accumulate during a run, such as 
+    CrapJudge.coverage, stays private to the worker that built it and is not 
+    reflected in the caller's judges.
+
+    If provided, `cache` is a quality.cache.ResultCache; files with an entry
+    in the cache aren't scored again, and newly scored files are added to it.
+
+    Before any contestants in a window are judged, and before those in the 
+    window before it, judges with a `prefetch` method are handed the 
+    window's files to be scored (or, with worker processes, each worker's 
+    chunk of it), so that they can process them in batches.
+
+    Each file is read only once: the same SourceFile serves the cache key, 
+    the parser and the judges.
+
+    If provided, `on_file` is called as on_file(src_path, contestants) for 
+    each file, as soon as its contestants have their final scores; files 
+    from the cache come first in each window, then the rest as they're 
+    scored.  If `collect_results` is False, the results aren't kept after 
+    that, and the returned dictionary is empty.
+
+    If `compact` is True, the result lists hold ScoreRecords rather than 
+    Contestants, and each file's AST and line number sets are released as
+    soon as its judging is done.
+
+    If provided, `profile` is a quality.timing.Profile, which records the 
+    time taken by each stage of the run, for each file.  Worker processes 
+    record their own timings, and send them back with their results.
+
+    `builtins` is the dict of builtins available to the formula, as in 
+    evaluate_formula.
     '''
-    results = {}
+    profiling = profile is not None
+    if profile is None:
+        profile = quality.timing.NULL_PROFILE
+    # every path taken from src_paths so far, in order
+    all_paths = []
+    scored_files = {}
+    # files that have been read, but not yet scored
+    sources = SourceCache()
 
-    for src_path in src_paths:
-        try:
-            # parse the source with the ast module
-            src_tree = ast.parse(open(src_path).read(), filename=src_path)
-        except (IndentationError, SyntaxError), exc:
-            warnings.warn('Exception encountered while parsing file %s: %s' % (src_path, exc))
-            continue
-        
-        # add linenums and qualnames to nodes
-        annotate_qualnames(src_tree)
-        annotate_linenums(src_tree)
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
 
-        # build a list of contestants
-        contestants = find_contestants(src_tree, src_path)
+    def report(src_path):
+        'Hand a file with final scores to on_file, and let it go unless results are being collected'
+        if on_file is not None:
+            with profile.timed('report', src_path):
+                on_file(src_path, scored_files[src_path])
+        if not collect_results:
+            del scored_files[src_path]
 
-        for contestant in contestants:
-            contestant.scores = dict((judge._quality_judge_name, judge(contestant, **extract_judge_kwargs(judge._quality_judge_name, options))) for judge in recruited_judges)
-            context = contestant.scores.copy()
-            context['__builtins__'] = __builtins__
-            contestant.final_score = eval(formula, context)
+    cache_keys = {}
+    def take_windows():
+        '''
+        Yield the files that actually need scoring, a window of src_paths at 
+        a time; files in the cache are reported on the way, since they 
+        already have their final scores
+        '''
+        src_iter = iter(src_paths)
+        while True:
+            window = list(itertools.islice(src_iter, SCORING_WINDOW))
+            if not window:
+                return
+            all_paths.extend(window)
+            if cache is None:
+                yield window
+                continue
 
-        results[src_path] = contestants
+            pending = []
+            for src_path in window:
+                with profile.timed('read', src_path):
+                    src_text = sources[src_path].data
+                with profile.timed('cache', src_path):
+                    cache_keys[src_path] = cache.key(src_path, src_text, options, formula, recruited_judges)
+                    contestants = cache.get(cache_keys[src_path])
+                if contestants is None:
+                    pending.append(src_path)
+                else:
+                    scored_files[src_path] = contestants
+                    del sources[src_path]
+                    report(src_path)
+            yield pending
+
+    if jobs == 1:
+        bound_judges = bind_judges(recruited_judges, options)
+        def start_window(pending):
+            for judge in bound_judges:
+                judge.prefetch(pending, profile)
+            return ((src_path, score_file(src_path, options, recruited_judges, compact, sources.pop(src_path, None), 
+                bound_judges, profile)) for src_path in pending)
+    else:
+        pool = multiprocessing.Pool(jobs, _init_worker, (options, recruited_judges, compact, profiling))
+        def start_window(pending):
+            # a handful of chunks per worker balances IPC overhead against 
+            # uneven file sizes; each chunk is prefetched as a batch
+            chunksize = max(1, len(pending) // (jobs * 4))
+            # files already read for the cache travel with their chunk, rather
+            # than being read again by the worker
+            chunks = [[(src_path, sources.pop(src_path, None)) for src_path in pending[i:i + chunksize]] 
+                for i in range(0, len(pending), chunksize)]
+            return _replay_worker_results(pool.imap(_score_files_in_worker, chunks), profile)
+
+    def score_windows():
+        '''
+        Yield (path, contestants) pairs for every file that needs scoring.  
+        Each window is started, i.e. prefetched or handed to the workers, 
+        before the window before it is scored: the next files are found, 
+        read for the cache and linted by judges' worker processes while 
+        this process parses and judges the current ones, and worker 
+        processes scoring files always have the next window queued.
+        '''
+        started = None
+        for pending in take_windows():
+            next_started = start_window(pending)
+            if started is not None:
+                for pair in started:
+                    yield pair
+            started = next_started
+        if started is not None:
+            for pair in started:
+                yield pair
+
+    # final scores are calculated for a batch of files at a time, so that 
+    # on_file hears about files while the run is still going
+    batch = []
+    batch_size = 0
+    def finish_batch():
+        with profile.timed('formula'):
+            evaluate_formula(formula, [contestant for src_path in batch for contestant in scored_files[src_path]], 
+                builtins)
+        for src_path in batch:
+            if cache is not None:
+                with profile.timed('cache', src_path):
+                    cache.put(cache_keys[src_path], scored_files[src_path])
+            report(src_path)
+        del batch[:]
+
+    try:
+        for src_path, contestants in score_windows():
+            if contestants is not None:
+                scored_files[src_path] = contestants
+                batch.append(src_path)
+                batch_size += len(contestants)
+                if batch_size >= FORMULA_BATCH_SIZE:
+                    finish_batch()
+                    batch_size = 0
+    finally:
+        if jobs != 1:
+            pool.terminate()
+            pool.join()
+    finish_batch()
+
+    if cache is not None:
+        with profile.timed('cache'):
+            cache.prune()
+
+    results = {}
+    for src_path in all_paths:
+        if src_path in scored_files:
+            results[src_path] = scored_files[src_path]
 
     return results
 
@@ -8,10 +8,25 @@ import quality.complexity
 
 
 import ast
+import dis
+import hashlib
+import os
 import os.path
+import re
+import sqlite3
+import sys
+import threading
+import tokenize
+import types
 import warnings
 import xml.etree.ElementTree
 
+# the first bytes of every SQLite database, including coverage.py's data file
+SQLITE_HEADER = 'SQLite format 3\x00'
+
+# coverage.py's default rule for excluding lines from coverage
+COVERAGE_EXCLUDE_RE = re.compile(r'#\s*(pragma|PRAGMA)[:\s]?\s*(no|NO)\s*(cover|COVER)')
+
 def gen_class_elems(doc):
     '''
     yield 'class' elements from a coverage.xml document
@@ -76,6 +91,332 @@ def extract_line_nums(doc, source_path, coverage_file):
 
     return hit_lines, missed_lines
 
+def gen_line_records(doc):
+    '''
+    yield (filename, hit_lines, missed_lines) for each 'class' element of a 
+    coverage.xml document that has already been parsed into a tree
+    '''
+    for class_elem in gen_class_elems(doc):
+        hit_lines = set()
+        missed_lines = set()
+        for line_elem in class_elem[1]:
+            (hit_lines if line_elem.get('hits') == '1' else missed_lines).add(int(line_elem.get('number')))
+        yield class_elem.get('filename'), hit_lines, missed_lines
+
+def iterparse_line_records(coverage_file):
+    '''
+    yield (filename, hit_lines, missed_lines) for each 'class' element of a 
+    coverage.xml document, without building the whole tree in memory.
+
+    Elements are discarded as soon as the parser finishes with them, so memory
+    use stays proportional to the largest single <class> element, no matter
+    how large the document is.
+
+    * `coverage_file` - path to, or file object representing, the coverage.xml document
+    '''
+    # the parser attaches each element to its parent; we track the open 
+    # elements ourselves so finished ones can be detached from their parents
+    stack = []
+    hit_lines = missed_lines = None
+    for event, elem in xml.etree.ElementTree.iterparse(coverage_file, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == 'class':
+                hit_lines = set()
+                missed_lines = set()
+            continue
+
+        stack.pop()
+        if elem.tag == 'line' and len(stack) > 1 and stack[-1].tag == 'lines' and stack[-2].tag == 'class':
+            (hit_lines if elem.get('hits') == '1' else missed_lines).add(int(elem.get('number')))
+        elif elem.tag == 'class':
+            yield elem.get('filename'), hit_lines, missed_lines
+
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
+class CoverageIndex(dict):
+    '''
+    Coverage data from a coverage.xml document, indexed by source file.
+
+    This is a dict mapping absolute source paths to pairs of line number sets,
+    (hit_lines, missed_lines).  The document is walked exactly once, when the
+    index is built, and each 'filename' attribute is normalized only once, so
+    looking up a source file afterwards is a single dict access, rather than 
+    the linear scan performed by find_class_elem.
+
+    Paths are aligned the same way find_class_elem aligns them: relative
+    'filename' attributes are assumed to be relative to the directory 
+    containing coverage.xml.
+    '''
+    def __init__(self, records, coverage_file, source_paths=None):
+        '''
+        Args:
+        * `records` - iterable of (filename, hit_lines, missed_lines), as 
+          produced by gen_line_records or iterparse_line_records
+        * `coverage_file` - path to, or file object representing, the coverage.xml document
+        * `source_paths` - if provided, only keep data for these source files
+        '''
+        super(CoverageIndex, self).__init__()
+        # ensure coverage_file is a path
+        if isinstance(coverage_file, file):
+            coverage_file = coverage_file.name
+        coverage_dir = os.path.dirname(coverage_file)
+        wanted = None if source_paths is None else frozenset(os.path.abspath(i) for i in source_paths)
+
+        for filename, hit_lines, missed_lines in records:
+            abs_path = os.path.abspath(os.path.join(coverage_dir, filename))
+            if abs_path in self or (wanted is not None and abs_path not in wanted):
+                # find_class_elem stops at the first matching element; do the same
+                continue
+            self[abs_path] = (hit_lines, missed_lines)
+
+    def line_nums(self, source_path, source=None):
+        '''
+        Return the sets of "hit" and "missed" line numbers for `source_path`.
+
+        This mirrors extract_line_nums, including its fallback for source 
+        files that don't appear in coverage.xml.  If given, `source` is the
+        quality.core.SourceFile for `source_path`, which spares the fallback
+        from reading the file again.
+        '''
+        try:
+            return self[os.path.abspath(source_path)]
+        except KeyError:
+            return assume_uncovered(source_path, source)
+
+def assume_uncovered(source_path, source=None):
+    '''
+    The fallback for source files missing from the coverage data: warn, and 
+    return the sets of "hit" and "missed" line numbers, treating every line 
+    as a missed statement.  This is ok, because the lines only get 
+    intersected with the ast version anyway.
+    '''
+    warnings.warn('Could not find coverage data for source file: %s; proceeding under the assumption that this code is uncovered'
+        % source_path)
+    if source is not None:
+        return frozenset(), frozenset(range(len(source.lines)))
+    return frozenset(), frozenset(range(sum(1 for l in open(source_path))))
+
+def is_sqlite_file(coverage_file):
+    '''
+    Return True if `coverage_file`, a path or file object, is an SQLite 
+    database, like the .coverage data file written by coverage.py 5 and 
+    later, rather than coverage.xml.  A file that can't be read isn't one.
+    '''
+    if isinstance(coverage_file, file):
+        position = coverage_file.tell()
+        header = coverage_file.read(len(SQLITE_HEADER))
+        coverage_file.seek(position)
+    else:
+        try:
+            with open(coverage_file, 'rb') as fobj:
+                header = fobj.read(len(SQLITE_HEADER))
+        except IOError:
+            return False
+    return header == SQLITE_HEADER
+
+def numbits_to_lines(numbits):
+    '''
+    Return a list of the line numbers in a "numbits" blob from coverage.py's
+    data file, in which bit i of byte j is set if line j * 8 + i was executed.
+    '''
+    lines = []
+    for byte_num, byte in enumerate(bytearray(numbits)):
+        if byte:
+            for bit in range(8):
+                if byte & (1 << bit):
+                    lines.append(byte_num * 8 + bit)
+    return lines
+
+def code_line_starts(code):
+    'Yield the line numbers where bytecode begins, in `code` and every code object nested in it'
+    codes = [code]
+    while codes:
+        code = codes.pop()
+        codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+        for offset, line_num in dis.findlinestarts(code):
+            yield line_num
+
+def statement_lines(tree, lines, filename='<unknown>'):
+    '''
+    Find the statements in a module the way coverage.py does, for reporting 
+    coverage.xml, and return them as a pair:
+    * the set of line numbers where statements begin
+    * a dict mapping each line of a multi-line statement to its first line,
+        for translating executed lines into statements
+
+    Statements are the lines where bytecode begins, in the code compiled 
+    from the AST `tree`, less docstrings, which are strings first on an 
+    indented line, or first in the module, and less lines excluded by 
+    coverage.py's default "pragma: no cover" rule, along with any block 
+    they begin.  `lines` is the list of lines of the source, which is 
+    tokenized to find them, and multi-line statements.  Exclusion rules 
+    from coverage.py's configuration aren't known here.
+    '''
+    if lines and not lines[-1].endswith('\n'):
+        # as for coverage.py, or the last statement has no NEWLINE token
+        lines = lines[:-1] + [lines[-1] + '\n']
+    excluded = set(line_num for line_num, line in enumerate(lines, 1) if COVERAGE_EXCLUDE_RE.search(line))
+    first_lines = {}
+    docstrings = set()
+    indent = exclude_indent = 0
+    excluding = excluding_decorators = False
+    empty = True
+    first_on_line = True
+    first_line = None
+    prev_type = tokenize.INDENT
+    for tok_type, text, (start_row, _), (end_row, _), _ in tokenize.generate_tokens(iter(lines).next):
+        if tok_type == tokenize.INDENT:
+            indent += 1
+        elif tok_type == tokenize.DEDENT:
+            indent -= 1
+        elif tok_type == tokenize.OP and text == ':':
+            if not excluding and (end_row in excluded or excluding_decorators):
+                # exclude the block begun by an excluded line
+                excluded.add(end_row)
+                exclude_indent = indent
+                excluding = True
+                excluding_decorators = False
+        elif tok_type == tokenize.OP and text == '@' and first_on_line:
+            # decorators of an excluded function are excluded too
+            excluding_decorators = excluding_decorators or end_row in excluded
+            if excluding_decorators:
+                excluded.add(end_row)
+        elif tok_type == tokenize.STRING and prev_type == tokenize.INDENT:
+            docstrings.update(range(start_row, end_row + 1))
+        elif tok_type == tokenize.NEWLINE:
+            if first_line is not None and end_row != first_line:
+                for line_num in range(first_line, end_row + 1):
+                    first_lines[line_num] = first_line
+            first_line = None
+            first_on_line = True
+
+        if text.strip() and tok_type != tokenize.COMMENT:
+            empty = False
+            if first_line is None:
+                first_line = start_row
+                if excluding and indent <= exclude_indent:
+                    excluding = False
+                if excluding:
+                    excluded.add(end_row)
+                first_on_line = False
+        prev_type = tok_type
+
+    if empty:
+        return set(), first_lines
+    ignored = set(first_lines.get(line_num, line_num) for line_num in excluded) | docstrings
+    starts = set(code_line_starts(compile(tree, filename, 'exec', 0, True))) - ignored
+    return set(first_lines.get(line_num, line_num) for line_num in starts) - ignored, first_lines
+
+class SqliteCoverageIndex(object):
+    '''
+    Coverage data read straight from the SQLite data file written by 
+    coverage.py 5 and later, usually named .coverage, so that there's no 
+    need to run `coverage xml` first.
+
+    The data file only records which lines were executed.  The statements 
+    that could have been are found with statement_lines, the same way 
+    coverage.py finds them when it writes coverage.xml; a file's hit lines 
+    are the statements with any line executed, and its missed lines are the 
+    rest.
+
+    The table of measured files is read when the index is built, but line 
+    data is only queried for each file as it's looked up.  Relative paths 
+    are aligned as for coverage.xml: they're assumed to be relative to the 
+    directory containing the data file.
+
+    Lookups may come from several threads, and from processes forked after 
+    the index was built; each process opens its own connection.
+
+    Attributes:
+    * coverage_file - path to the data file
+    * file_ids - dict mapping absolute source paths to ids in the `file` table
+    * has_arcs - True if the data file records arcs (branch coverage), rather
+        than lines
+    '''
+    def __init__(self, coverage_file):
+        '''
+        Args:
+        * `coverage_file` - path to, or file object representing, the data file
+
+        Raises ValueError if `coverage_file` isn't a coverage.py data file.
+        '''
+        if isinstance(coverage_file, file):
+            coverage_file = coverage_file.name
+        self.coverage_file = coverage_file
+        self._lock = threading.Lock()
+        self._connection = None
+        try:
+            meta = dict(self.query('SELECT key, value FROM meta'))
+            files = self.query('SELECT id, path FROM file')
+        except sqlite3.DatabaseError, exc:
+            raise ValueError('%s is not a coverage.py data file: %s' % (coverage_file, exc))
+        self.has_arcs = meta.get('has_arcs') in ('1', 'True', 'true')
+
+        coverage_dir = os.path.dirname(coverage_file)
+        encoding = sys.getfilesystemencoding() or 'utf-8'
+        self.file_ids = {}
+        for file_id, path in files:
+            abs_path = os.path.abspath(os.path.join(coverage_dir, path.encode(encoding)))
+            self.file_ids.setdefault(abs_path, file_id)
+
+    def query(self, sql, args=()):
+        'Run a query against the data file, and return all the rows'
+        with self._lock:
+            if self._connection is None or self._connection[0] != os.getpid():
+                # a connection can't be shared with a forked process
+                self._connection = (os.getpid(), sqlite3.connect(self.coverage_file, check_same_thread=False))
+            return self._connection[1].execute(sql, args).fetchall()
+
+    def executed_lines(self, file_id):
+        'Return the set of lines executed in the file with id `file_id`, in any context'
+        if self.has_arcs:
+            # arcs run between lines, or from or to negative numbers for entry and exit
+            return set(line for arc in self.query('SELECT fromno, tono FROM arc WHERE file_id = ?', (file_id,))
+                for line in arc if line > 0)
+        executed = set()
+        for numbits, in self.query('SELECT numbits FROM line_bits WHERE file_id = ?', (file_id,)):
+            executed.update(numbits_to_lines(numbits))
+        return executed
+
+    def line_nums(self, source_path, source=None):
+        '''
+        Return the sets of "hit" and "missed" line numbers for `source_path`,
+        as CoverageIndex.line_nums does.  If given, `source` is the 
+        quality.core.SourceFile for `source_path`, whose AST is used to find 
+        the statements, rather than parsing the file again.
+        '''
+        file_id = self.file_ids.get(os.path.abspath(source_path))
+        if file_id is None:
+            return assume_uncovered(source_path, source)
+        executed = self.executed_lines(file_id)
+        try:
+            if source is not None:
+                tree, lines = source.tree, source.lines
+            else:
+                with open(source_path) as fobj:
+                    data = fobj.read()
+                tree, lines = ast.parse(data, source_path), data.splitlines(True)
+            statements, first_lines = statement_lines(tree, lines, source_path)
+        except (SyntaxError, tokenize.TokenError):
+            # without statements, no lines can be known to be missed
+            return executed, frozenset()
+        # the data file has every line executed, not just where statements begin
+        hit = set(first_lines.get(line_num, line_num) for line_num in executed) & statements
+        return hit, statements - hit
+
+def load_coverage_index(coverage_file):
+    '''
+    Return an index of the coverage data in `coverage_file`, a path or file 
+    object: a SqliteCoverageIndex if it's coverage.py's SQLite data file, or
+    a CoverageIndex if it's coverage.xml.
+    '''
+    if is_sqlite_file(coverage_file):
+        return SqliteCoverageIndex(coverage_file)
+    return CoverageIndex(iterparse_line_records(coverage_file), coverage_file)
+
 class CrapJudge(object):
     '''
     Calculates C.R.A.P. scores for Contestants.
@@ -98,12 +439,18 @@ class CrapJudge(object):
 
     * coverage - dict mapping filenames to sets of line numbers, (hit_lines, missed_lines)
     * unified - dict mapping filenames to sets of all line numbers in coverage.xml: hit_lines | missed_lines
+    * index - CoverageIndex built from coverage.xml, or SqliteCoverageIndex 
+        for coverage.py's data file, or None until first needed
     '''
     _quality_judge_name = 'crap'
+    _quality_judge_version = 1
 
     def __init__(self):
         self.coverage = {}
         self.unified = {} # todo: turn this into a property that dynamically combines the hit and miss sets on the fly
+        self.index = None
+        # (LineIndex, buckets) for the file most recently judged
+        self._last_buckets = None
         
     def coverage_ratio(self, contestant):
         '''
@@ -112,13 +459,38 @@ class CrapJudge(object):
 
         Returns a float.
         '''
-        fixed_lines = self.align_linenums(contestant)
+        if contestant.line_index is None:
+            fixed_lines = self.align_linenums(contestant)
+            total = len(fixed_lines)
+            covered = len(fixed_lines & self.coverage[contestant.src_file][0])
+        else:
+            hits = self.line_hits(contestant)
+            total = len(hits)
+            covered = sum(hits)
 
-        if len(fixed_lines) == 0:
+        if total == 0:
             # if a def has no lines, we'll call it 100% covered.
             return 1.0
 
-        return float(len(fixed_lines & self.coverage[contestant.src_file][0])) / len(fixed_lines)
+        return float(covered) / total
+
+    def line_hits(self, contestant):
+        '''
+        Return a list with one bool for each line of `contestant` that appears
+        in coverage.xml, telling whether that line was hit.
+
+        This matches align_linenums, but sorts the lines from coverage.xml by 
+        Contestant in a single pass over the file's LineIndex, which is 
+        shared by all the Contestants in the file.
+        '''
+        line_index = contestant.line_index
+        last_buckets = self._last_buckets
+        if last_buckets is None or last_buckets[0] is not line_index:
+            hit = self.coverage[contestant.src_file][0]
+            findings = ((line, line in hit) for line in self.unified[contestant.src_file])
+            last_buckets = (line_index, line_index.bucket(findings))
+            self._last_buckets = last_buckets
+        return last_buckets[1].get(contestant, [])
 
     def align_linenums(self, contestant):
         '''
@@ -137,6 +509,61 @@ class CrapJudge(object):
         '''
         return contestant.linenums & self.unified[contestant.src_file]
 
+    def load_coverage(self, src_file, coverage_file, source=None):
+        '''
+        Cache the hit and missed lines for `src_file`, if we haven't already.
+
+        Arguments:
+        * `src_file` - path to the python module being scored
+        * `coverage_file` - path to, or file object representing, the coverage.xml document,
+            or coverage.py's SQLite data file
+        * `source` - quality.core.SourceFile for `src_file`, if one is at hand
+        '''
+        if src_file in self.coverage:
+            return
+        if self.index is None:
+            # coverage.xml only gets parsed once per run
+            self.index = load_coverage_index(coverage_file)
+        hit, miss = self.index.line_nums(src_file, source)
+        self.coverage[src_file] = (hit, miss)
+        self.unified[src_file] = hit | miss
+
+    def forget(self, src_file=None):
+        '''
+        Drop the coverage data kept for `src_file`, so that it's looked up 
+        again the next time it's needed.  If `src_file` is None, drop it for
+        every file, along with the index, so that coverage.xml is read again.
+        '''
+        if src_file is None:
+            self.coverage.clear()
+            self.unified.clear()
+            self.index = None
+        else:
+            self.coverage.pop(src_file, None)
+            self.unified.pop(src_file, None)
+        self._last_buckets = None
+
+    def cache_key(self, src_file, coverage_file=None):
+        '''
+        Return the parts of coverage.xml that can influence the scores of 
+        contestants in `src_file`: its hit and missed lines.
+        '''
+        self.load_coverage(src_file, coverage_file)
+        hit, miss = self.coverage[src_file]
+        return sorted(hit), sorted(miss)
+
+    def run_key(self, coverage_file=None):
+        '''
+        Return the SHA-1 of the coverage data at the path `coverage_file`, 
+        which can influence the scores of any file; unlike cache_key, it 
+        takes one read of the data, however many files are scored.
+        '''
+        digest = hashlib.sha1()
+        with open(coverage_file, 'rb') as fobj:
+            for chunk in iter(lambda: fobj.read(1 << 16), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
     def __call__(self, contestant, coverage_file=None):
         '''
         Return the C.R.A.P. score for a Contestant.
@@ -145,14 +572,27 @@ class CrapJudge(object):
         * `contestant` - a Contestant
         * `coverage_file` - path to, or file object representing, the coverage.xml document
         '''
-        complexity = quality.complexity.complexity(contestant.node)
+        # we might not yet have cached coverage info for this module
+        self.load_coverage(contestant.src_file, coverage_file, contestant.source)
+        return self.crap(contestant)
+
+    def judge_file(self, contestants, coverage_file=None):
+        '''
+        Return a list of the C.R.A.P. scores for `contestants`, which all come 
+        from the same source file.  Coverage data for the file is only looked
+        up once.
+        '''
+        if contestants:
+            self.load_coverage(contestants[0].src_file, coverage_file, contestants[0].source)
+        return [self.crap(contestant) for contestant in contestants]
+
+    def crap(self, contestant):
+        'Calculate the C.R.A.P. score for a Contestant, once its coverage data is loaded'
+        # use the complexity computed by quality.core.annotate, if it's there
+        complexity = getattr(contestant.node, 'complexity', None)
+        if complexity is None:
+            complexity = quality.complexity.complexity(contestant.node)
         
-        if contestant.src_file not in self.coverage:
-            # we haven't yet cached coverage info for this module; do so now
-            coverage_doc = xml.etree.ElementTree.parse(coverage_file)
-            hit, miss = extract_line_nums(coverage_doc, contestant.src_file, coverage_file)
-            self.coverage[contestant.src_file] = (hit, miss)
-            self.unified[contestant.src_file] = hit | miss
         cov_ratio = self.coverage_ratio(contestant)
 
         return (complexity ** 2) * (1 - cov_ratio) + complexity
@@ -5,7 +5,7 @@ from __future__ import absolute_import
 import collections
 import StringIO
 import sys
-import types
+import threading
 
 class PatchContext(object):
     'A context manager that swaps out one object on entry, and restores the original on exit.'
@@ -22,62 +22,106 @@ class PatchContext(object):
     def __exit__(self, exc_type, exc_val, tb):
         setattr(self.obj, self.attr_name, self.orig)
 
+class ThreadLocalStream(object):
+    '''
+    A stand-in for a stream like sys.stdout, which sends output to a 
+    per-thread target when the current thread has redirected it, and to the
+    original stream otherwise.  This lets several threads capture their own 
+    output at once, where swapping out sys.stdout itself would have them 
+    stealing each other's output.
+
+    All attribute access, including writes like the `softspace` attribute 
+    managed by the print statement, is forwarded to the current target.
+    '''
+    def __init__(self, orig):
+        object.__setattr__(self, '_orig', orig)
+        object.__setattr__(self, '_local', threading.local())
+
+    def redirect(self, target):
+        '''
+        Send output from the current thread to `target`, or back to the 
+        original stream if `target` is None.  Returns the previous target, 
+        so that redirects can be nested.
+        '''
+        prev = getattr(self._local, 'target', None)
+        self._local.target = target
+        return prev
+
+    def current(self):
+        'Return the stream that output from the current thread goes to'
+        target = getattr(self._local, 'target', None)
+        return self._orig if target is None else target
+
+    def __getattr__(self, attrname):
+        return getattr(self.current(), attrname)
+
+    def __setattr__(self, attrname, value):
+        setattr(self.current(), attrname, value)
+
+class RedirectContext(object):
+    '''
+    A context manager that sends output written to a stream in the `sys` 
+    module, from the current thread only, to another file-like object.
+
+    While any RedirectContext is active for a stream, that stream is replaced 
+    by a ThreadLocalStream; the original is restored when the last one exits.
+    '''
+    _lock = threading.Lock()
+    # maps stream names to (ThreadLocalStream, number of active redirects)
+    _installed = {}
+
+    def __init__(self, stream_name, target):
+        '''
+        Args:
+        * `stream_name` - name of the stream in `sys`, e.g. 'stdout'
+        * `target` - file-like object to receive the output
+        '''
+        self.stream_name = stream_name
+        self.target = target
+
+    def __enter__(self):
+        with self._lock:
+            stream, count = self._installed.get(self.stream_name, (None, 0))
+            if stream is None or getattr(sys, self.stream_name) is not stream:
+                # someone else may have replaced the stream since we installed 
+                # ours; wrap whatever is there now
+                stream = ThreadLocalStream(getattr(sys, self.stream_name))
+                setattr(sys, self.stream_name, stream)
+            self._installed[self.stream_name] = (stream, count + 1)
+        self.stream = stream
+        self.prev = stream.redirect(self.target)
+        return self
+
+    def __exit__(self, exc_type, exc_val, tb):
+        self.stream.redirect(self.prev)
+        with self._lock:
+            stream, count = self._installed[self.stream_name]
+            if count > 1:
+                self._installed[self.stream_name] = (stream, count - 1)
+                return
+            del self._installed[self.stream_name]
+            if getattr(sys, self.stream_name) is stream:
+                setattr(sys, self.stream_name, stream._orig)
+
 def capture_output(fn):
     '''
     Enter a context-managed capture of stdout, and then dispatch to the 
     original function.
 
+    Only output from the calling thread is captured, so wrapped functions may 
+    run concurrently in several threads.
+
     Meant to be used as a decorator for default_factory functions for
     OutputCollectingJudge.
     '''
     def wrapped(*args, **kwargs):
         output_buffer = StringIO.StringIO()
-        with PatchContext(sys, 'stdout', output_buffer):
+        with RedirectContext('stdout', output_buffer):
             fn(*args, **kwargs)
         output_buffer.seek(0)
         return output_buffer
     return wrapped
 
-class FilteredFileProxy(object):
-    '''
-    A proxy for a file-like object that hooks into the write methods to 
-    exclude certain strings.
-
-    This is a brittle solution, because we're counting on the search string
-    being written in a single call, e.g. when searching for "Can't touch this",
-    we would miss a call to obj.writelines(["Can't ", "touch ", "this"]).
-
-    Note that one can't patch only these methods on true file-like objects,
-    since those are built-ins, and thus their attributes are read-only.
-    '''
-    def __init__(self, orig, search):
-        '''
-        Args:
-        * `orig` - the original file object being proxied
-        * `search` - the string to filter out from write calls
-        '''
-        self._orig = orig
-        self._search = search
-        def filtered_write(self, output):
-            if output.endswith('\n'):
-                output = output[:-1]
-            if output == self._search:
-                return
-            orig.write(output)
-        def filtered_writelines(self, seq):
-            orig.writelines(output for output in seq if output != self._search
-                and not (output.endswith('\n') and output[:-1] == self._search))
-        self._filters = {
-            'write': types.MethodType(filtered_write, self),
-            'writelines': types.MethodType(filtered_writelines, self),
-        }
-
-    def __getattr__(self, attrname):
-        if attrname in self._filters:
-            return self._filters[attrname]
-        return getattr(self._orig, attrname)
-
-
 class OutputCollectingJudge(collections.defaultdict):
     '''
     Combines two concepts for judging programs that write to stdout.
@@ -107,6 +151,18 @@ class OutputCollectingJudge(collections.defaultdict):
         self[key] = self.default_factory(key) # todo: figure out why this doesn't infinitely recurse
         return self[key]
 
+    def forget(self, src_path=None):
+        '''
+        Drop the output collected for `src_path`, or for every file if it's 
+        None, so that it's collected again the next time it's needed.  Any 
+        memo of the file judged last, in `_last_buckets`, is dropped too.
+        '''
+        if src_path is None:
+            self.clear()
+        else:
+            self.pop(src_path, None)
+        self._last_buckets = None
+
     def __call__(self, contestant):
         'Override this in child classes to interpret the data in the dict and return a score'
         raise NotImplementedError
\ No newline at end of file
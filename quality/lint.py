@@ -4,11 +4,18 @@ from __future__ import absolute_import
 
 import quality.liason
 
+import astroid
+import collections
+import hashlib
+import multiprocessing
+import pylint.__pkginfo__
+import pylint.config
 import pylint.lint
-from pylint.reporters.text import ParseableTextReporter
-import re
-import StringIO
+import pylint.reporters
+import os.path
 import sys
+import time
+import timeit
 import traceback
 import warnings
 
@@ -20,49 +27,363 @@ SCORE_MAP = {
     'F': 0, # fatal errors that stopped pylint processing - not necessarily a bug in source?
 }
 
-MESSAGE_REGEX = re.compile(r'^[^:]+:([\d]+): \[([\w]).*$')
+# checks that compare modules with each other; linting files one at a time 
+# never triggers them, so they are disabled for batches as well
+CROSS_MODULE_CHECKS = ['duplicate-code', 'cyclic-import']
+
+# the most files handed to a pylint worker process at a time
+WORKER_BATCH_SIZE = 16
+
+# the number of files a pylint worker process lints before it's replaced, to 
+# keep the growth of astroid's module cache in check
+WORKER_RECYCLE_AFTER = 200
+
+# seconds to wait for a pylint worker process to return a batch; a worker 
+# that dies, e.g. when it runs out of memory, takes its batch with it, and 
+# the pool never reports the loss, so waiting forever would hang the run
+WORKER_TIMEOUT = 300
+
+def rcfile_key():
+    '''
+    Return the path to the pylintrc that pylint uses, which it finds when 
+    it's imported, and the SHA-1 of its contents; or (None, None) if pylint
+    found none.
+    '''
+    path = pylint.config.PYLINTRC
+    if path is None:
+        return None, None
+    path = os.path.abspath(path)
+    try:
+        with open(path, 'rb') as fobj:
+            return path, hashlib.sha1(fobj.read()).hexdigest()
+    except IOError:
+        return path, None
+
+class MessageCollector(pylint.reporters.BaseReporter):
+    '''
+    A pylint reporter that keeps messages as data, rather than rendering them
+    as text for us to parse back again.
+
+    It also times each module, from when pylint starts on it to when it 
+    starts on the next, or finishes.
+
+    Attributes:
+    * messages - dict mapping the absolute path of each linted module to a list
+        of (line number, message category) pairs, in the order reported
+    * times - dict mapping the absolute path of each linted module to the 
+        (wall, cpu) seconds pylint spent on it
+    '''
+    name = 'quality'
+
+    def __init__(self):
+        super(MessageCollector, self).__init__()
+        self.messages = collections.defaultdict(list)
+        self.times = {}
+        self._current = None
+
+    def handle_message(self, msg):
+        self.messages[msg.abspath].append((msg.line, msg.C))
+
+    def on_set_current_module(self, module, filepath):
+        # modules are also named without a path while pylint looks for them, 
+        # before any of them are checked
+        if filepath is not None:
+            self._stop_timing()
+            self._current = (os.path.abspath(filepath), timeit.default_timer(), time.clock())
+
+    def on_close(self, stats, previous_stats):
+        self._stop_timing()
+
+    def _stop_timing(self):
+        'Record the time spent on the current module, if any'
+        if self._current is not None:
+            path, wall, cpu = self._current
+            self.times[path] = (timeit.default_timer() - wall, time.clock() - cpu)
+            self._current = None
+
+    def _display(self, layout):
+        'Reports are disabled; there is nothing to display'
+        pass
+
+class QuietLinter(pylint.lint.PyLinter):
+    '''
+    A PyLinter that doesn't announce which configuration file it's using.
+
+    Otherwise, pylint repeatedly tells us about its lack of a configuration
+    file, on stderr, once per run.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(QuietLinter, self).__init__(*args, **kwargs)
+        self.quiet = 1
+
+class QuietRun(pylint.lint.Run):
+    'pylint.lint.Run, using a QuietLinter'
+    LinterClass = QuietLinter
 
 def run_pylint(src_file):
     '''
     Dispatch to pylint, once per module
-    
-    We need to fiddle with stderr because pylint insists on repeatedly telling
-    us about its lack of a configuration file.  We don't want to suppress all 
-    of stderr, so we instead selectively target offending messages.
+
+    Returns a list of (line number, message category) pairs.
     '''
-    buf = StringIO.StringIO()
+    collector = MessageCollector()
     try:
-        with quality.liason.PatchContext(sys, 'stderr', quality.liason.FilteredFileProxy(sys.stderr, 'No config file found, using default configuration')):
-            pylint.lint.Run(['-r', 'n', src_file], reporter=ParseableTextReporter(output=buf), exit=False)
+        QuietRun(['-r', 'n', src_file], reporter=collector, exit=False)
     except Exception:
         warnings.warn('pylint encountered a fatal error attempting to process the file: %s\n%s' % (src_file, traceback.format_exc()))
 
-    buf.seek(0)
-    return buf
+    return collector.messages[os.path.abspath(src_file)]
+
+def forget_modules(src_files):
+    '''
+    Drop astroid's cached trees for `src_files`.  astroid keeps every module 
+    it parses for the life of the process, and doesn't notice when one 
+    changes, so without this, linting a file again in the same process would
+    report on its old contents.
+    '''
+    src_files = set(os.path.abspath(src_file) for src_file in src_files)
+    cache = astroid.MANAGER.astroid_cache
+    for modname, module in cache.items():
+        if module.file is not None and os.path.abspath(module.file) in src_files:
+            del cache[modname]
+
+def run_pylint_batch(src_files, times=None):
+    '''
+    Dispatch to pylint once for a whole batch of modules, and split its 
+    output up by module.  This shares pylint's start-up cost, and astroid's 
+    inference cache, across the batch.
+
+    Returns a dict mapping each of `src_files` to its messages, in the same 
+    format returned by run_pylint.  If pylint fails on the batch, each module 
+    is linted on its own instead, so that one bad module doesn't cost the 
+    whole batch its results.
+
+    If `times` is given, it's a dict to store the (wall, cpu) seconds spent 
+    on each of `src_files` in; pylint's start-up isn't counted against any 
+    of them.
+    '''
+    forget_modules(src_files)
+    collector = MessageCollector()
+    try:
+        QuietRun(['-r', 'n', '--disable=%s' % ','.join(CROSS_MODULE_CHECKS)] + list(src_files), 
+            reporter=collector, exit=False)
+    except Exception:
+        messages = {}
+        for src_file in src_files:
+            wall, cpu = timeit.default_timer(), time.clock()
+            messages[src_file] = run_pylint(src_file)
+            if times is not None:
+                times[src_file] = (timeit.default_timer() - wall, time.clock() - cpu)
+        return messages
+
+    if times is not None:
+        for src_file in src_files:
+            if os.path.abspath(src_file) in collector.times:
+                times[src_file] = collector.times[os.path.abspath(src_file)]
+    return dict((src_file, collector.messages[os.path.abspath(src_file)]) for src_file in src_files)
     
+def _lint_in_worker(src_files):
+    '''
+    run_pylint_batch, as invoked inside a pylint worker process; returns its
+    messages, and the times spent on each file
+    '''
+    times = {}
+    return run_pylint_batch(src_files, times), times
+
 class LintJudge(quality.liason.OutputCollectingJudge):
-    def __init__(self):
+    '''
+    Scores Contestants by the pylint messages on their lines.
+
+    Options, which only affect how pylint is run, not the scores:
+    * jobs - the number of pylint worker processes that prefetch uses; 0 
+        means one per CPU, and 1 means linting in this process
+    * recycle_after - the number of files each worker lints before it's 
+        replaced
+    * timeout - seconds to wait for a worker to lint a batch of files, 
+        WORKER_TIMEOUT by default, or None to wait forever; files a worker 
+        doesn't finish in time are linted in this process instead
+
+    Worker processes are kept for the life of the judge, or until close() is 
+    called, so pylint stays imported, and astroid's cache of parsed modules
+    stays warm from one file to the next.  Their messages are collected as
+    they're needed, so run_contest can parse and judge files in this 
+    process while the workers lint the files to come.
+
+    Attributes:
+    * batch_size - the most modules that prefetch hands to a single pylint 
+        run; None means no limit when linting in this process, or 
+        WORKER_BATCH_SIZE with worker processes
+    * pool - multiprocessing.Pool of pylint workers, or None
+    * pending - list of (result iterator, set of files not yet returned, 
+        timeout) for each prefetch handed to the workers and not yet collected
+    * file_times - dict mapping files linted in batches to the (wall, cpu) 
+        seconds pylint spent on each, in whichever process linted it, until
+        they're taken by pop_file_times
+    '''
+    _quality_judge_version = 1
+
+    def __init__(self, batch_size=None):
         super(LintJudge, self).__init__('lint', run_pylint)
+        self.batch_size = batch_size
+        self.pool = None
+        self.pool_args = None
+        self.pending = []
+        self.file_times = {}
+
+    def prefetch(self, src_files, jobs=1, recycle_after=WORKER_RECYCLE_AFTER, timeout=WORKER_TIMEOUT):
+        '''
+        Lint all of `src_files` that haven't been linted yet, in as few pylint
+        runs as `batch_size` allows, spread over `jobs` processes.  Any other 
+        files still get linted one at a time, when first needed.
+
+        With worker processes, this returns as soon as the files have been 
+        handed out, so that the caller can get on with other work while 
+        they're linted; see collect.
+        '''
+        src_files = [src_file for src_file in src_files if src_file not in self and not self.is_pending(src_file)]
+        if not jobs:
+            jobs = multiprocessing.cpu_count()
+        if jobs == 1:
+            batch_size = self.batch_size or len(src_files)
+            for i in range(0, len(src_files), batch_size or 1):
+                self.update(run_pylint_batch(src_files[i:i + batch_size], self.file_times))
+            return
+        if not src_files:
+            return
+
+        # spread small runs evenly over the workers
+        batch_size = self.batch_size or max(1, min(WORKER_BATCH_SIZE, -(-len(src_files) // jobs)))
+        batches = [src_files[i:i + batch_size] for i in range(0, len(src_files), batch_size)]
+        results = self.worker_pool(jobs, recycle_after).imap_unordered(_lint_in_worker, batches)
+        self.pending.append((results, set(src_files), timeout))
+
+    def is_pending(self, src_file):
+        'Return True if `src_file` is being linted by a worker process, and its messages aren\'t in yet'
+        return any(src_file in remaining for results, remaining, timeout in self.pending)
+
+    def collect(self, src_file=None):
+        '''
+        Store the messages from pylint worker processes as their batches come 
+        back, until those for `src_file` are in, or those for every file 
+        handed to the workers if `src_file` is None.
+
+        If a batch takes longer than the `timeout` given to prefetch, the 
+        workers are shut down, and every file they haven't finished is linted
+        in this process instead.
+        '''
+        for entry in list(self.pending):
+            results, remaining, timeout = entry
+            if src_file is not None and src_file not in remaining:
+                continue
+            try:
+                while remaining and (src_file is None or src_file in remaining):
+                    messages, times = results.next(timeout)
+                    self.update(messages)
+                    self.file_times.update(times)
+                    remaining.difference_update(messages)
+            except multiprocessing.TimeoutError:
+                warnings.warn('Timed out waiting for pylint worker processes; linting the remaining files in this process')
+                unfinished = [i for results, remaining, timeout in self.pending for i in sorted(remaining)]
+                self.close()
+                self.prefetch(unfinished)
+                return
+            except StopIteration:
+                # every batch is back; anything missing is linted when needed
+                remaining.clear()
+            if not remaining:
+                self.pending.remove(entry)
+
+    def pop_file_times(self):
+        '''
+        Return a list of (file, wall, cpu) for the files linted in batches 
+        since the last call, with the seconds pylint spent on each.  With 
+        worker processes, the times only arrive once the files' messages are
+        collected.
+        '''
+        file_times = [(src_file, wall, cpu) for src_file, (wall, cpu) in sorted(self.file_times.iteritems())]
+        self.file_times.clear()
+        return file_times
+
+    def __missing__(self, src_file):
+        'Wait for `src_file` if it\'s being linted by a worker process, otherwise lint it here'
+        if self.is_pending(src_file):
+            self.collect(src_file)
+            if src_file in self:
+                return self[src_file]
+        return super(LintJudge, self).__missing__(src_file)
+
+    def forget(self, src_path=None):
+        '''
+        As OutputCollectingJudge.forget; messages still on their way from 
+        worker processes are collected first, so that they can't replace the
+        file's new messages later.
+        '''
+        self.collect()
+        super(LintJudge, self).forget(src_path)
+
+    def worker_pool(self, jobs, recycle_after):
+        '''
+        Return a pool of `jobs` pylint worker processes, each replaced after 
+        linting about `recycle_after` files; the pool is reused by later calls
+        with the same arguments.  Workers aren't replaced before Python 2.7, 
+        which lacks Pool's `maxtasksperchild`.
+        '''
+        if self.pool is not None and self.pool_args != (jobs, recycle_after):
+            self.close()
+        if self.pool is None:
+            if sys.version_info >= (2, 7):
+                tasks_per_worker = max(1, recycle_after // (self.batch_size or WORKER_BATCH_SIZE))
+                self.pool = multiprocessing.Pool(jobs, maxtasksperchild=tasks_per_worker)
+            else:
+                self.pool = multiprocessing.Pool(jobs)
+            self.pool_args = (jobs, recycle_after)
+        return self.pool
+
+    def close(self):
+        'Shut down any worker processes, giving up on the files they haven\'t finished'
+        self.pending = []
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self.pool_args = None
+
+    def cache_key(self, src_file, **options):
+        '''
+        Scores depend on which checks pylint runs, so they depend on its 
+        version, and on its configuration: the pylintrc it found, and that 
+        file's contents.  The judge's options are included as well.
+        '''
+        return self.run_key(**options)
+
+    def run_key(self, **options):
+        'The same as cache_key, which doesn\'t depend on the file'
+        return pylint.__pkginfo__.version, rcfile_key(), sorted(options.items())
+
+    # (LineIndex, buckets) for the file most recently judged; contestants are 
+    # judged a file at a time, so there's no need to remember more than one
+    _last_buckets = None
 
     def msg_types(self, contestant):
-        'Yield message categories for each message recorded for this Contestant'
-        buf = self[contestant.src_file]
-        buf.seek(0) # rewind in case previous runs have exhausted
-        for line in buf:
-            matches = MESSAGE_REGEX.match(line)
-            if matches:
-                line, category = matches.group(1, 2)
-                if int(line) in contestant.linenums:
-                    yield category
-
-    def __call__(self, contestant):
+        'Return a list of message categories for each message recorded for this Contestant'
+        line_index = contestant.line_index
+        if line_index is None:
+            return [category for line, category in self[contestant.src_file] if line in contestant.linenums]
+
+        last_buckets = self._last_buckets
+        if last_buckets is None or last_buckets[0] is not line_index:
+            last_buckets = (line_index, line_index.bucket(self[contestant.src_file]))
+            self._last_buckets = last_buckets
+        return last_buckets[1].get(contestant, [])
+
+    def __call__(self, contestant, **options):
         '''
         pylint runs on a per-module basis, like tabnanny.  However, it reports
         line numbers with each message, so we can associate individual messages
         with Contestants.
 
-        Scan through the output, looking for lines that are within the requested
-        contestant.  Return the sum of the message weights, which are determined
-        by the category of each message.
+        The messages for each module are sorted by Contestant in one pass, 
+        using the module's LineIndex.  Return the sum of the message weights, 
+        which are determined by the category of each message.
         '''
         return sum(SCORE_MAP[category] for category in self.msg_types(contestant))
\ No newline at end of file
@@ -2,6 +2,11 @@
 Things that generate reports from the results of a quality contest.
 '''
 
+import csv
+import heapq
+import itertools
+import json
+import sqlite3
 import sys
 
 def contestant_list(results):
@@ -10,10 +15,14 @@ def contestant_list(results):
         for contestant in contestant_list:
             yield src_file, contestant
 
-def print_report(results):
+def print_report(results, top=None):
     '''
     Print the results via stdout.
 
+    If `top` is given, only that many of the highest-scoring contestants are 
+    printed; they're picked out with a bounded heap, rather than by sorting 
+    everything.
+
     todo: pass in the output stream as an argument, so it can be overriden
     this would currently change the protocol for reporters
     '''
@@ -21,16 +30,22 @@ def print_report(results):
         return
 
     # sort contestants by final score
-    sorted_contestants = sorted(contestant_list(results), key=lambda x: x[1].final_score, reverse=True)
-
-    # get a list of judge names from the first result item
-    judge_names = results.itervalues().next()[0].scores.keys()
+    by_score = lambda x: x[1].final_score
+    if top is None:
+        sorted_contestants = sorted(contestant_list(results), key=by_score, reverse=True)
+    else:
+        sorted_contestants = heapq.nlargest(top, contestant_list(results), key=by_score)
 
-    chart = [['File', 'Item'] + judge_names + ['Final']]
-    for src_path, contestant in sorted_contestants:
-        chart.append([src_path, contestant.name] + ordered_scores(contestant.scores, judge_names) + [contestant.final_score])
+    # get a list of judge names from the first result item; sort them, since
+    # dict ordering can vary between equal dicts, e.g. after unpickling
+    judge_names = sorted(results.itervalues().next()[0].scores.keys())
 
-    write_minimal_columns(chart, sys.stdout)
+    # rows are generated as write_minimal_columns consumes them, so the table
+    # is only held in memory once, as text
+    header = ['File', 'Item'] + judge_names + ['Final']
+    rows = ([src_path, contestant.name] + ordered_scores(contestant.scores, judge_names) + [contestant.final_score]
+        for src_path, contestant in sorted_contestants)
+    write_minimal_columns(itertools.chain([header], rows), sys.stdout)
 
 def write_minimal_columns(chart, output):
     '''
@@ -38,10 +53,7 @@ def write_minimal_columns(chart, output):
 
     `chart` must be a two-dimensional iterable of values to be written.  The 
     outer iterable is assumed to represent rows, and the inner iterables, 
-    columns.
-
-    The iterables must allow for by-index access, i.e., it[0] must return
-    the first element.
+    columns.  It's only iterated over once, so it may be a generator.
 
     Formats the `chart` in the following ways:
     * right-aligns numeric values (float, int, complex, and long)
@@ -53,41 +65,32 @@ def write_minimal_columns(chart, output):
     todo: allow for configuration options, say, to change formatting, like
     decimal precision.
     '''
-    if len(chart) == 0:
-        return
-
-    # implementation note: there follow a lot of 'for' loops around
-    # comprehensions.  I intentionally did this over using nested comprehensions,
-    # although the whole function stands to be reviewed for efficiency.
-
-    # convert all values in chart to strings
-    # todo: find a better way to do this that doesn't duplicate memory
+    # convert all values in chart to strings, finding the longest cell in each
+    # column as we go
     text_chart = []
+    max_len = None
+    justify = None
     for row in chart:
-        text_chart.append(['%.3f' % col if type(col) == float else str(col) for col in row])
-
-    if len(chart) > 1:
-        # scan the second row (first data row) for data types to determine 
-        # column justifications.
-        # build a list of bools, True if right, False if left
-        justify = [type(cell) in [int, float, complex, long] for cell in chart[1]]
-    else:
-        # second row doesn't exist, then justification doesn't matter; just assume all lefts
-        justify = [False] * len(chart[0])
-    
-    # find the longest cell in each column; make a list, indexed by column
-    max_len = []
-    for i in range(len(chart[0])):
-        max_len.append(max(len(row[i]) for row in text_chart))
-
-    # overwrite text_chart cell values with justified padding
-    for i, row in enumerate(text_chart):
-        for j, cell in enumerate(row):
-            justifier = cell.rjust if justify[j] else cell.ljust
-            text_chart[i][j] = justifier(max_len[j])
+        text_row = ['%.3f' % col if type(col) == float else str(col) for col in row]
+        text_chart.append(text_row)
+        if max_len is None:
+            max_len = [len(cell) for cell in text_row]
+        else:
+            max_len = [max(width, len(cell)) for width, cell in itertools.izip(max_len, text_row)]
+        if justify is None and len(text_chart) == 2:
+            # use the first data row's types to determine column 
+            # justifications: True if right, False if left
+            justify = [type(cell) in [int, float, complex, long] for cell in row]
+
+    if not text_chart:
+        return
+    if justify is None:
+        # there's no data row, so justification doesn't matter; just assume all lefts
+        justify = [False] * len(max_len)
 
     for row in text_chart:
-        output.write('  '.join(row) + '\n')
+        output.write('  '.join((cell.rjust if right else cell.ljust)(width) 
+            for cell, right, width in itertools.izip(row, justify, max_len)) + '\n')
 
 
 def ordered_scores(scores, judge_names):
@@ -95,6 +98,142 @@ def ordered_scores(scores, judge_names):
     Return a list of values in `scores`, ordered so their keys match
     their order of occurrence in `judge_names` 
     '''
-    scores = scores.items()
-    scores.sort(key=lambda i: judge_names.index(i[0]))
-    return [i[1] for i in scores]
\ No newline at end of file
+    return [scores[judge_name] for judge_name in judge_names if judge_name in scores]
+
+class StreamingReporter(object):
+    '''
+    Base class for reporters that write out each file's results as soon as
+    they're final, rather than waiting for the whole run, so that results 
+    can be consumed while the run is in progress, and needn't be kept in 
+    memory.
+
+    Instances are meant to be passed as the `on_file` argument of 
+    quality.core.run_contest; call close() once the run is done.
+
+    Child classes override write_header, write_row and close.  Columns are 
+    the file, the item name, each judge's score, and the final score; judge 
+    names are taken from the first contestant, and sorted, as in print_report.
+
+    Attributes:
+    * judge_names - sorted list of judge names, or None until the first 
+        contestant arrives
+    '''
+    def __init__(self):
+        self.judge_names = None
+
+    def __call__(self, src_path, contestants):
+        for contestant in contestants:
+            if self.judge_names is None:
+                self.judge_names = sorted(contestant.scores.keys())
+                self.write_header()
+            self.write_row(src_path, contestant.name, ordered_scores(contestant.scores, self.judge_names), 
+                contestant.final_score)
+        self.flush()
+
+    def write_header(self):
+        'Called once, when judge_names have been determined'
+        pass
+
+    def write_row(self, src_path, name, scores, final_score):
+        'Write the results for one contestant; `scores` is ordered like judge_names'
+        raise NotImplementedError
+
+    def flush(self):
+        'Make the rows written so far visible to readers; called after each file'
+        pass
+
+    def close(self):
+        pass
+
+class StreamingFileReporter(StreamingReporter):
+    '''
+    Base class for StreamingReporters that write text to a file-like object.
+
+    Attributes:
+    * output - the file-like object
+    * close_output - if True, `output` is closed along with the reporter
+    '''
+    def __init__(self, output, close_output=False):
+        super(StreamingFileReporter, self).__init__()
+        self.output = output
+        self.close_output = close_output
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        if self.close_output:
+            self.output.close()
+        else:
+            self.output.flush()
+
+class JsonLinesReporter(StreamingFileReporter):
+    '''
+    Writes one JSON object per line, per contestant, with the keys "file", 
+    "item", "scores" (an object mapping judge names to scores) and "final".
+    '''
+    def write_row(self, src_path, name, scores, final_score):
+        self.output.write(json.dumps({
+            'file': src_path,
+            'item': name,
+            'scores': dict(itertools.izip(self.judge_names, scores)),
+            'final': final_score,
+        }, sort_keys=True) + '\n')
+
+class CsvReporter(StreamingFileReporter):
+    '''
+    Writes CSV, with a header row, and a row per contestant, with the same 
+    columns as print_report.
+    '''
+    def __init__(self, output, close_output=False):
+        super(CsvReporter, self).__init__(output, close_output)
+        self.writer = csv.writer(output)
+
+    def write_header(self):
+        self.writer.writerow(['File', 'Item'] + self.judge_names + ['Final'])
+
+    def write_row(self, src_path, name, scores, final_score):
+        self.writer.writerow([src_path, name] + scores + [final_score])
+
+class SqliteReporter(StreamingReporter):
+    '''
+    Writes rows to a `results` table in an SQLite database, replacing the 
+    table if it already exists.  It has the columns `file`, `item`, one 
+    named after each judge, and `final`, and is indexed by file and by final
+    score.
+
+    Each file's rows are committed as soon as they're written, and the 
+    database uses write-ahead logging, so readers can query it during the 
+    run.
+
+    Paths are stored as text, decoded with the file system encoding, since 
+    sqlite3 won't take 8-bit byte strings; bytes that don't decode are 
+    replaced.
+    '''
+    def __init__(self, path):
+        super(SqliteReporter, self).__init__()
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('DROP TABLE IF EXISTS results')
+        self.insert = None
+
+    def write_header(self):
+        columns = ['file', 'item'] + self.judge_names + ['final']
+        quoted = ['"%s"' % column.replace('"', '""') for column in columns]
+        self.connection.execute('CREATE TABLE results (%s)' % ', '.join(
+            ['%s TEXT' % column for column in quoted[:2]] + ['%s NUMERIC' % column for column in quoted[2:]]))
+        self.connection.execute('CREATE INDEX results_file ON results (file)')
+        self.connection.execute('CREATE INDEX results_final ON results (final)')
+        self.insert = 'INSERT INTO results VALUES (%s)' % ', '.join('?' * len(columns))
+
+    def write_row(self, src_path, name, scores, final_score):
+        if isinstance(src_path, str):
+            src_path = src_path.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+        self.connection.execute(self.insert, [src_path, name] + scores + [final_score])
+
+    def flush(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
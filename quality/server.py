@@ -0,0 +1,341 @@
+'''
+A long-running scoring server, for editors and pre-commit hooks, which
+answers requests over a Unix domain socket, with judges that stay loaded
+between requests.
+
+Start it with `python -m quality.server serve --socket PATH --coverage PATH`,
+and score files with `python -m quality.server score --socket PATH FILE...`,
+or from Python, with request().
+
+The protocol is one JSON object per line, each way.  A request has the keys:
+* files - list of paths to score; relative paths are taken to be relative
+    to the server's working directory, so clients should send absolute ones
+* formula - optional formula for final scores, replacing the server's; 
+    formulas may only use judge names, numbers and operators
+
+Each request gets a response with the keys:
+* results - list of objects, one per contestant, with the same keys as
+    quality.report.JsonLinesReporter writes: file, item, scores and final
+* unparsable - list of the requested files that couldn't be parsed
+* warnings - list of warning messages raised while scoring
+or, if the request couldn't be scored, just the key:
+* error - a message saying why, e.g. that some of the files don't exist
+
+A connection may carry any number of requests, answered in order.  Only 
+the user running the server may connect to its socket.
+'''
+
+import quality.cmdline
+import quality.core
+import quality.report
+import quality.watch
+
+import errno
+import json
+import multiprocessing
+import optparse
+import os
+import os.path
+import signal
+import socket
+import SocketServer
+import sys
+import types
+import warnings
+
+# seconds to wait for a worker to score a request; a worker that dies takes
+# its request with it, and the pool never reports the loss
+REQUEST_TIMEOUT = 600
+
+# the number of requests each worker scores before it's replaced, so that 
+# astroid's cache of parsed modules, which only grows, is let go
+WORKER_RECYCLE_AFTER = 100
+
+# the state of a scoring worker process: (judges, options, coverage file signature)
+_server_state = None
+
+def _init_server_worker(coverage_file):
+    'Initializer for scoring worker processes: loads judges once, for every request'
+    global _server_state
+    # Ctrl-C is for the server; it shuts the workers down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _server_state = (quality.core.load_judges(), {'crap:coverage_file': coverage_file},
+        quality.watch.file_signature(coverage_file))
+
+def _score_request(src_paths, formula):
+    '''
+    Score `src_paths` in a worker process, and return a response for them.
+
+    Each file is forgotten by the judges first, since a request usually
+    means it changed; if coverage.xml has changed since the last request,
+    everything is forgotten.
+    '''
+    global _server_state
+    judges, options, coverage_signature = _server_state
+    current_signature = quality.watch.file_signature(options['crap:coverage_file'])
+    forget = src_paths
+    if current_signature != coverage_signature:
+        _server_state = (judges, options, current_signature)
+        forget = [None]
+    for judge in judges:
+        if hasattr(judge, 'forget'):
+            for src_path in forget:
+                judge.forget(src_path)
+
+    judge_names = quality.cmdline.formula_judge_names(formula, [judge._quality_judge_name for judge in judges])
+    recruited_judges = [judge for judge in judges if judge._quality_judge_name in judge_names]
+    with warnings.catch_warnings(record=True) as caught:
+        # only our own warnings are of interest to clients, but all of them are
+        warnings.simplefilter('ignore')
+        warnings.filterwarnings('always', module=r'quality\.')
+        # formulas come from clients, so they get no builtins, only the scores
+        results = quality.core.run_contest(src_paths, options, compile(formula, '<formula>', 'eval'),
+            recruited_judges, compact=True, builtins={})
+
+    return {
+        'results': [{
+            'file': src_path,
+            'item': record.name,
+            'scores': record.scores,
+            'final': record.final_score,
+        } for src_path in src_paths if src_path in results for record in results[src_path]],
+        'unparsable': [src_path for src_path in src_paths if src_path not in results],
+        'warnings': [str(warning.message) for warning in caught],
+    }
+
+class ScoringService(object):
+    '''
+    Checks requests, and hands them to a pool of worker processes to score.
+    Each worker loads its own judges once, so that pylint stays imported and
+    coverage.xml stays parsed from one request to the next.  On Python 2.7 
+    and later, each worker is replaced after WORKER_RECYCLE_AFTER requests.
+
+    Attributes:
+    * coverage_file - absolute path to coverage.xml
+    * formula - default formula for final scores
+    * judge_names - names of the judges available to formulas
+    * timeout - seconds to wait for a request to be scored
+    * pool - multiprocessing.Pool of scoring workers
+    '''
+    def __init__(self, coverage_file, formula=None, jobs=1, timeout=REQUEST_TIMEOUT):
+        '''
+        Args:
+        * `coverage_file` - path to coverage.xml
+        * `formula` - default formula, or None for the stock one
+        * `jobs` - number of worker processes, i.e. requests scored at once;
+            0 or None means one per CPU
+        * `timeout` - seconds to wait for a request to be scored, before 
+            answering with an error
+        '''
+        self.coverage_file = os.path.abspath(coverage_file)
+        self.formula = formula or quality.cmdline.default_quality_formula()
+        self.judge_names = [judge._quality_judge_name for judge in quality.core.load_judges()]
+        self.check_formula(self.formula)
+        self.timeout = timeout
+        pool_options = {}
+        if sys.version_info >= (2, 7):
+            # maxtasksperchild is new in Python 2.7
+            pool_options['maxtasksperchild'] = WORKER_RECYCLE_AFTER
+        self.pool = multiprocessing.Pool(jobs or None, _init_server_worker, (self.coverage_file,), **pool_options)
+
+    def check_formula(self, formula):
+        '''
+        Raise ValueError if `formula` can't be used.  Formulas are evaluated
+        without builtins, and may not use any names besides the judges', 
+        which also rules out attributes, so that a client can't use them to 
+        run code of its own.
+        '''
+        try:
+            code = compile(formula, '<formula>', 'eval')
+            judge_names = quality.cmdline.formula_judge_names(formula, self.judge_names)
+        except Exception, exc:
+            raise ValueError('Invalid formula: %s' % exc)
+        if not judge_names:
+            raise ValueError('Formula doesn\'t include any known metric names: %s' % formula)
+        other_names = sorted(set(code.co_names) - set(self.judge_names))
+        if other_names:
+            raise ValueError('Formula uses names other than the judges\': %s' % ', '.join(other_names))
+        if any(isinstance(const, types.CodeType) for const in code.co_consts):
+            raise ValueError('Formula can\'t define functions or generators: %s' % formula)
+
+    def handle(self, request):
+        'Return the response to `request`, a dict decoded from JSON'
+        if not isinstance(request, dict):
+            return {'error': 'Requests must be JSON objects'}
+        src_paths = request.get('files')
+        if not src_paths or not isinstance(src_paths, list) or not all(isinstance(i, basestring) for i in src_paths):
+            return {'error': 'Requests must include a list of files'}
+        # JSON strings decode to unicode, but paths are kept as byte strings
+        encoding = sys.getfilesystemencoding() or 'utf-8'
+        src_paths = [src_path.encode(encoding) if isinstance(src_path, unicode) else src_path 
+            for src_path in src_paths]
+        missing = [src_path for src_path in src_paths if not os.path.isfile(src_path)]
+        if missing:
+            return {'error': 'Files not found: %s' % ', '.join(missing)}
+        formula = request.get('formula') or self.formula
+        try:
+            self.check_formula(formula)
+        except ValueError, exc:
+            return {'error': str(exc)}
+
+        try:
+            return self.pool.apply_async(_score_request, (src_paths, formula)).get(self.timeout)
+        except multiprocessing.TimeoutError:
+            return {'error': 'Scoring timed out after %s seconds' % self.timeout}
+        except Exception, exc:
+            return {'error': 'Scoring failed: %s: %s' % (type(exc).__name__, exc)}
+
+    def close(self):
+        'Shut down the worker processes'
+        self.pool.terminate()
+        self.pool.join()
+
+class ScoreRequestHandler(SocketServer.StreamRequestHandler):
+    'Answers each line of JSON on a connection with a line of JSON'
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {'error': 'Requests must be JSON'}
+            else:
+                response = self.server.service.handle(request)
+            self.wfile.write(json.dumps(response, sort_keys=True) + '\n')
+
+class ScoringServer(SocketServer.ThreadingUnixStreamServer):
+    '''
+    Listens on a Unix domain socket, handling each connection in its own
+    thread; requests from all connections share `service`.  The socket is
+    only open to the user running the server.
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        # a socket file left behind by a server that's gone would stop us
+        # from binding, but one that's still in use must be left alone
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error, exc:
+                if exc.errno != errno.ECONNREFUSED:
+                    raise
+                os.remove(socket_path)
+            else:
+                probe.close()
+                raise ValueError('A server is already listening on %s' % socket_path)
+        SocketServer.ThreadingUnixStreamServer.__init__(self, socket_path, ScoreRequestHandler)
+        self.service = service
+
+    def server_bind(self):
+        '''
+        Bind the socket so that only this user can connect to it, since 
+        whoever connects can have the server read any file it can
+        '''
+        # the umask covers the moment between creating the socket file and
+        # the chmod
+        umask = os.umask(0177)
+        try:
+            SocketServer.ThreadingUnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0600)
+
+    def server_close(self):
+        SocketServer.ThreadingUnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+def request(socket_path, src_paths, formula=None):
+    '''
+    Ask the server listening on `socket_path` to score `src_paths`, which are
+    made absolute first, and return its response.  Raises ValueError if the
+    server reports an error.
+    '''
+    message = {'files': [os.path.abspath(src_path) for src_path in src_paths]}
+    if formula:
+        message['formula'] = formula
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message) + '\n')
+        response = json.loads(sock.makefile('rb').readline())
+    finally:
+        sock.close()
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return response
+
+def print_response(response):
+    'Print the results in a response, as quality.report.print_report does'
+    results = {}
+    for row in response['results']:
+        judge_names = tuple(str(judge_name) for judge_name in sorted(row['scores']))
+        src_path = row['file'].encode(sys.getfilesystemencoding() or 'utf-8')
+        results.setdefault(src_path, []).append(quality.core.ScoreRecord(src_path, row['item'].encode('utf-8'), 
+            judge_names, tuple(row['scores'][judge_name] for judge_name in judge_names), row['final']))
+    quality.report.print_report(results)
+
+def main(args=None):
+    'Run the server, or send it a request'
+    parser = optparse.OptionParser(
+        usage='%prog serve --socket PATH --coverage PATH [options]\n       %prog score --socket PATH [options] FILE...',
+        description='Score Python modules with a long-running server')
+    parser.add_option('--socket', action='store', metavar='PATH', help='Path to the server\'s Unix domain socket')
+    parser.add_option('--coverage', action='store', metavar='PATH',
+        help='serve: path to coverage.xml, or to coverage.py\'s .coverage data file')
+    parser.add_option('-f', '--formula', action='store',
+        help='Formula for final scores; for serve, the default for requests that don\'t give one')
+    parser.add_option('-j', '--jobs', action='store', type='int', default=0,
+        help='serve: number of worker processes, i.e. requests scored at once; 0 means one per CPU')
+    parser.add_option('--timeout', action='store', type='float', default=REQUEST_TIMEOUT, metavar='SECONDS',
+        help='serve: how long to wait for a request to be scored, before answering with an error')
+    opts, args = parser.parse_args(args)
+    if not args or args[0] not in ('serve', 'score'):
+        parser.error('Expected a command: serve or score')
+    if not opts.socket:
+        parser.error('--socket is required')
+
+    if args[0] == 'score':
+        if len(args) < 2:
+            parser.error('No files to score')
+        try:
+            response = request(opts.socket, args[1:], opts.formula)
+        except (ValueError, socket.error), exc:
+            parser.exit(1, 'Error: %s\n' % exc)
+        for message in response['warnings']:
+            sys.stderr.write('Warning: %s\n' % message)
+        print_response(response)
+        return
+
+    if len(args) > 1:
+        parser.error('Unexpected arguments: %s' % ' '.join(args[1:]))
+    if not opts.coverage or not os.path.isfile(opts.coverage):
+        parser.error('Invalid coverage file argument: %s' % opts.coverage)
+    if opts.jobs < 0:
+        parser.error('Invalid number of jobs: %d' % opts.jobs)
+    if opts.timeout <= 0:
+        parser.error('Invalid timeout: %s' % opts.timeout)
+    try:
+        service = ScoringService(opts.coverage, opts.formula, opts.jobs, opts.timeout)
+    except ValueError, exc:
+        parser.error(str(exc))
+    try:
+        server = ScoringServer(opts.socket, service)
+    except ValueError, exc:
+        service.close()
+        parser.error(str(exc))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == '__main__':
+    main()
@@ -4,27 +4,78 @@ from __future__ import absolute_import
 
 import quality.liason
 
-import os
 import tabnanny
+import tokenize
+
+def check_tokens(tokens):
+    '''
+    Run tabnanny's checks over already-tokenized source.
+
+    Args:
+    * `tokens` - iterable of tokens, as from tokenize.generate_tokens
+
+    Returns a list of (line number, message) findings.  Like tabnanny.check, 
+    this stops at the first problem, so the list holds at most one finding.
+    '''
+    try:
+        tabnanny.process_tokens(tokens)
+    except tokenize.TokenError, exc:
+        return [(exc.args[1][0], 'Token Error: %s' % exc.args[0])]
+    except IndentationError, exc:
+        return [(exc.lineno, 'Indentation Error: %s' % exc.msg)]
+    except tabnanny.NannyNag, nag:
+        return [(nag.get_lineno(), nag.get_msg())]
+    return []
 
-@quality.liason.capture_output
 def run_tabnanny(src_file):
-    'Dispatch to tabnanny'
-    tabnanny.check(src_file)
+    'Dispatch to tabnanny; returns findings in the format of check_tokens'
+    with open(src_file) as fobj:
+        return check_tokens(tokenize.generate_tokens(fobj.readline))
     
 class TabnannyJudge(quality.liason.OutputCollectingJudge):
+    _quality_judge_version = 2
+
+    # (LineIndex, buckets) for the file most recently judged
+    _last_buckets = None
+
     def __init__(self):
         super(TabnannyJudge, self).__init__('tabnanny', run_tabnanny)
 
+    def findings(self, contestant):
+        '''
+        Return a list of the messages found on the lines of this Contestant.
+
+        Findings on lines that don't belong to any Contestant, such as blank 
+        lines or decorators, go to the module.  Contestants without a 
+        LineIndex receive every finding for their module.
+        '''
+        if contestant.src_file not in self and contestant.source is not None:
+            # use the tokens shared by the rest of the run, rather than reading
+            # the file again
+            self[contestant.src_file] = check_tokens(contestant.source.iter_tokens())
+
+        line_index = contestant.line_index
+        if line_index is None:
+            return [message for line, message in self[contestant.src_file]]
+
+        last_buckets = self._last_buckets
+        if last_buckets is None or last_buckets[0] is not line_index:
+            findings = self[contestant.src_file]
+            buckets = line_index.bucket(findings)
+            # annotate lists the module first
+            buckets[line_index.contestants[0]].extend(message for line, message in findings 
+                if not line_index.owners(line))
+            last_buckets = (line_index, buckets)
+            self._last_buckets = last_buckets
+        return last_buckets[1].get(contestant, [])
+
     def __call__(self, contestant):
         '''
-        Return 1 if the Contestant contains with indentation errors, or 0 otherwise.
+        Return 1 if the Contestant contains indentation errors, or 0 otherwise.
 
-        Tabnanny works on a per-file basis; because indentation analysis is 
-        context-sensitive, it's impossible to validate individual Contestants
-        (functions or classes).  Therefore, every Contestant in a module receives
-        the same score.
+        Indentation analysis is context-sensitive, so tabnanny works on whole
+        modules, and stops at the first problem.  It does report the line 
+        where it found that problem, though, so the score goes to the 
+        Contestant owning that line.
         '''
-        fobj = self[contestant.src_file]
-        fobj.seek(0, os.SEEK_END)
-        return 1 if fobj.tell() else 0
\ No newline at end of file
+        return 1 if self.findings(contestant) else 0
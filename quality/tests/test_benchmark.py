@@ -0,0 +1,97 @@
+'Tests for benchmark.py'
+
+from __future__ import absolute_import
+
+import quality.benchmark
+import quality.core
+import quality.crap
+import quality.tests.compat # must come before import nose.tools
+
+import ast
+from nose.tools import *
+import os.path
+import shutil
+import tempfile
+
+def test_generate_corpus():
+    'generate_corpus: writes parsable modules with the requested shape, the same way each time'
+    root = tempfile.mkdtemp()
+    try:
+        src_paths = quality.benchmark.generate_corpus(os.path.join(root, 'a'), files=3, functions=8, depth=2, lines=1)
+        again = quality.benchmark.generate_corpus(os.path.join(root, 'b'), files=3, functions=8, depth=2, lines=1)
+        assert_equal(4, len(src_paths))
+
+        for src_path, other_path in zip(src_paths, again):
+            with open(src_path) as fobj:
+                data = fobj.read()
+            with open(other_path) as fobj:
+                assert_equal(data, fobj.read())
+            ast.parse(data, filename=src_path)
+
+        contestants = quality.core.parse_file(src_paths[1])
+        names = [contestant.name for contestant in contestants]
+        # the module, six functions, the class and its two methods
+        assert_equal(10, len(names))
+        assert 'Generated.method_3' in names
+    finally:
+        shutil.rmtree(root)
+
+def test_generate_coverage_xml():
+    'generate_coverage_xml: covers every statement of every module, with paths CoverageIndex can find'
+    root = tempfile.mkdtemp()
+    try:
+        src_paths = quality.benchmark.generate_corpus(root, files=2, functions=4, depth=1, lines=2)
+        coverage_path = os.path.join(root, 'coverage.xml')
+        quality.benchmark.generate_coverage_xml(coverage_path, src_paths, hit_ratio=0.5)
+
+        index = quality.crap.CoverageIndex(quality.crap.iterparse_line_records(coverage_path), coverage_path)
+        for src_path in src_paths[1:]:
+            hit, unhit = index.line_nums(src_path)
+            assert_equal(quality.benchmark.statement_lines(src_path), sorted(hit | unhit))
+            assert hit and unhit
+    finally:
+        shutil.rmtree(root)
+
+def test_find_regressions():
+    'find_regressions: reports only stages slower than the baseline by more than the threshold'
+    baseline = {'parse': 1.0, 'lint': 2.0, 'report': 0.5}
+    timings = {'parse': 1.1, 'lint': 3.0, 'formula': 9.0}
+    assert_equal([('lint', 2.0, 3.0)], quality.benchmark.find_regressions(timings, baseline, 0.2))
+    assert_equal([('lint', 2.0, 3.0), ('parse', 1.0, 1.1)], quality.benchmark.find_regressions(timings, baseline, 0.05))
+
+def test_format_change():
+    'format_change: gives the change as a percentage, even from a stage that took no time'
+    assert_equal('+50.0%', quality.benchmark.format_change(2.0, 3.0))
+    assert_equal('-25.0%', quality.benchmark.format_change(2.0, 1.5))
+    assert_equal('n/a', quality.benchmark.format_change(0.0, 1.0))
+
+def test_baseline_round_trip():
+    'load_baseline: returns saved timings, but only for the same corpus'
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, 'baseline.json')
+        corpus = dict(quality.benchmark.DEFAULT_CORPUS)
+        assert_equal(None, quality.benchmark.load_baseline(path, corpus))
+
+        quality.benchmark.save_baseline(path, corpus, {'parse': 0.25})
+        assert_equal({'parse': 0.25}, quality.benchmark.load_baseline(path, corpus))
+        corpus['files'] += 1
+        assert_equal(None, quality.benchmark.load_baseline(path, corpus))
+    finally:
+        shutil.rmtree(root)
+
+def test_run_benchmark():
+    'run_benchmark: times each requested stage'
+    root = tempfile.mkdtemp()
+    try:
+        src_paths = quality.benchmark.generate_corpus(root, files=2, functions=4, depth=1, lines=1)
+        coverage_path = os.path.join(root, 'coverage.xml')
+        quality.benchmark.generate_coverage_xml(coverage_path, src_paths)
+
+        stages = [stage for stage in quality.benchmark.STAGES if stage != 'lint']
+        timings = quality.benchmark.run_benchmark(src_paths, coverage_path, stages, repeat=1)
+        assert_equal(sorted(stages), sorted(timings))
+        for seconds in timings.values():
+            assert seconds >= 0
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,128 @@
+'Tests for cache.py'
+
+from __future__ import absolute_import
+
+import quality.cache
+import quality.core
+import quality.tests.compat # must come before import nose.tools
+
+import mock
+from nose.tools import *
+import os
+import os.path
+import shutil
+import tempfile
+
+FORMULA = compile('judge_a', '<formula>', 'eval')
+
+class CacheDir(object):
+    'A context manager that provides a ResultCache in a temp dir, and removes it on exit'
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        return quality.cache.ResultCache(os.path.join(self.path, 'cache'), self.max_size)
+
+    def __exit__(self, exc_type, exc_val, tb):
+        shutil.rmtree(self.path)
+
+def make_judge(name, version=None, cache_key=None):
+    judge = mock.MagicMock(name=name, spec=['_quality_judge_name', '_quality_judge_version', 'cache_key'])
+    judge._quality_judge_name = name
+    judge._quality_judge_version = version
+    if cache_key is None:
+        del judge.cache_key
+    else:
+        judge.cache_key.return_value = cache_key
+    return judge
+
+def test_resultcache_get_put():
+    'ResultCache: stores and retrieves entries, and misses on unknown keys'
+    with CacheDir() as cache:
+        assert_equal(None, cache.get('abcdef'))
+        cache.put('abcdef', ['some', 'contestants'])
+        assert_equal(['some', 'contestants'], cache.get('abcdef'))
+        cache.put('abcdef', ['replaced'])
+        assert_equal(['replaced'], cache.get('abcdef'))
+
+        # unreadable entries are treated as misses, and thrown away
+        with open(cache.entry_path('abcdef'), 'w') as fobj:
+            fobj.write('garbage')
+        assert_equal(None, cache.get('abcdef'))
+        assert not os.path.exists(cache.entry_path('abcdef'))
+
+def test_resultcache_key():
+    'ResultCache.key: changes with anything that could influence scores'
+    cache = quality.cache.ResultCache('unused')
+    judges = [make_judge('judge_a', 1), make_judge('judge_b', cache_key='b key')]
+    options = {'judge_a:opt': 1, 'judge_b:opt': 2}
+    base = cache.key('a.py', 'x = 1', options, FORMULA, judges)
+
+    # keys are stable
+    assert_equal(base, cache.key('a.py', 'x = 1', options, FORMULA, judges))
+
+    variations = [
+        cache.key('b.py', 'x = 1', options, FORMULA, judges),
+        cache.key('a.py', 'x = 2', options, FORMULA, judges),
+        cache.key('a.py', 'x = 1', {'judge_a:opt': 3, 'judge_b:opt': 2}, FORMULA, judges),
+        cache.key('a.py', 'x = 1', options, compile('judge_a * 2', '<formula>', 'eval'), judges),
+        cache.key('a.py', 'x = 1', options, FORMULA, [make_judge('judge_a', 2), judges[1]]),
+        cache.key('a.py', 'x = 1', options, FORMULA, [judges[0], make_judge('judge_b', cache_key='other')]),
+    ]
+    for variation in variations:
+        assert_not_equal(base, variation)
+
+    # judges with a cache_key method decide for themselves which options matter
+    assert_equal(base, cache.key('a.py', 'x = 1', {'judge_a:opt': 1, 'judge_b:opt': 4}, FORMULA, judges))
+    judges[1].cache_key.assert_called_with('a.py', opt=4)
+
+def test_run_keys():
+    'run_keys: uses each judge\'s run_key, or its options'
+    judge_a = make_judge('judge_a', 2)
+    judge_a.run_key = mock.MagicMock(return_value='coverage digest')
+    judge_b = make_judge('judge_b')
+    assert_equal([('judge_a', 2, 'coverage digest'), ('judge_b', None, [('opt', 2)])], 
+        quality.cache.run_keys({'judge_a:opt': 1, 'judge_b:opt': 2}, [judge_a, judge_b]))
+    judge_a.run_key.assert_called_once_with(opt=1)
+
+def test_resultcache_prune():
+    'ResultCache.prune: discards least recently used entries first'
+    with CacheDir() as cache:
+        for i, key in enumerate(['aaaa', 'bbbb', 'cccc']):
+            cache.put(key, 'x' * 1000)
+            os.utime(cache.entry_path(key), (i, i))
+        entry_size = os.path.getsize(cache.entry_path('aaaa'))
+
+        # reading an entry makes it the most recently used
+        cache.get('aaaa')
+        cache.max_size = entry_size * 2
+        cache.prune()
+
+        assert_equal(None, cache.get('bbbb'))
+        assert cache.get('aaaa')
+        assert cache.get('cccc')
+
+def test_run_contest_cache():
+    'run_contest: serves unchanged files from the cache and rescores changed ones'
+    judge = mock.MagicMock(return_value=1, spec=['__call__', '_quality_judge_name'])
+    judge._quality_judge_name = 'judge_a'
+
+    with CacheDir() as cache:
+        src_path = os.path.join(os.path.dirname(cache.path), 'src.py')
+        with open(src_path, 'w') as fobj:
+            fobj.write('def f():\n    pass\n')
+
+        first = quality.core.run_contest([src_path], {}, FORMULA, [judge], cache=cache)
+        assert_equal(2, judge.call_count)
+
+        second = quality.core.run_contest([src_path], {}, FORMULA, [judge], cache=cache)
+        assert_equal(2, judge.call_count)
+        assert_equal(sorted((c.name, c.final_score) for c in first[src_path]),
+            sorted((c.name, c.final_score) for c in second[src_path]))
+
+        with open(src_path, 'w') as fobj:
+            fobj.write('def f():\n    pass\ndef g():\n    pass\n')
+        third = quality.core.run_contest([src_path], {}, FORMULA, [judge], cache=cache)
+        assert_equal(5, judge.call_count)
+        assert_equal(['<module>', 'f', 'g'], sorted(c.name for c in third[src_path]))
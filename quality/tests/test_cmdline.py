@@ -4,13 +4,19 @@ from __future__ import absolute_import
 
 import quality.tests.compat # must come before import nose.tools
 
+import json
+import mock
+from nose.plugins.skip import SkipTest
 from nose.tools import *
 import os
 import re
 import shutil
 import tempfile
+import types
+import warnings
 
 import quality.cmdline
+import quality.core
 
 class TempDir(object):
     '''
@@ -66,6 +72,9 @@ def test_find_source_files():
             ('.', [r'^\./dir_[^/]/*'], None, ['./container.py', './decoy.py/decoy.py']),
             # multiple excludes
             ('.', [r'a', r'[\d]'], None, ['./decoy.py/decoy.py', './dir_b/b.py']),
+            # excludes that can't be used for pruning, or combined into one regex
+            ('.', [r'dir_b/$'], None, ['./container.py', './dir_a/a.py', './dir_b/b.py', './dir_b/dir_b1/b1.py', './dir_b/dir_b2/b2.py', './decoy.py/decoy.py']),
+            ('.', [r'(dir_)b', r'container'], None, ['./dir_a/a.py', './decoy.py/decoy.py']),
             # single include
             ('.', None, [r'dir_b'], ['./dir_b/b.py','./dir_b/dir_b1/b1.py','./dir_b/dir_b2/b2.py',]),
             # multiple includes
@@ -80,4 +89,191 @@ def test_find_source_files():
 
         # error handling tests
         with assert_raises(ValueError):
-            quality.cmdline.find_source_files(os.path.join(container_dir.path, 'non-existent-path'))
\ No newline at end of file
+            quality.cmdline.find_source_files(os.path.join(container_dir.path, 'non-existent-path'))
+
+def _make_source_tree():
+    'Populate the current directory with a small tree of source files'
+    for i in ['pkg/sub', '.tox/py27/lib']:
+        os.makedirs(i)
+    for i in ['pkg/a.py', 'pkg/sub/b.py', '.tox/py27/lib/c.py', 'setup.py']:
+        open(i, 'w').close()
+
+def test_iter_source_files_prunes():
+    'iter_source_files: never lists excluded directories, and yields files lazily'
+    with TempDir():
+        _make_source_tree()
+        listed = []
+        orig_listdir = os.listdir
+        def listdir(path):
+            listed.append(path)
+            return orig_listdir(path)
+
+        with mock.patch('quality.cmdline.scandir', None):
+            with mock.patch('os.listdir', side_effect=listdir):
+                found = quality.cmdline.iter_source_files('.', exclude=[re.compile(r'/\.tox/')])
+                assert_equal([], listed)
+                assert_equal(['./setup.py', './pkg/a.py', './pkg/sub/b.py'], list(found))
+        assert_equal(['.', './pkg', './pkg/sub'], listed)
+
+    # bad arguments are reported straight away
+    with assert_raises(ValueError):
+        quality.cmdline.iter_source_files('non-existent-path')
+
+def test_iter_source_files_scandir():
+    'iter_source_files: finds the same files in the same order with or without scandir'
+    if quality.cmdline.scandir is None:
+        raise SkipTest('scandir is not available')
+    with TempDir():
+        _make_source_tree()
+        os.symlink('pkg', 'link')
+        for exclude in [None, [re.compile(r'/\.tox/')]]:
+            with mock.patch('quality.cmdline.scandir', None):
+                expected = list(quality.cmdline.iter_source_files('.', exclude=exclude))
+            assert_equal(expected, list(quality.cmdline.iter_source_files('.', exclude=exclude)))
+
+def test_combine_patterns():
+    'combine_patterns: matches when any one pattern matches'
+    patterns = [re.compile(i) for i in [r'^a', r'(x)\1', r'c$', r'(?i)D']]
+    matches = quality.cmdline.combine_patterns(patterns)
+    for text, expected in [('abc', True), ('xx', True), ('x', False), ('bc', True), ('bd', True), ('bcb', False)]:
+        assert_equal(expected, matches(text), text)
+
+def test_changed_source_files():
+    'changed_source_files: finds committed, uncommitted and untracked changes since a ref'
+    with TempDir() as container_dir:
+        def git(*args):
+            quality.cmdline.run_git(list(args), container_dir.path)
+        def write(path, text):
+            with open(path, 'w') as fobj:
+                fobj.write(text)
+
+        git('init', '-q')
+        git('config', 'user.email', 'nobody@example.com')
+        git('config', 'user.name', 'nobody')
+        os.makedirs('pkg')
+        for i in ['pkg/a.py', 'pkg/b.py', 'pkg/c.py', 'pkg/d.py']:
+            write(i, 'x = 1\n')
+        git('add', '.')
+        git('commit', '-q', '-m', 'base')
+        git('tag', 'base')
+
+        write('pkg/a.py', 'x = 2\n') # committed after the ref
+        git('commit', '-q', '-am', 'change a')
+        write('pkg/b.py', 'x = 2\n') # modified, not committed
+        write('pkg/e.py', 'x = 1\n') # untracked
+
+        source_files = quality.cmdline.find_source_files('pkg')
+        assert_equal(set(['pkg/a.py', 'pkg/b.py', 'pkg/e.py']), 
+            set(quality.cmdline.changed_source_files('base', 'pkg', source_files)))
+        assert_equal([], quality.cmdline.changed_source_files('HEAD', 'pkg', ['pkg/c.py']))
+
+        with assert_raises(ValueError):
+            quality.cmdline.changed_source_files('no-such-ref', 'pkg', source_files)
+
+def test_main_lazy_discovery():
+    'main: hands files to run_contest as they\'re found, unless it needs them all first'
+    with TempDir():
+        _make_source_tree()
+        with open('coverage.xml', 'w') as fobj:
+            fobj.write('<coverage/>')
+        for extra_args, lazy in [([], True), (['--since', 'HEAD'], False)]:
+            argv = ['pyquality', '-f', 'crap', '--format', 'jsonl', '-o', 'report'] + extra_args + ['coverage.xml', 'pkg']
+            with mock.patch('sys.argv', argv):
+                with mock.patch('quality.core.run_contest', return_value={}) as mock_run:
+                    with mock.patch('quality.cmdline.changed_source_files', side_effect=lambda ref, src_dir, paths: paths):
+                        quality.cmdline.main()
+            src_paths = mock_run.call_args[0][0]
+            assert_equal(lazy, not isinstance(src_paths, list))
+            assert_equal(['pkg/a.py', 'pkg/sub/b.py'], list(src_paths))
+
+        with assert_raises(SystemExit):
+            with mock.patch('sys.argv', ['pyquality', '-i', 'nothing', 'coverage.xml', '.']):
+                with mock.patch('sys.stderr'):
+                    quality.cmdline.main()
+
+def test_baseline():
+    'load_baseline: returns the saved baseline, unless the formula or run keys have changed'
+    formula = compile('a + b', '<formula>', 'eval')
+    with TempDir() as container_dir:
+        assert_equal(None, quality.cmdline.load_baseline('baseline', formula, ['keys']))
+
+        quality.cmdline.save_baseline('baseline', 'abc123', {'x.py': [1, 2]}, formula, ['keys'])
+        assert_equal({'formula': mock.ANY, 'run_keys': ['keys'], 'commit': 'abc123', 'results': {'x.py': [1, 2]}}, 
+            quality.cmdline.load_baseline('baseline', formula, ['keys']))
+        with warnings.catch_warnings(record=True):
+            # Python 2 would otherwise remember these, and not warn again
+            warnings.simplefilter('always')
+            assert_equal(None, quality.cmdline.load_baseline('baseline', compile('a', '<formula>', 'eval'), ['keys']))
+            assert_equal(None, quality.cmdline.load_baseline('baseline', formula, ['other keys']))
+
+COVERAGE_XML = '''<?xml version="1.0" ?>
+<coverage><packages><package><classes>
+<class filename="pkg/a.py" name="a"><methods/><lines><line hits="1" number="1"/><line hits="%s" number="2"/></lines></class>
+<class filename="pkg/b.py" name="b"><methods/><lines><line hits="1" number="1"/><line hits="%s" number="2"/></lines></class>
+</classes></package></packages></coverage>
+'''
+
+def test_main_baseline():
+    'main: takes results from the baseline only for files unchanged since its commit and --since, with the same coverage'
+    with TempDir() as container_dir:
+        def git(*args):
+            return quality.cmdline.run_git(list(args), container_dir.path)
+        def write(path, text):
+            with open(path, 'w') as fobj:
+                fobj.write(text)
+        def run(since):
+            argv = ['pyquality', '--since', since, '--baseline', 'baseline', '-f', 'crap', 
+                '--format', 'jsonl', '-o', 'report', 'coverage.xml', 'pkg']
+            with mock.patch('sys.argv', argv):
+                with mock.patch('quality.core.run_contest', side_effect=quality.core.run_contest) as mock_run:
+                    # checking the baseline takes no work per unchanged file
+                    with mock.patch('quality.crap.CrapJudge.cache_key', side_effect=AssertionError):
+                        quality.cmdline.main()
+            with open('report') as fobj:
+                reported = set(json.loads(line)['file'] for line in fobj)
+            return sorted(mock_run.call_args[0][0]), sorted(reported)
+
+        git('init', '-q')
+        git('config', 'user.email', 'nobody@example.com')
+        git('config', 'user.name', 'nobody')
+        os.makedirs('pkg')
+        write('pkg/a.py', 'def f():\n    return 1\n')
+        write('pkg/b.py', 'def g():\n    return 1\n')
+        write('coverage.xml', COVERAGE_XML % (1, 1))
+        git('add', 'pkg')
+        git('commit', '-q', '-m', 'base')
+
+        everything = ['pkg/a.py', 'pkg/b.py']
+        assert_equal((everything, everything), run('HEAD'))
+        assert_equal(([], everything), run('HEAD'))
+
+        # new coverage data means rescoring everything
+        write('coverage.xml', COVERAGE_XML % (1, 0))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            assert_equal((everything, everything), run('HEAD'))
+        assert any('coverage data' in str(i.message) for i in caught)
+
+        # files changed since the baseline's commit are rescored, and so are 
+        # files changed since --since
+        write('pkg/a.py', 'def f():\n    return 2\n')
+        git('commit', '-q', '-am', 'change a')
+        assert_equal((['pkg/a.py'], everything), run('HEAD'))
+        assert_equal((['pkg/a.py'], everything), run('HEAD~1'))
+        assert_equal(([], everything), run('HEAD'))
+
+        # uncommitted changes are rescored again, even once they're undone
+        write('pkg/b.py', 'def g():\n    return 2\n')
+        assert_equal((['pkg/b.py'], everything), run('HEAD'))
+        git('checkout', '--', 'pkg/b.py')
+        assert_equal((['pkg/b.py'], everything), run('HEAD'))
+        assert_equal(([], everything), run('HEAD'))
+
+        # a baseline commit that's gone means rescoring everything
+        git('commit', '-q', '--amend', '-m', 'change a again')
+        git('reflog', 'expire', '--expire=now', '--all')
+        git('gc', '-q', '--prune=now')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            assert_equal((everything, everything), run('HEAD'))
+        assert any('can\'t be compared' in str(i.message) for i in caught)
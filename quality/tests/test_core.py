@@ -1,13 +1,20 @@
 from __future__ import absolute_import
 
+import quality.complexity
 import quality.core
+import quality.timing
 import quality.tests.compat # must come before import nose.tools
 
 import ast
 import mock
+from nose.plugins.skip import SkipTest
 from nose.tools import *
 import os.path
+import pickle
+import shutil
 import sys
+import tempfile
+import tokenize
 import unittest
 import warnings
 import xml.etree.ElementTree
@@ -126,6 +133,101 @@ class C:
         [i.node.__class__.__name__ for i in contestants])
     assert_equal(5, [contestant.src_file for contestant in contestants].count('source.py'))
 
+ANNOTATE_SOURCE = '''\
+'module docstring'
+import os
+
+@decorator(lambda x: x if x else None)
+def function_a(arg=1 if True else 2):
+    """
+    function docstring
+    """
+    if arg and os:
+        return [i for i in range(3)]
+    def function_b():
+        pass
+    'not a docstring'
+
+class C1(object):
+    'class docstring'
+    CONSTANT = {1: 2}
+    class C2(Base if True else object):
+        def method(self):
+            try:
+                'first statement in a try block'
+                with open('x') as f:
+                    pass
+            except:
+                'first statement in an except block'
+            while True:
+                for i in []:
+                    pass
+            return lambda: (yield)
+    value = \\
+        CONSTANT
+'''
+
+def test_annotate():
+    'annotate: gives the same results as annotate_qualnames, annotate_linenums, find_contestants and complexity'
+    expected_tree = ast.parse(ANNOTATE_SOURCE)
+    quality.core.annotate_qualnames(expected_tree)
+    quality.core.annotate_linenums(expected_tree)
+    expected = [(c.name, c.linenums, quality.complexity.complexity(c.node), c.node, c.src_file)
+        for c in quality.core.find_contestants(expected_tree, 'source.py')]
+
+    actual_tree = ast.parse(ANNOTATE_SOURCE)
+    contestants = quality.core.annotate(actual_tree, 'source.py')
+    assert_equal(['<module>', 'function_a', 'function_a.function_b', 'C1', 'C1.C2', 'C1.C2.method'], [c.name for c in contestants])
+    # compare the node types rather than the nodes, which come from different trees
+    assert_equal([(name, linenums, complexity, node.__class__, src_file) for name, linenums, complexity, node, src_file in expected],
+        [(c.name, c.linenums, c.node.complexity, c.node.__class__, c.src_file) for c in contestants])
+
+def test_annotate_deep_nesting():
+    'annotate: handles trees deeper than the recursion limit'
+    tree = ast.parse('x = (' + ' + '.join(['1'] * (sys.getrecursionlimit() * 2)) + ')\ndef f():\n    pass')
+    contestants = quality.core.annotate(tree, 'source.py')
+    assert_equal(['<module>', 'f'], [c.name for c in contestants])
+    assert_equal(set([1]), contestants[0].linenums)
+
+def test_lineindex():
+    'LineIndex: attributes findings to the same contestants as their linenums'
+    contestants = quality.core.annotate(ast.parse(ANNOTATE_SOURCE), 'source.py')
+    line_index = contestants[0].line_index
+    assert all(c.line_index is line_index for c in contestants)
+
+    findings = [(line, line * 10) for line in range(-1, 40)] + [(1000, 'beyond the end')]
+    buckets = line_index.bucket(findings)
+    for contestant in contestants:
+        assert_equal([value for line, value in findings if line in contestant.linenums], buckets[contestant])
+    assert_equal((), line_index.owners(1000))
+
+def test_sourcefile():
+    'SourceFile: reads its file once and derives everything else from that'
+    data = '# -*- coding: latin-1 -*-\nx = "\xe9"\r\ndef f():\n    pass\n'
+    with mock.patch('__builtin__.open', mock.mock_open(read_data=data)) as mock_open:
+        source = quality.core.SourceFile('src.py')
+        assert_equal(data, source.data)
+        assert_equal(['# -*- coding: latin-1 -*-\n', 'x = "\xe9"\r\n', 'def f():\n', '    pass\n'], source.lines)
+        assert_equal('Module', source.tree.__class__.__name__)
+        assert_equal(list(tokenize.generate_tokens(iter(source.lines).next)), list(source.iter_tokens()))
+        # tokens are replayed rather than regenerated
+        assert_equal(list(source.iter_tokens()), list(source.iter_tokens()))
+    mock_open.assert_called_once_with('src.py', 'rb')
+
+    # only the path and contents are pickled
+    copy = pickle.loads(pickle.dumps(source))
+    assert_equal(('src.py', data), (copy.path, copy.data))
+    assert_equal(None, copy._tree)
+
+def test_sourcefile_token_error():
+    'SourceFile.iter_tokens: replays the tokens up to a failure, then the failure'
+    source = quality.core.SourceFile('src.py', 'x = (1,\n')
+    for i in range(2):
+        tokens = source.iter_tokens()
+        assert_equal('x', next(tokens)[1])
+        with assert_raises(tokenize.TokenError):
+            list(tokens)
+
 def test_extract_judge_kwargs():
     assert_equal({}, quality.core.extract_judge_kwargs('hello', {}))
     assert_equal(
@@ -154,19 +256,14 @@ def test_extract_judge_kwargs():
 @mock.patch('__builtin__.open', spec=file)
 @mock.patch('ast.parse')
 @mock.patch('xml.etree.ElementTree.parse')
-@mock.patch.multiple(
-    'quality.core', 
-    annotate_qualnames=mock.MagicMock(spec=quality.core.annotate_qualnames), 
-    annotate_linenums=mock.MagicMock(spec=quality.core.annotate_linenums),
-    find_contestants=mock.MagicMock(spec=quality.core.find_contestants),
-)
-def test_run_contest(etree_parse, ast_parse, mock_open):
+@mock.patch('quality.core.annotate', spec=quality.core.annotate)
+def test_run_contest(mock_annotate, etree_parse, ast_parse, mock_open):
     contestant_a = mock.MagicMock(name='contestant a')
     contestant_a.name = 'function_a'
     contestant_b = mock.MagicMock(name='contestant b')
     contestant_b.name = 'function_b'
     contestants = [contestant_a, contestant_b]
-    quality.core.find_contestants.return_value = contestants
+    mock_annotate.return_value = contestants
 
     def mock_judge(contestant, **options):
         '''
@@ -178,19 +275,17 @@ def test_run_contest(etree_parse, ast_parse, mock_open):
         }
         return qualities[contestant.name]
 
-    judge = mock.MagicMock(side_effect=mock_judge)
+    judge = mock.MagicMock(side_effect=mock_judge, spec=['__call__', '_quality_judge_name'])
     judge._quality_judge_name = 'mock_judge_name'
 
     src_path = '/path/to/src.py'
     result = quality.core.run_contest([src_path], {}, '2*mock_judge_name', [judge])
 
-    mock_open.assert_called_once_with(src_path)
-    mock_open.read.assert_called_once()
-    # ast_parse.assert_called_once_with(mock_open.read.return_value, filename=src_path)
-    ast_parse.assert_called_once()
-    quality.core.annotate_qualnames.assert_called_once_with(ast_parse.return_value)
-    quality.core.annotate_linenums.assert_called_once_with(ast_parse.return_value)
-    quality.core.find_contestants.assert_called_once_with(ast_parse.return_value, src_path)
+    mock_open.assert_called_once_with(src_path, 'rb')
+    mock_fobj = mock_open.return_value.__enter__.return_value
+    mock_fobj.read.assert_called_once_with()
+    ast_parse.assert_called_once_with(mock_fobj.read.return_value, filename=src_path)
+    mock_annotate.assert_called_once_with(ast_parse.return_value, src_path)
     
     assert_equal(result.keys(), ['/path/to/src.py'])
     assert_equal(set(result['/path/to/src.py']), set([contestant_b, contestant_a]))
@@ -205,4 +300,329 @@ def test_run_contest_bad_source(mock_ast_parse, mock_open):
         quality.core.run_contest(['syntax_error.py'], {}, '0', [])
 
     mock_ast_parse.assert_called_once()
-    assert 'Exception encountered while parsing file' in str(warning_context[-1].message)
\ No newline at end of file
+    assert 'Exception encountered while parsing file' in str(warning_context[-1].message)
+
+def _count_lines_judge(contestant):
+    'a judge simple enough to run in worker processes'
+    return len(contestant.linenums)
+_count_lines_judge._quality_judge_name = 'lines'
+
+def test_run_contest_jobs():
+    'run_contest: scoring with worker processes gives the same results as scoring serially'
+    src_dir = tempfile.mkdtemp()
+    try:
+        src_paths = []
+        for i in range(6):
+            src_paths.append(os.path.join(src_dir, 'module_%d.py' % i))
+            with open(src_paths[-1], 'w') as fobj:
+                fobj.write('x = 1\n' * i + 'def f():\n' + '    y = 2\n' * (i + 1))
+        # one file that can't be parsed
+        src_paths.append(os.path.join(src_dir, 'broken.py'))
+        with open(src_paths[-1], 'w') as fobj:
+            fobj.write('def (:\n')
+
+        def summarize(results):
+            return dict((src_path, sorted((c.name, c.scores, c.final_score) for c in contestants))
+                for src_path, contestants in results.iteritems())
+
+        with warnings.catch_warnings(record=True):
+            serial = quality.core.run_contest(src_paths, {}, compile('lines * 2', '<formula>', 'eval'), [_count_lines_judge])
+            parallel = quality.core.run_contest(src_paths, {}, compile('lines * 2', '<formula>', 'eval'), [_count_lines_judge], jobs=3)
+
+        assert_equal(6, len(serial))
+        assert_equal(summarize(serial), summarize(parallel))
+        assert_equal([('<module>', {'lines': 5}, 10), ('f', {'lines': 6}, 12)], summarize(parallel)[src_paths[5]])
+    finally:
+        shutil.rmtree(src_dir)
+
+def _make_scored(scores_ls):
+    'make contestant-like objects with the given scores'
+    return [mock.MagicMock(scores=scores, final_score=None) for scores in scores_ls]
+
+def _test_evaluate_formula(formula, scores_ls):
+    'evaluate_formula gives the same final scores, and types, with and without NumPy'
+    formula = compile(formula, '<formula>', 'eval')
+
+    expected = _make_scored(scores_ls)
+    with mock.patch('quality.core.numpy', None):
+        quality.core.evaluate_formula(formula, expected)
+    actual = _make_scored(scores_ls)
+    quality.core.evaluate_formula(formula, actual)
+
+    assert_equal([(type(c.final_score), c.final_score) for c in expected], 
+        [(type(c.final_score), c.final_score) for c in actual])
+
+def test_evaluate_formula():
+    'evaluate_formula: vectorized evaluation matches per-contestant evaluation'
+    scores_ls = [
+        {'crap': 2.0, 'lint': 3, 'tabnanny': 0},
+        {'crap': 12.5, 'lint': 0, 'tabnanny': 1},
+        {'crap': 0.0, 'lint': 7, 'tabnanny': 0},
+    ]
+    formulas = [
+        'crap + lint + 25*tabnanny',
+        'lint / 2',
+        'lint * 2 - tabnanny',
+        'crap ** 2 / (lint + 1)',
+        'abs(-crap)',
+        'max(crap, lint)',
+        'crap if lint else 100',
+        'lint > 2',
+        '42',
+    ]
+    for formula in formulas:
+        yield _test_evaluate_formula, formula, scores_ls
+    # mixed ints and floats from one judge
+    yield _test_evaluate_formula, 'lint + 1', [{'lint': 1}, {'lint': 2.5}]
+
+def test_evaluate_formula_builtins():
+    'evaluate_formula: only offers the formula the builtins it\'s given'
+    for scores_ls in [[{'lint': 1}], [{'lint': 1}, {'lint': 2}]]:
+        contestants = _make_scored(scores_ls)
+        quality.core.evaluate_formula(compile('abs(-lint)', '<formula>', 'eval'), contestants, {'abs': abs})
+        assert_equal([1, 2][:len(contestants)], [c.final_score for c in contestants])
+        with assert_raises(NameError):
+            quality.core.evaluate_formula(compile('abs(-lint)', '<formula>', 'eval'), contestants, {})
+
+def test_evaluate_formula_records():
+    'evaluate_formula: handles ScoreRecords'
+    records = [quality.core.ScoreRecord('a.py', 'f', ('crap', 'lint'), (2.0, 1)),
+        quality.core.ScoreRecord('a.py', 'g', ('crap', 'lint'), (4.5, 3))]
+    quality.core.evaluate_formula(compile('crap + 2*lint', '<formula>', 'eval'), records)
+    assert_equal([4.0, 10.5], [r.final_score for r in records])
+
+def test_evaluate_formula_columns():
+    'evaluate_formula_columns: declines formulas that behave differently on arrays'
+    if quality.core.numpy is None:
+        raise SkipTest('NumPy is not available')
+
+    contestants = _make_scored([{'crap': 2.0, 'lint': 3}, {'crap': 1.0, 'lint': 0}])
+    assert_equal([5.0, 1.0], quality.core.evaluate_formula_columns(compile('crap + lint', '<formula>', 'eval'), contestants))
+    for formula in ['max(crap, lint)', 'sum(lint)', 'crap.real', 'crap / lint', 'crap if lint else 0']:
+        assert_equal(None, quality.core.evaluate_formula_columns(compile(formula, '<formula>', 'eval'), contestants))
+
+    # per-contestant evaluation raises the same error that Python would
+    with assert_raises(ZeroDivisionError):
+        quality.core.evaluate_formula(compile('crap / lint', '<formula>', 'eval'), contestants)
+
+def test_scorerecord():
+    'ScoreRecord: keeps names and scores, and survives pickling'
+    contestant = mock.MagicMock(src_file='src.py', scores={'a': 1, 'b': 2.5}, final_score=3.5)
+    contestant.name = 'C.method'
+    record = quality.core.ScoreRecord.from_contestant(contestant, ('b', 'a'))
+
+    assert_equal(('src.py', 'C.method', (2.5, 1), 3.5), (record.src_file, record.name, record.score_values, record.final_score))
+    assert_equal({'a': 1, 'b': 2.5}, record.scores)
+    assert not hasattr(record, '__dict__')
+
+    for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+        copy = pickle.loads(pickle.dumps(record, protocol))
+        assert_equal(record.__getstate__(), copy.__getstate__())
+        # names are interned again after unpickling
+        assert copy.src_file is intern('src.py')
+
+    # unicode names are kept, rather than interned
+    record = quality.core.ScoreRecord(u'src.py', u'f', ('a',), (1,))
+    assert_equal((u'src.py', u'f'), (record.src_file, record.name))
+    assert_equal(record.__getstate__(), pickle.loads(pickle.dumps(record)).__getstate__())
+
+def test_run_contest_compact():
+    'run_contest: emits ScoreRecords with the same scores as Contestants'
+    src_dir = tempfile.mkdtemp()
+    try:
+        src_path = os.path.join(src_dir, 'module.py')
+        with open(src_path, 'w') as fobj:
+            fobj.write('x = 1\ndef f():\n    y = 2\n    z = 3\n')
+        formula = compile('lines * 2', '<formula>', 'eval')
+
+        full = quality.core.run_contest([src_path], {}, formula, [_count_lines_judge])
+        compact = quality.core.run_contest([src_path], {}, formula, [_count_lines_judge], compact=True)
+
+        assert all(isinstance(i, quality.core.ScoreRecord) for i in compact[src_path])
+        assert_equal([(c.src_file, c.name, c.scores, c.final_score) for c in full[src_path]],
+            [(c.src_file, c.name, c.scores, c.final_score) for c in compact[src_path]])
+
+        # unicode paths work as well as byte strings
+        unicode_path = src_path.decode('ascii')
+        compact = quality.core.run_contest([unicode_path], {}, formula, [_count_lines_judge], compact=True)
+        assert_equal([c.final_score for c in full[src_path]], [c.final_score for c in compact[unicode_path]])
+    finally:
+        shutil.rmtree(src_dir)
+
+def test_run_contest_on_file():
+    'run_contest: hands over each file once its final scores are known'
+    src_dir = tempfile.mkdtemp()
+    try:
+        src_paths = []
+        for i in range(5):
+            src_paths.append(os.path.join(src_dir, 'module_%d.py' % i))
+            with open(src_paths[-1], 'w') as fobj:
+                fobj.write('x = 1\ndef f():\n    y = 2\n' * (i + 1))
+        formula = compile('lines * 2', '<formula>', 'eval')
+        expected = quality.core.run_contest(src_paths, {}, formula, [_count_lines_judge])
+
+        for batch_size in [1, 3, 1000]:
+            reported = []
+            def on_file(src_path, contestants):
+                reported.append((src_path, [(c.name, c.final_score) for c in contestants]))
+
+            with mock.patch('quality.core.FORMULA_BATCH_SIZE', batch_size):
+                results = quality.core.run_contest(src_paths, {}, formula, [_count_lines_judge], 
+                    on_file=on_file, collect_results=False)
+
+            assert_equal({}, results)
+            assert_equal([(src_path, [(c.name, c.final_score) for c in expected[src_path]]) for src_path in src_paths], 
+                reported)
+    finally:
+        shutil.rmtree(src_dir)
+
+def test_run_contest_lazy():
+    'run_contest: starts scoring before a lazy src_paths runs out, in a window at a time'
+    src_dir = tempfile.mkdtemp()
+    try:
+        src_paths = []
+        for i in range(5):
+            src_paths.append(os.path.join(src_dir, 'module_%d.py' % i))
+            with open(src_paths[-1], 'w') as fobj:
+                fobj.write('x = 1\n')
+        formula = compile('lines', '<formula>', 'eval')
+
+        for kwargs in [{}, {'jobs': 2}]:
+            events = []
+            def find_files():
+                for src_path in src_paths:
+                    events.append(('found', src_path))
+                    yield src_path
+            def on_file(src_path, contestants):
+                events.append(('scored', src_path))
+
+            with mock.patch('quality.core.SCORING_WINDOW', 2):
+                with mock.patch('quality.core.FORMULA_BATCH_SIZE', 1):
+                    results = quality.core.run_contest(find_files(), {}, formula, [_count_lines_judge], 
+                        on_file=on_file, **kwargs)
+            assert_equal(src_paths, sorted(results))
+            # the first window is scored once the second has been found, and 
+            # before the third file is found
+            assert events.index(('found', src_paths[3])) < events.index(('scored', src_paths[0]))
+            assert events.index(('scored', src_paths[0])) < events.index(('found', src_paths[4]))
+            assert_equal(set(src_paths), set(src_path for event, src_path in events if event == 'scored'))
+    finally:
+        shutil.rmtree(src_dir)
+
+def test_run_contest_overlap():
+    'run_contest: prefetches each window before the one before it is scored'
+    src_dir = tempfile.mkdtemp()
+    try:
+        src_paths = []
+        for i in range(5):
+            src_paths.append(os.path.join(src_dir, 'module_%d.py' % i))
+            with open(src_paths[-1], 'w') as fobj:
+                fobj.write('x = 1\n')
+        formula = compile('lines', '<formula>', 'eval')
+
+        events = []
+        class PrefetchingJudge(object):
+            _quality_judge_name = 'lines'
+            def __call__(self, contestant):
+                return len(contestant.linenums)
+            def prefetch(self, src_paths):
+                events.append(('prefetched', tuple(src_paths)))
+        def on_file(src_path, contestants):
+            events.append(('scored', src_path))
+
+        with mock.patch('quality.core.SCORING_WINDOW', 2):
+            with mock.patch('quality.core.FORMULA_BATCH_SIZE', 1):
+                quality.core.run_contest(src_paths, {}, formula, [PrefetchingJudge()], on_file=on_file)
+        assert_equal([
+            ('prefetched', tuple(src_paths[0:2])),
+            ('prefetched', tuple(src_paths[2:4])),
+            ('scored', src_paths[0]),
+            ('scored', src_paths[1]),
+            ('prefetched', tuple(src_paths[4:5])),
+            ('scored', src_paths[2]),
+            ('scored', src_paths[3]),
+            ('scored', src_paths[4]),
+        ], events)
+    finally:
+        shutil.rmtree(src_dir)
+
+def test_run_contest_profile():
+    'run_contest: records the same stages for each file, whichever way files are scored'
+    src_dir = tempfile.mkdtemp()
+    try:
+        src_paths = []
+        for i in range(4):
+            src_paths.append(os.path.join(src_dir, 'module_%d.py' % i))
+            with open(src_paths[-1], 'w') as fobj:
+                fobj.write('x = 1\ndef f():\n    y = 2\n')
+        formula = compile('lines * 2', '<formula>', 'eval')
+
+        for kwargs in [{}, {'jobs': 2}]:
+            events = []
+            profile = quality.timing.Profile([events.append])
+            quality.core.run_contest(src_paths, {}, formula, [_count_lines_judge], profile=profile, **kwargs)
+
+            for stage in ['read', 'parse', 'judge:lines']:
+                assert_equal(sorted(src_paths), sorted(event.src_path for event in events if event.stage == stage))
+                assert_equal(len(src_paths), profile.stages[stage][2])
+            assert_equal(1, profile.stages['formula'][2])
+            assert_equal(sorted(src_paths), sorted(profile.files))
+    finally:
+        shutil.rmtree(src_dir)
+
+def test_boundjudge():
+    'BoundJudge: picks out options once, and scores whole files through judge_file where available'
+    per_contestant = mock.MagicMock(side_effect=lambda contestant, factor: contestant * factor, 
+        spec=['__call__', '_quality_judge_name'])
+    per_contestant._quality_judge_name = 'each'
+    per_file = mock.MagicMock(spec=['__call__', '_quality_judge_name', 'judge_file', 'prefetch'])
+    per_file._quality_judge_name = 'file'
+    per_file.judge_file.side_effect = lambda contestants, factor: [i * factor for i in contestants]
+    options = {'each:factor': 2, 'file:factor': 3, 'other:factor': 4}
+
+    with mock.patch('quality.core.extract_judge_kwargs', wraps=quality.core.extract_judge_kwargs) as mock_extract:
+        bound = quality.core.bind_judges([per_contestant, per_file], options)
+        for i in range(3):
+            assert_equal([2, 4], bound[0]([1, 2]))
+            assert_equal([3, 6], bound[1]([1, 2]))
+    assert_equal(2, mock_extract.call_count)
+    assert_equal(0, per_file.call_count)
+    assert_equal(6, per_contestant.call_count)
+
+    bound[0].prefetch(['a.py'])
+    bound[1].prefetch(['a.py'])
+    per_file.prefetch.assert_called_once_with(['a.py'], factor=3)
+
+def test_boundjudge_file_times():
+    'BoundJudge: records the times a judge reports for each file, apart from the rest of its prefetch'
+    judge = mock.MagicMock(spec=['__call__', '_quality_judge_name', 'prefetch', 'pop_file_times'])
+    judge._quality_judge_name = 'lint'
+    judge.pop_file_times.side_effect = [[('a.py', 2.0, 1.0), ('b.py', 3.0, 1.5)], [('c.py', 1.0, 0.5)]]
+    bound = quality.core.BoundJudge(judge, {})
+    events = []
+    profile = quality.timing.Profile([events.append])
+    with mock.patch('timeit.default_timer', side_effect=[10.0, 16.0]):
+        with mock.patch('time.clock', side_effect=[1.0, 4.0]):
+            bound.prefetch(['a.py', 'b.py'], profile)
+    bound.record_file_times(profile)
+
+    assert_equal([
+        quality.timing.TimingEvent('prefetch:lint', 'a.py', 2.0, 1.0),
+        quality.timing.TimingEvent('prefetch:lint', 'b.py', 3.0, 1.5),
+        quality.timing.TimingEvent('prefetch:lint', None, 1.0, 0.5),
+        quality.timing.TimingEvent('prefetch:lint', 'c.py', 1.0, 0.5),
+    ], events)
+    assert_equal({'a.py': 2.0, 'b.py': 3.0, 'c.py': 1.0}, profile.files)
+
+def test_score_file_judge_file():
+    'score_file: gives the same scores whether judges score contestants one at a time or by file'
+    class FileJudge(object):
+        _quality_judge_name = 'lines'
+        def judge_file(self, contestants):
+            return [len(contestant.linenums) for contestant in contestants]
+    src_path = os.path.join(DATA_DIR, 'tabnanny_problems.py')
+
+    for compact in [False, True]:
+        expected = quality.core.score_file(src_path, {}, [_count_lines_judge], compact)
+        actual = quality.core.score_file(src_path, {}, [FileJudge()], compact)
+        assert_equal([(c.name, c.scores) for c in expected], [(c.name, c.scores) for c in actual])
@@ -9,6 +9,10 @@ import mock
 from nose.tools import *
 import os
 import os.path
+import shutil
+import sqlite3
+import StringIO
+import tempfile
 import warnings
 import xml.etree.ElementTree
 
@@ -66,7 +70,7 @@ def _crapjudge_coverage_ratio(expected, hit, miss, contestant_lines):
     j.coverage['foo.py'] = (hit, miss)
     j.unified['foo.py'] = hit | miss
 
-    contestant = mock.MagicMock(linenums=contestant_lines, src_file='foo.py')
+    contestant = mock.MagicMock(linenums=contestant_lines, src_file='foo.py', line_index=None)
 
     assert_equal(expected, j.coverage_ratio(contestant))
     if contestant_lines:
@@ -74,9 +78,9 @@ def _crapjudge_coverage_ratio(expected, hit, miss, contestant_lines):
 
 def _test_crapjudge_cached(mock_complexity_ret, mock_cov_ratio_ret, expected):
     'run one test over CrapJudge.judge_crap, in which coverage data is already cached'
-    mock_node = mock.MagicMock(name='node')
+    mock_node = mock.MagicMock(name='node', complexity=None)
     contestant = mock.MagicMock(spec=quality.core.Contestant, linenums=set([1, 2, 3]), 
-        src_file='foo.py', node=mock_node)
+        src_file='foo.py', node=mock_node, source=None)
     judge = quality.crap.CrapJudge()
 
     # line numbers in the coverage data cache don't matter, just that they exist.
@@ -120,9 +124,9 @@ def _test_crapjudge_uncached(mock_complexity_ret, mock_cov_ratio_ret, expected):
     Yes, this repeats a lot of the code in _test_crapjudge_judge_crap_cached, but
     I'm less opposed to copy-pasta than complication in test fixtures.
     '''
-    mock_node = mock.MagicMock(name='node')
+    mock_node = mock.MagicMock(name='node', complexity=None)
     contestant = mock.MagicMock(spec=quality.core.Contestant, linenums=set([1, 2, 3]), 
-        src_file='foo.py', node=mock_node)
+        src_file='foo.py', node=mock_node, source=None)
     judge = quality.crap.CrapJudge()
 
     # line numbers in the coverage data cache don't matter, just that they exist.
@@ -140,16 +144,38 @@ def _test_crapjudge_uncached(mock_complexity_ret, mock_cov_ratio_ret, expected):
     mock_miss = mock.MagicMock(name='mock_miss')
     mock_hit.__or__ = mock.MagicMock(return_value=mock_union)
 
-    with mock.patch('xml.etree.ElementTree.parse', name='mock_etree_parse') as mock_etree_parse:
+    with mock.patch('quality.crap.iterparse_line_records', name='mock_iterparse') as mock_iterparse:
         with mock.patch('quality.complexity.complexity', return_value=mock_complexity_ret):
-            with mock.patch('quality.crap.extract_line_nums', return_value=(mock_hit, mock_miss)):
+            with mock.patch('quality.crap.CoverageIndex') as mock_index_cls:
+                mock_index_cls.return_value.line_nums.return_value = (mock_hit, mock_miss)
                 assert_equal(expected, judge(contestant, coverage_file='coverage.xml'))
                 quality.complexity.complexity.assert_called_once_with(mock_node)
                 judge.coverage_ratio.assert_called_once_with(contestant)
-                mock_etree_parse.assert_called_once_with('coverage.xml')
+                mock_iterparse.assert_called_once_with('coverage.xml')
+                mock_index_cls.assert_called_once_with(mock_iterparse.return_value, 'coverage.xml')
+                mock_index_cls.return_value.line_nums.assert_called_once_with('foo.py', None)
                 assert_equal((mock_hit, mock_miss), judge.coverage['foo.py'])
                 assert_equal(mock_union, judge.unified['foo.py'])
 
+                # a second, uncached source file should reuse the index rather than re-parse
+                other = mock.MagicMock(spec=quality.core.Contestant, linenums=set([1]), 
+                    src_file='baz.py', node=mock_node, source=None)
+                judge(other, coverage_file='coverage.xml')
+                mock_iterparse.assert_called_once_with('coverage.xml')
+                assert_equal(1, mock_index_cls.call_count)
+
+def test_crapjudge_precomputed_complexity():
+    'CrapJudge.judge_crap: uses complexity already computed by quality.core.annotate'
+    contestant = mock.MagicMock(spec=quality.core.Contestant, linenums=set([1, 2, 3]), 
+        src_file='foo.py', node=mock.MagicMock(name='node', complexity=4), source=None)
+    judge = quality.crap.CrapJudge()
+    judge.coverage = {'foo.py': (set([1, 2, 3]), set())}
+    judge.unified = {'foo.py': set([1, 2, 3])}
+    judge.coverage_ratio = mock.MagicMock(return_value=0.5)
+
+    with mock.patch('quality.complexity.complexity', side_effect=Exception('complexity should not be recalculated')):
+        assert_equal(12, judge(contestant, coverage_file='coverage.xml'))
+
 def test_crapjudge_uncached():
     'CrapJudge.judge_crap: populates coverage data cache and calculates scores'
     args_ls = [
@@ -161,13 +187,7 @@ def test_crapjudge_uncached():
     for args in args_ls:
         yield (_test_crapjudge_uncached,) + args
 
-def _test_find_class_elem(doc, source_path, coverage_file, expected_elem_name):
-    actual = quality.crap.find_class_elem(doc, source_path, coverage_file)
-    assert_equal(actual.get('name'), expected_elem_name)
-
-def test_find_class_elem():
-    'find_class_elem: identifies the correct <class> element using either relative and absolute paths'
-    doc = xml.etree.ElementTree.ElementTree(element=xml.etree.ElementTree.fromstring('''<?xml version="1.0" ?>
+COVERAGE_XML = '''<?xml version="1.0" ?>
 <!DOCTYPE coverage
   SYSTEM 'http://cobertura.sourceforge.net/xml/coverage-03.dtd'>
 <coverage>
@@ -185,7 +205,15 @@ def test_find_class_elem():
             </classes>
         </package>
     </packages>
-</coverage>'''))
+</coverage>'''
+
+def _test_find_class_elem(doc, source_path, coverage_file, expected_elem_name):
+    actual = quality.crap.find_class_elem(doc, source_path, coverage_file)
+    assert_equal(actual.get('name'), expected_elem_name)
+
+def test_find_class_elem():
+    'find_class_elem: identifies the correct <class> element using either relative and absolute paths'
+    doc = xml.etree.ElementTree.ElementTree(element=xml.etree.ElementTree.fromstring(COVERAGE_XML))
 
     args_ls = [
         # absolute paths should work
@@ -240,3 +268,286 @@ def test_extract_line_nums():
     with warnings.catch_warnings(record=True) as warnings_context:
         assert_equal((set(), cur_file_lines), quality.crap.extract_line_nums(doc, cur_file, 'coverage.xml'))
         assert 'Could not find coverage data for source file' in str(warnings_context[-1].message)
+
+COVERAGE_LINES_XML = '''<?xml version="1.0" ?>
+<coverage>
+    <packages>
+        <package>
+            <classes>
+                <class filename="/tmp/something_a.py" name="something_a">
+                    <methods/>
+                    <lines>
+                        <line hits="1" number="1"/>
+                        <line hits="0" number="2"/>
+                        <line hits="1" number="4"/>
+                    </lines>
+                </class>
+                <class filename="src/something_d.py" name="something_d">
+                    <methods/>
+                    <lines>
+                        <line hits="0" number="3"/>
+                    </lines>
+                </class>
+            </classes>
+        </package>
+    </packages>
+</coverage>'''
+
+def _test_coverageindex(index, source_path, expected):
+    assert_equal(expected, index.line_nums(source_path))
+
+def test_coverageindex():
+    'CoverageIndex: aligns paths like find_class_elem and splits hit and missed lines'
+    doc = xml.etree.ElementTree.ElementTree(element=xml.etree.ElementTree.fromstring(COVERAGE_LINES_XML))
+
+    args_ls = [
+        ('/tmp/something_a.py', 'coverage.xml', (set([1, 4]), set([2]))),
+        ('/tmp/something_a.py', '/somewhere/else/coverage.xml', (set([1, 4]), set([2]))),
+        ('src/something_d.py', 'coverage.xml', (set(), set([3]))),
+        ('./src/something_d.py', './coverage.xml', (set(), set([3]))),
+        ('other/src/something_d.py', 'other/coverage.xml', (set(), set([3]))),
+    ]
+    for source_path, coverage_file, expected in args_ls:
+        yield _test_coverageindex, quality.crap.CoverageIndex(quality.crap.gen_line_records(doc), coverage_file), source_path, expected
+
+    # missing files fall back to treating every line as missed, like extract_line_nums
+    cur_file = os.path.abspath(__file__.replace('.pyc', '.py'))
+    cur_file_lines = frozenset([num for num, l in enumerate(open(cur_file).readlines())])
+    with warnings.catch_warnings(record=True) as warnings_context:
+        warnings.simplefilter('always')
+        assert_equal((set(), cur_file_lines), quality.crap.CoverageIndex([], 'coverage.xml').line_nums(cur_file))
+        assert 'Could not find coverage data for source file' in str(warnings_context[-1].message)
+
+    # source_paths limits which files are kept
+    index = quality.crap.CoverageIndex(quality.crap.gen_line_records(doc), 'coverage.xml', source_paths=['src/something_d.py'])
+    assert_equal([os.path.abspath('src/something_d.py')], index.keys())
+
+def test_iterparse_line_records():
+    'iterparse_line_records: streams the same records as gen_line_records'
+    doc = xml.etree.ElementTree.ElementTree(element=xml.etree.ElementTree.fromstring(COVERAGE_LINES_XML))
+    expected = list(quality.crap.gen_line_records(doc))
+    actual = list(quality.crap.iterparse_line_records(StringIO.StringIO(COVERAGE_LINES_XML)))
+    assert_equal(expected, actual)
+    assert_equal(('/tmp/something_a.py', set([1, 4]), set([2])), actual[0])
+
+def test_crapjudge_coverage_ratio_line_index():
+    'CrapJudge.coverage_ratio: gives the same ratios with a LineIndex as without'
+    source = 'def f(x):\n    if x:\n        return 1\n    return 2\n\nclass C(object):\n    y = 1\n'
+    contestants = quality.core.annotate(ast.parse(source), 'foo.py')
+    judge = quality.crap.CrapJudge()
+    judge.coverage['foo.py'] = (set([1, 2, 4, 6]), set([3, 7]))
+    judge.unified['foo.py'] = set([1, 2, 3, 4, 6, 7])
+
+    with_index = [judge.coverage_ratio(contestant) for contestant in contestants]
+    for contestant in contestants:
+        contestant.line_index = None
+    assert_equal([judge.coverage_ratio(contestant) for contestant in contestants], with_index)
+    assert_equal([1.0, 2.0 / 3, 0.0], with_index)
+
+def test_crapjudge_forget():
+    'CrapJudge.forget: drops coverage data for one file, or all of it, along with the index'
+    judge = quality.crap.CrapJudge()
+    judge.index = quality.crap.CoverageIndex([('foo.py', set([1]), set([2])), ('bar.py', set([3]), set())], 'coverage.xml')
+    judge.load_coverage('foo.py', 'coverage.xml')
+    judge.load_coverage('bar.py', 'coverage.xml')
+    judge._last_buckets = 'stale'
+
+    judge.forget('foo.py')
+    assert_equal(['bar.py'], judge.coverage.keys())
+    assert_equal(['bar.py'], judge.unified.keys())
+    assert_equal(None, judge._last_buckets)
+    assert judge.index is not None
+
+    judge.forget()
+    assert_equal({}, judge.coverage)
+    assert_equal({}, judge.unified)
+    assert_equal(None, judge.index)
+
+def test_crapjudge_judge_file():
+    'CrapJudge.judge_file: gives the same scores as judging each contestant'
+    source = 'def f(x):\n    if x:\n        return 1\n    return 2\n\nclass C(object):\n    y = 1\n'
+    contestants = quality.core.annotate(ast.parse(source), 'foo.py')
+    for contestant in contestants:
+        contestant.source = None
+    judge = quality.crap.CrapJudge()
+    judge.index = quality.crap.CoverageIndex([('foo.py', set([1, 2, 4, 6]), set([3, 7]))], 'coverage.xml')
+
+    with mock.patch.object(judge, 'load_coverage', wraps=judge.load_coverage) as mock_load:
+        scores = judge.judge_file(contestants, coverage_file='coverage.xml')
+    mock_load.assert_called_once_with('foo.py', 'coverage.xml', None)
+    assert_equal([judge(contestant, coverage_file='coverage.xml') for contestant in contestants], scores)
+    assert_equal([], judge.judge_file([]))
+
+# exercises coverage.py's rules for statements: the comment makes the module
+# docstring a statement, a default argument makes line 6 part of the `def`,
+# and the `if` block is excluded
+COVERAGE_DATA_SOURCE = '''# a comment
+\'\'\'Docstring.\'\'\'
+import os
+
+def f(x,
+      y=None):
+    'Doc'
+    global z
+    total = (x +
+             1)
+    if x:  # pragma: no cover
+        return 1
+    return total
+
+@staticmethod
+def g():
+    pass
+'''
+
+# the lines coverage.py records as executed by f(0), and its report of them
+COVERAGE_DATA_EXECUTED = [2, 3, 6, 9, 10, 11, 13, 15]
+COVERAGE_DATA_EXPECTED = (set([2, 3, 5, 9, 13, 15]), set([17]))
+
+def _numbits(line_nums):
+    'encode line numbers as a coverage.py numbits blob'
+    numbits = bytearray(max(line_nums) // 8 + 1)
+    for line_num in line_nums:
+        numbits[line_num // 8] |= 1 << (line_num % 8)
+    return sqlite3.Binary(str(numbits))
+
+def _write_coverage_data(data_path, executed, arcs=False):
+    '''
+    write a minimal coverage.py data file; `executed` maps paths to lists of
+    executed lines, or of arcs if `arcs` is set
+    '''
+    connection = sqlite3.connect(data_path)
+    connection.executescript('''
+        CREATE TABLE meta (key text, value text, unique (key));
+        CREATE TABLE file (id integer primary key, path text, unique (path));
+        CREATE TABLE context (id integer primary key, context text, unique (context));
+        CREATE TABLE line_bits (file_id integer, context_id integer, numbits blob, unique (file_id, context_id));
+        CREATE TABLE arc (file_id integer, context_id integer, fromno integer, tono integer,
+            unique (file_id, context_id, fromno, tono));
+        INSERT INTO context VALUES (1, '');
+        INSERT INTO context VALUES (2, 'test');
+    ''')
+    connection.execute('INSERT INTO meta VALUES (?, ?)', ('has_arcs', '1' if arcs else '0'))
+    for file_id, (path, lines) in enumerate(sorted(executed.items()), 1):
+        connection.execute('INSERT INTO file VALUES (?, ?)', (file_id, path))
+        if arcs:
+            connection.executemany('INSERT INTO arc VALUES (?, 1, ?, ?)', 
+                [(file_id, from_num, to_num) for from_num, to_num in lines])
+        elif lines:
+            # split between two contexts, which must be combined
+            for context_id, context_lines in ((1, lines[::2]), (2, lines[1::2])):
+                if context_lines:
+                    connection.execute('INSERT INTO line_bits VALUES (?, ?, ?)', 
+                        (file_id, context_id, _numbits(context_lines)))
+    connection.commit()
+    connection.close()
+
+def test_numbits_to_lines():
+    'numbits_to_lines: decodes each set bit as a line number'
+    assert_equal([], quality.crap.numbits_to_lines(''))
+    assert_equal([1, 7, 8, 17], quality.crap.numbits_to_lines(_numbits([1, 7, 8, 17])))
+
+def test_statement_lines():
+    'statement_lines: finds statements as coverage.py does, with the first line of each multi-line statement'
+    lines = COVERAGE_DATA_SOURCE.splitlines(True)
+    statements, first_lines = quality.crap.statement_lines(ast.parse(COVERAGE_DATA_SOURCE), lines)
+    assert_equal(set([2, 3, 5, 9, 13, 15, 17]), statements)
+    assert_equal({5: 5, 6: 5, 9: 9, 10: 9}, first_lines)
+
+    # a missing final newline still ends the last statement
+    source = 'x = [\n    1,\n]'
+    assert_equal((set([1]), {1: 1, 2: 1, 3: 1}), quality.crap.statement_lines(ast.parse(source), source.splitlines(True)))
+    assert_equal((set(), {}), quality.crap.statement_lines(ast.parse('# nothing\n'), ['# nothing\n']))
+
+def test_sqlitecoverageindex():
+    'SqliteCoverageIndex: aligns paths like find_class_elem and reports statements like coverage.xml'
+    root = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(root, 'src'))
+        src_path = os.path.join(root, 'src', 'mod.py')
+        other_path = os.path.join(root, 'other.py')
+        for path in (src_path, other_path):
+            with open(path, 'w') as fobj:
+                fobj.write(COVERAGE_DATA_SOURCE)
+
+        for arcs in (False, True):
+            data_path = os.path.join(root, '.coverage')
+            executed = COVERAGE_DATA_EXECUTED
+            if arcs:
+                executed = [(-1, 2)] + zip(executed, executed[1:]) + [(15, -1)]
+            # one path relative to the data file's directory, one absolute
+            _write_coverage_data(data_path, {'src/mod.py': executed, other_path: []}, arcs=arcs)
+
+            index = quality.crap.SqliteCoverageIndex(data_path)
+            assert_equal(arcs, index.has_arcs)
+            assert_equal(COVERAGE_DATA_EXPECTED, index.line_nums(src_path))
+            assert_equal(COVERAGE_DATA_EXPECTED, index.line_nums(os.path.relpath(src_path)))
+            assert_equal(COVERAGE_DATA_EXPECTED, quality.crap.SqliteCoverageIndex(os.path.relpath(data_path)).line_nums(src_path))
+            assert_equal((set(), set([2, 3, 5, 9, 13, 15, 17])), index.line_nums(other_path))
+
+            source = quality.core.SourceFile(src_path)
+            source.tree, source.lines
+            with mock.patch('__builtin__.open', side_effect=AssertionError('the source should not be read again')):
+                assert_equal(COVERAGE_DATA_EXPECTED, index.line_nums(src_path, source))
+            os.remove(data_path)
+
+        # missing files fall back to treating every line as missed, like CoverageIndex
+        with warnings.catch_warnings(record=True) as warnings_context:
+            warnings.simplefilter('always')
+            hit, missed = index.line_nums(os.path.join(root, 'missing.py'), source)
+            assert_equal((frozenset(), frozenset(range(17))), (hit, missed))
+            assert 'Could not find coverage data for source file' in str(warnings_context[-1].message)
+    finally:
+        shutil.rmtree(root)
+
+def test_load_coverage_index():
+    'load_coverage_index: reads coverage.py\'s data file or coverage.xml, whichever it\'s given'
+    root = tempfile.mkdtemp()
+    try:
+        data_path = os.path.join(root, '.coverage')
+        _write_coverage_data(data_path, {'mod.py': [1]})
+        xml_path = os.path.join(root, 'coverage.xml')
+        with open(xml_path, 'w') as fobj:
+            fobj.write(COVERAGE_LINES_XML)
+
+        assert quality.crap.is_sqlite_file(data_path)
+        assert not quality.crap.is_sqlite_file(xml_path)
+        assert not quality.crap.is_sqlite_file(os.path.join(root, 'missing'))
+        assert isinstance(quality.crap.load_coverage_index(data_path), quality.crap.SqliteCoverageIndex)
+        assert isinstance(quality.crap.load_coverage_index(xml_path), quality.crap.CoverageIndex)
+        with open(data_path, 'rb') as fobj:
+            assert isinstance(quality.crap.load_coverage_index(fobj), quality.crap.SqliteCoverageIndex)
+            assert_equal(0, fobj.tell())
+
+        # other SQLite databases are rejected
+        os.remove(data_path)
+        connection = sqlite3.connect(data_path)
+        connection.execute('CREATE TABLE other (x integer)')
+        connection.close()
+        with assert_raises(ValueError):
+            quality.crap.SqliteCoverageIndex(data_path)
+    finally:
+        shutil.rmtree(root)
+
+def test_crapjudge_sqlite_coverage():
+    'CrapJudge: loads coverage from coverage.py\'s data file'
+    root = tempfile.mkdtemp()
+    try:
+        src_path = os.path.join(root, 'mod.py')
+        with open(src_path, 'w') as fobj:
+            fobj.write(COVERAGE_DATA_SOURCE)
+        data_path = os.path.join(root, '.coverage')
+        _write_coverage_data(data_path, {'mod.py': COVERAGE_DATA_EXECUTED})
+
+        judge = quality.crap.CrapJudge()
+        judge.load_coverage(src_path, data_path)
+        assert isinstance(judge.index, quality.crap.SqliteCoverageIndex)
+        assert_equal(COVERAGE_DATA_EXPECTED, judge.coverage[src_path])
+
+        # the same scores as from the equivalent coverage.xml
+        xml_judge = quality.crap.CrapJudge()
+        xml_judge.index = quality.crap.CoverageIndex([(src_path,) + COVERAGE_DATA_EXPECTED], 'coverage.xml')
+        assert_equal(xml_judge.judge_file(quality.core.parse_file(src_path), coverage_file='coverage.xml'),
+            judge.judge_file(quality.core.parse_file(src_path), coverage_file=data_path))
+    finally:
+        shutil.rmtree(root)
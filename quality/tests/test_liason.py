@@ -5,9 +5,9 @@ import quality.tests.compat # must come before import nose.tools
 
 import mock
 from nose.tools import *
-import os
 import StringIO
 import sys
+import threading
 
 def test_patchcontext():
     orig = mock.MagicMock(name='sub')
@@ -46,31 +46,50 @@ def test_capture_output():
     # ensure everything still works when nothing is written
     assert_equal('', noop().getvalue())
 
-def test_filteredfileproxy():
-    'FilteredFileProxy: prevents writing certain strings'
-    buf = StringIO.StringIO()
-    p = quality.liason.FilteredFileProxy(buf, 'Pintsize')
-    p.write('Marten\n')
-    p.write('Pintsize\n')
-    assert 'Pintsize' not in buf.getvalue()
-    p.writelines(['Hannelore\n', 'Faye\n', 'Pintsize\n', 'Dora\n'])
-    assert 'Pintsize' not in buf.getvalue()
-
-    # try again without newlines
-    p = quality.liason.FilteredFileProxy(buf, 'Pintsize')
-    p.write('Marten')
-    p.write('Pintsize')
-    assert 'Pintsize' not in buf.getvalue()
-    p.writelines(['Hannelore', 'Faye', 'Pintsize', 'Dora'])
-    assert 'Pintsize' not in buf.getvalue()
-
-    # proxying should allow normal methods to work
-    p.seek(0, os.SEEK_END)
-    assert_equal(p.tell(), len(buf.getvalue()))
-
-    # proxying should not break normal errors
-    with assert_raises(AttributeError):
-        p.non_existent()
+def test_redirectcontext():
+    'RedirectContext: redirects only the current thread, nests, and restores the original stream'
+    orig = sys.stdout
+    outer = StringIO.StringIO()
+    inner = StringIO.StringIO()
+    with quality.liason.RedirectContext('stdout', outer):
+        print 'outer', 1
+        with quality.liason.RedirectContext('stdout', inner):
+            print 'inner'
+        sys.stdout.write('outer again\n')
+    assert sys.stdout is orig
+    assert_equal('outer 1\nouter again\n', outer.getvalue())
+    assert_equal('inner\n', inner.getvalue())
+
+def test_capture_output_threads():
+    'capture_output: captures output separately for each of several threads'
+    ready = []
+    condition = threading.Condition()
+    thread_count = 4
+
+    @quality.liason.capture_output
+    def writer(name):
+        # wait until every thread is capturing before anyone writes
+        with condition:
+            ready.append(name)
+            condition.notify_all()
+            while len(ready) < thread_count:
+                condition.wait()
+        for i in range(100):
+            print name,
+            sys.stdout.write('')
+
+    results = {}
+    def run(name):
+        results[name] = writer(name).getvalue()
+    threads = [threading.Thread(target=run, args=('thread%d' % i,)) for i in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for name, output in results.iteritems():
+        assert_equal(' '.join([name] * 100), output)
+    assert_equal(thread_count, len(results))
 
 def test_outputcollectingjudge_keydefaultdict():
     'OutputCollectingJudge: still behaves like a defaultdict, but provides the key to default_factory'
@@ -94,6 +113,23 @@ def test_outputcollectingjudge_keydefaultdict():
     assert_equal(1, factory.call_args_list.count(mock.call(2)))
     assert_equal(1, factory.call_args_list.count(mock.call(4)))
 
+def test_outputcollectingjudge_forget():
+    'OutputCollectingJudge.forget: drops output for one file, or all of them'
+    factory = mock.MagicMock(side_effect=lambda x: x.upper())
+    d = quality.liason.OutputCollectingJudge('bogus', factory)
+    d['a.py'], d['b.py']
+    d._last_buckets = 'stale'
+
+    d.forget('a.py')
+    assert_equal(['b.py'], d.keys())
+    assert_equal(None, d._last_buckets)
+    assert_equal('A.PY', d['a.py'])
+    assert_equal(3, factory.call_count)
+
+    d.forget('never.py')
+    d.forget()
+    assert_equal({}, d)
+
 def test_outputcollectingjudge_call():
     'OutputCollectingJudge: base implementation of __call__ raises NotImplementedError'
     with assert_raises(NotImplementedError):
@@ -2,19 +2,206 @@
 
 from __future__ import absolute_import
 
+import quality.core
 import quality.lint
 import quality.tests.compat # must come before import nose.tools
 
+import ast
+import mock
+import multiprocessing
+import os
 import os.path
 from nose.tools import *
+import shutil
+import tempfile
+import warnings
 
 PROB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tabnanny_problems.py')
+THIS_FILE = os.path.abspath(__file__.replace('.pyc', '.py'))
 
 def test_run_pylint():
-    output = quality.lint.run_pylint(PROB_FILE)
-    for line in output:
-        if 'Found indentation with tabs instead of spaces' in line:
-            break
-    else:
-        assert False, 'Did not find expected message in pylint output'
+    'run_pylint: reports the line and category of each message'
+    messages = quality.lint.run_pylint(PROB_FILE)
+    # mixed-indentation, for the tab on line 5
+    assert (5, 'W') in messages
+    for line, category in messages:
+        assert isinstance(line, int)
+        assert category in quality.lint.SCORE_MAP
 
+def test_run_pylint_batch():
+    'run_pylint_batch: splits one pylint run into the same messages as separate runs'
+    src_files = [PROB_FILE, THIS_FILE]
+    outputs = quality.lint.run_pylint_batch(src_files)
+    assert_equal(set(src_files), set(outputs.keys()))
+    for src_file in src_files:
+        assert_equal(quality.lint.run_pylint(src_file), outputs[src_file])
+
+def test_run_pylint_batch_times():
+    'run_pylint_batch: times each module, whether linted in one run or one at a time'
+    src_files = [PROB_FILE, THIS_FILE]
+    times = {}
+    quality.lint.run_pylint_batch(src_files, times)
+    assert_equal(sorted(src_files), sorted(times))
+    assert all(wall > 0 for wall, cpu in times.values())
+
+    times = {}
+    with mock.patch('quality.lint.QuietRun', side_effect=Exception):
+        with mock.patch('quality.lint.run_pylint', return_value=[]):
+            quality.lint.run_pylint_batch(src_files, times)
+    assert_equal(sorted(src_files), sorted(times))
+
+def test_run_pylint_batch_changed():
+    'run_pylint_batch: lints the current contents of files that were linted before, in the same process'
+    src_dir = tempfile.mkdtemp()
+    try:
+        src_path = os.path.join(src_dir, 'changing.py')
+        with open(src_path, 'w') as fobj:
+            fobj.write('\'a module\'\n')
+        assert_equal([], quality.lint.run_pylint_batch([src_path])[src_path])
+
+        with open(src_path, 'w') as fobj:
+            fobj.write('\'a module\'\nprint undefined_name\n')
+        assert (2, 'E') in quality.lint.run_pylint_batch([src_path])[src_path]
+    finally:
+        shutil.rmtree(src_dir)
+
+def test_lintjudge():
+    'LintJudge: sums the weights of messages within each contestant'
+    judge = quality.lint.LintJudge()
+    judge['a.py'] = [(1, 'C'), (3, 'W'), (3, 'E'), (7, 'R')]
+    contestant = mock.MagicMock(src_file='a.py', linenums=set([2, 3, 4]), line_index=None)
+    assert_equal(12, judge(contestant))
+    contestant.linenums = set([5, 6])
+    assert_equal(0, judge(contestant))
+
+def test_lintjudge_cache_key():
+    'LintJudge.cache_key: changes with the pylintrc, its contents and the options'
+    judge = quality.lint.LintJudge()
+    rc_dir = tempfile.mkdtemp()
+    try:
+        rc_path = os.path.join(rc_dir, 'pylintrc')
+        with open(rc_path, 'w') as fobj:
+            fobj.write('[MESSAGES CONTROL]\ndisable=C\n')
+        with mock.patch('pylint.config.PYLINTRC', None):
+            no_rcfile = judge.cache_key('a.py')
+        with mock.patch('pylint.config.PYLINTRC', rc_path):
+            key = judge.cache_key('a.py')
+            assert_equal(key, judge.cache_key('b.py'))
+            with open(rc_path, 'w') as fobj:
+                fobj.write('[MESSAGES CONTROL]\ndisable=R\n')
+            keys = [no_rcfile, key, judge.cache_key('a.py'), judge.cache_key('a.py', jobs=2)]
+        assert_equal(len(keys), len(set(repr(i) for i in keys)))
+    finally:
+        shutil.rmtree(rc_dir)
+
+def test_lintjudge_prefetch():
+    'LintJudge.prefetch: lints files in batches, and skips files already linted'
+    judge = quality.lint.LintJudge(batch_size=2)
+    judge[THIS_FILE] = 'already linted'
+    with mock.patch('quality.lint.run_pylint_batch', side_effect=lambda src_files, times: dict((i, i) for i in src_files)) as mock_batch:
+        judge.prefetch([THIS_FILE, 'a.py', 'b.py', 'c.py'])
+
+    assert_equal([mock.call(['a.py', 'b.py'], judge.file_times), mock.call(['c.py'], judge.file_times)], 
+        mock_batch.call_args_list)
+    assert_equal('already linted', judge[THIS_FILE])
+    assert_equal('c.py', judge['c.py'])
+
+def test_lintjudge_line_index():
+    'LintJudge: gives the same scores with a LineIndex as without'
+    contestants = quality.core.annotate(ast.parse(open(PROB_FILE).read()), PROB_FILE)
+    judge = quality.lint.LintJudge()
+    judge[PROB_FILE] = [(line, category) for line in range(20) for category in 'CWE']
+    with_index = [judge(contestant) for contestant in contestants]
+    for contestant in contestants:
+        contestant.line_index = None
+    assert_equal([judge(contestant) for contestant in contestants], with_index)
+    assert any(with_index)
+
+def test_lintjudge_prefetch_workers():
+    'LintJudge.prefetch: worker processes give the same messages, and are kept between calls'
+    judge = quality.lint.LintJudge()
+    try:
+        judge.prefetch([PROB_FILE], jobs=2, recycle_after=1)
+        pool = judge.pool
+        judge.prefetch([PROB_FILE, THIS_FILE], jobs=2, recycle_after=1)
+        assert pool is judge.pool
+        assert_equal(quality.lint.run_pylint(PROB_FILE), judge[PROB_FILE])
+        assert_equal(quality.lint.run_pylint(THIS_FILE), judge[THIS_FILE])
+    finally:
+        judge.close()
+    assert_equal(None, judge.pool)
+
+def test_lintjudge_collect():
+    'LintJudge.collect: stores batches as they come back from the workers, until the file asked for is in'
+    judge = quality.lint.LintJudge(batch_size=1)
+    mock_pool = mock.MagicMock(name='pool')
+    mock_pool.imap_unordered.return_value.next.side_effect = [({'b.py': [(1, 'C')]}, {'b.py': (2.0, 1.0)}), 
+        ({'a.py': []}, {'a.py': (1.0, 0.5)})]
+    with mock.patch('multiprocessing.Pool', return_value=mock_pool):
+        judge.prefetch(['a.py', 'b.py', 'c.py'], jobs=2)
+        assert judge.is_pending('a.py')
+        # files on their way back aren't handed out again
+        judge.prefetch(['a.py', 'd.py'], jobs=2)
+    assert_equal([['d.py']], mock_pool.imap_unordered.call_args[0][1])
+
+    with mock.patch('quality.lint.run_pylint', side_effect=AssertionError):
+        assert_equal([], judge['a.py'])
+    assert_equal([(1, 'C')], judge['b.py'])
+    assert judge.is_pending('c.py')
+    assert_equal([('a.py', 1.0, 0.5), ('b.py', 2.0, 1.0)], judge.pop_file_times())
+    assert_equal([], judge.pop_file_times())
+
+    # forgetting a file means waiting for every batch first, so none of them
+    # can bring back old messages later
+    mock_pool.imap_unordered.return_value.next.side_effect = [({'c.py': []}, {}), ({'d.py': []}, {})]
+    judge.forget('c.py')
+    assert not judge.is_pending('d.py')
+    assert 'c.py' not in judge
+    assert_equal([], judge.pending)
+
+def test_lintjudge_prefetch_timeout():
+    'LintJudge.prefetch: lints files in this process when workers take too long'
+    judge = quality.lint.LintJudge()
+    mock_pool = mock.MagicMock(name='pool')
+    mock_pool.imap_unordered.return_value.next.side_effect = multiprocessing.TimeoutError
+    with mock.patch('multiprocessing.Pool', return_value=mock_pool):
+        with mock.patch('quality.lint.run_pylint_batch', side_effect=lambda src_files, times=None: dict((i, [(1, 'C')]) for i in src_files)):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                judge.prefetch(['a.py', 'b.py'], jobs=2, timeout=1)
+                # workers are only waited for once their messages are needed
+                assert not mock_pool.imap_unordered.return_value.next.called
+                assert_equal([(1, 'C')], judge['a.py'])
+
+    mock_pool.imap_unordered.return_value.next.assert_called_once_with(1)
+    mock_pool.terminate.assert_called_once_with()
+    assert_equal(1, len(caught))
+    assert_equal([(1, 'C')], judge['b.py'])
+
+def _die_in_worker(src_files):
+    'a pylint worker that dies, taking its batch with it'
+    os._exit(9)
+
+def test_lintjudge_prefetch_dead_worker():
+    'LintJudge.prefetch: gives up on a worker that dies, and lints its files in this process'
+    judge = quality.lint.LintJudge()
+    try:
+        with mock.patch('quality.lint._lint_in_worker', _die_in_worker):
+            with mock.patch('quality.lint.run_pylint_batch', side_effect=lambda src_files, times=None: dict((i, [(1, 'C')]) for i in src_files)):
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always')
+                    judge.prefetch(['a.py', 'b.py'], jobs=2, timeout=1)
+                    judge.collect()
+    finally:
+        judge.close()
+    assert 'Timed out waiting for pylint worker processes' in str(caught[-1].message)
+    assert_equal([(1, 'C')], judge['a.py'])
+    assert_equal([(1, 'C')], judge['b.py'])
+
+    # there's a limit on waiting even when no timeout is given
+    mock_pool = mock.MagicMock(name='pool')
+    mock_pool.imap_unordered.return_value.next.return_value = ({'c.py': []}, {})
+    with mock.patch('multiprocessing.Pool', return_value=mock_pool):
+        judge.prefetch(['c.py'], jobs=2)
+        judge.collect()
+    mock_pool.imap_unordered.return_value.next.assert_called_once_with(quality.lint.WORKER_TIMEOUT)
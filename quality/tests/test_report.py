@@ -4,11 +4,17 @@ from __future__ import absolute_import
 
 import quality.tests.compat # must come before import nose.tools
 
+import json
 import math
 import mock
 from nose.tools import *
+import os
+import shutil
+import sqlite3
 import StringIO
+import tempfile
 
+import quality.core
 import quality.report
 
 def _test_ordered_scores(scores, judge_names, expected):
@@ -66,6 +72,8 @@ abc  3.142
     ]
     for args in args_ls:
         yield (_test_write_minimal_columns,) + args
+        # charts may also be generators
+        yield _test_write_minimal_columns, (row for row in args[0]), args[1]
 
 def test_print_report():
     'print_report: builds and sorts data necessary for write_minimal_columns'
@@ -86,20 +94,11 @@ def test_print_report():
     contestant2 = make_contestant('function_b', 8, 2.2, 8)
     contestant3 = make_contestant('function_c', 12, 4.1, 7)
 
-    # problem: either wibbyness or wobblyness will show up in the chart first, 
-    # depending on the order returned by the first contestant's keys()
-    # this approach isn't very DRY; maybe there's a better way?
-    names = contestant1.scores.keys()
     expected = [
         ['File', 'Item', 'wibblyness', 'wobblyness', 'Final'],
         ['file1.py', 'function_b', 8, 2.2, 8],
         ['file2.py', 'function_c', 12, 4.1, 7], # function C should get sorted between A and B
         ['file1.py', 'function_a', 4, 2.0, 6],
-    ] if names[0] == 'wibblyness' else [
-        ['File', 'Item', 'wobblyness', 'wibblyness', 'Final'],
-        ['file1.py', 'function_b', 2.2, 8, 8],
-        ['file2.py', 'function_c', 4.1, 12, 7],
-        ['file1.py', 'function_a', 2.0, 4, 6],
     ]
     
     results = {
@@ -116,4 +115,113 @@ def test_print_report():
         with mock.patch('quality.report.write_minimal_columns') as mock_write_minimal_columns:
             quality.report.print_report(results)
 
-    mock_write_minimal_columns.assert_called_once_with(expected, mock_stdout)
\ No newline at end of file
+    assert_chart_written(mock_write_minimal_columns, expected, mock_stdout)
+
+    # only the highest scores, in order
+    with mock.patch('sys.stdout') as mock_stdout:
+        with mock.patch('quality.report.write_minimal_columns') as mock_write_minimal_columns:
+            quality.report.print_report(results, top=2)
+
+    assert_chart_written(mock_write_minimal_columns, expected[:3], mock_stdout)
+
+def assert_chart_written(mock_write_minimal_columns, expected, output):
+    'check that write_minimal_columns was called once, with a chart holding `expected`'
+    assert_equal(1, mock_write_minimal_columns.call_count)
+    chart, actual_output = mock_write_minimal_columns.call_args[0]
+    assert_equal(expected, list(chart))
+    assert_equal(output, actual_output)
+
+def test_print_report_records():
+    'print_report: works with ScoreRecords'
+    judge_names = ('wobblyness', 'wibblyness')
+    results = {
+        'file1.py': [quality.core.ScoreRecord('file1.py', 'function_a', judge_names, (2.0, 4), 6)],
+        'file2.py': [quality.core.ScoreRecord('file2.py', 'function_c', judge_names, (4.1, 12), 7)],
+    }
+    with mock.patch('sys.stdout') as mock_stdout:
+        with mock.patch('quality.report.write_minimal_columns') as mock_write_minimal_columns:
+            quality.report.print_report(results)
+
+    assert_chart_written(mock_write_minimal_columns, [
+        ['File', 'Item', 'wibblyness', 'wobblyness', 'Final'],
+        ['file2.py', 'function_c', 12, 4.1, 7],
+        ['file1.py', 'function_a', 4, 2.0, 6],
+    ], mock_stdout)
+
+STREAMED_RESULTS = [
+    ('file1.py', [quality.core.ScoreRecord('file1.py', 'function_a', ('wobblyness', 'wibblyness'), (2.0, 4), 6)]),
+    ('file2.py', [
+        quality.core.ScoreRecord('file2.py', '<module>', ('wobblyness', 'wibblyness'), (0.0, 1), 1),
+        quality.core.ScoreRecord('file2.py', 'function_c', ('wobblyness', 'wibblyness'), (4.1, 12), 7.5),
+    ]),
+]
+
+def test_jsonlinesreporter():
+    'JsonLinesReporter: writes a JSON object per contestant, as each file arrives'
+    output = StringIO.StringIO()
+    reporter = quality.report.JsonLinesReporter(output)
+    reporter(*STREAMED_RESULTS[0])
+    assert_equal(1, len(output.getvalue().splitlines()))
+    reporter(*STREAMED_RESULTS[1])
+    reporter.close()
+
+    assert_equal([
+        {'file': 'file1.py', 'item': 'function_a', 'scores': {'wibblyness': 4, 'wobblyness': 2.0}, 'final': 6},
+        {'file': 'file2.py', 'item': '<module>', 'scores': {'wibblyness': 1, 'wobblyness': 0.0}, 'final': 1},
+        {'file': 'file2.py', 'item': 'function_c', 'scores': {'wibblyness': 12, 'wobblyness': 4.1}, 'final': 7.5},
+    ], [json.loads(line) for line in output.getvalue().splitlines()])
+    # stdout and the like are left open
+    assert not output.closed
+
+def test_csvreporter():
+    'CsvReporter: writes a header, then a row per contestant'
+    output = StringIO.StringIO()
+    reporter = quality.report.CsvReporter(output, close_output=True)
+    for args in STREAMED_RESULTS:
+        reporter(*args)
+    value = output.getvalue()
+    reporter.close()
+    assert output.closed
+
+    assert_equal([
+        'File,Item,wibblyness,wobblyness,Final',
+        'file1.py,function_a,4,2.0,6',
+        'file2.py,<module>,1,0.0,1',
+        'file2.py,function_c,12,4.1,7.5',
+    ], value.splitlines())
+
+def test_sqlitereporter():
+    'SqliteReporter: commits each file\'s rows into an indexed table, replacing old results'
+    db_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(db_dir, 'results.db')
+        for i in range(2):
+            reporter = quality.report.SqliteReporter(db_path)
+            reporter(*STREAMED_RESULTS[0])
+            # committed rows are visible to other connections during the run
+            assert_equal([(1,)], sqlite3.connect(db_path).execute('SELECT COUNT(*) FROM results').fetchall())
+            reporter(*STREAMED_RESULTS[1])
+            reporter.close()
+
+        connection = sqlite3.connect(db_path)
+        assert_equal([
+            (u'file2.py', u'function_c', 12, 4.1, 7.5),
+            (u'file1.py', u'function_a', 4, 2.0, 6),
+            (u'file2.py', u'<module>', 1, 0.0, 1),
+        ], connection.execute('SELECT file, item, wibblyness, wobblyness, final FROM results ORDER BY final DESC').fetchall())
+        assert_equal(set(['results_file', 'results_final']), 
+            set(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")))
+        connection.close()
+
+        # sqlite3 refuses 8-bit byte strings
+        reporter = quality.report.SqliteReporter(db_path)
+        with mock.patch('sys.getfilesystemencoding', return_value='utf-8'):
+            reporter('caf\xc3\xa9.py', [quality.core.ScoreRecord('caf\xc3\xa9.py', 'f', ('lint',), (1,), 1)])
+            reporter('bad\xff.py', [quality.core.ScoreRecord('bad\xff.py', 'f', ('lint',), (1,), 1)])
+        reporter.close()
+        connection = sqlite3.connect(db_path)
+        assert_equal([(u'bad\ufffd.py',), (u'caf\xe9.py',)], 
+            connection.execute('SELECT file FROM results ORDER BY file').fetchall())
+        connection.close()
+    finally:
+        shutil.rmtree(db_dir)
@@ -0,0 +1,147 @@
+'Tests for server.py'
+
+from __future__ import absolute_import
+
+import quality.server
+import quality.tests.compat # must come before import nose.tools
+
+import mock
+import multiprocessing
+from nose.tools import *
+import os
+import os.path
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+
+COVERAGE_XML = '''<?xml version="1.0" ?>
+<coverage><packages><package><classes>
+<class filename="a.py" name="a"><methods/><lines>
+<line hits="1" number="1"/><line hits="1" number="2"/><line hits="0" number="3"/><line hits="1" number="4"/>
+</lines></class>
+</classes></package></packages></coverage>
+'''
+
+def test_score_request():
+    'quality.server._score_request: rescores requested files, and rereads coverage.xml when it changes'
+    src_dir = tempfile.mkdtemp()
+    try:
+        src_path = os.path.join(src_dir, 'a.py')
+        coverage_path = os.path.join(src_dir, 'coverage.xml')
+        with open(src_path, 'w') as fobj:
+            fobj.write('def f(x):\n    if x:\n        return 1\n    return 2\n')
+        with open(coverage_path, 'w') as fobj:
+            fobj.write(COVERAGE_XML)
+        bad_path = os.path.join(src_dir, 'bad.py')
+        with open(bad_path, 'w') as fobj:
+            fobj.write('def (')
+
+        with mock.patch('signal.signal'):
+            with mock.patch('quality.server._server_state'):
+                quality.server._init_server_worker(coverage_path)
+                response = quality.server._score_request([src_path, bad_path], 'crap')
+                # the module, then f, which misses one of its 3 lines and has a complexity of 2
+                rows = sorted((row['file'], row['item'], row['scores'].keys()) for row in response['results'])
+                assert_equal([(src_path, '<module>', ['crap']), (src_path, 'f', ['crap'])], rows)
+                assert_almost_equal(2.0 ** 2 / 3 + 2, max(row['final'] for row in response['results']))
+                assert_equal([bad_path], response['unparsable'])
+                assert_equal(1, len(response['warnings']))
+
+                # requested files are always rescored, since they've likely changed
+                with open(src_path, 'w') as fobj:
+                    fobj.write('def f(x):\n    return x\n')
+                response = quality.server._score_request([src_path], 'crap * 2')
+                assert_equal([0.0, 2.0], sorted(row['final'] for row in response['results']))
+
+                with open(coverage_path, 'w') as fobj:
+                    fobj.write(COVERAGE_XML.replace('hits="0"', 'hits="1"'))
+                response = quality.server._score_request([src_path], 'crap')
+                assert_equal([0.0, 1.0], sorted(row['final'] for row in response['results']))
+    finally:
+        shutil.rmtree(src_dir)
+
+@mock.patch('os.path.isfile', side_effect=lambda path: path != '/missing.py')
+def test_scoringservice_handle(mock_isfile):
+    'ScoringService.handle: checks requests before handing them to the workers'
+    with mock.patch('multiprocessing.Pool') as mock_pool:
+        service = quality.server.ScoringService('coverage.xml', jobs=2)
+    assert_equal(((2, quality.server._init_server_worker, (os.path.abspath('coverage.xml'),)),), mock_pool.call_args[:1])
+    apply_async = mock_pool.return_value.apply_async
+    apply_async.return_value.get.return_value = {'results': []}
+
+    assert_equal({'results': []}, service.handle({'files': [u'/a.py']}))
+    apply_async.assert_called_with(quality.server._score_request, (['/a.py'], service.formula))
+    assert_equal(str, type(apply_async.call_args[0][1][0][0]))
+    service.handle({'files': ['/a.py'], 'formula': 'lint * 2'})
+    apply_async.assert_called_with(quality.server._score_request, (['/a.py'], 'lint * 2'))
+
+    for request in [[], {}, {'files': []}, {'files': '/a.py'}, {'files': [1]}, 
+            {'files': ['/a.py'], 'formula': 'nope'}, {'files': ['/a.py'], 'formula': 'lint +'},
+            # nothing but the judges' names, so no builtins, attributes or functions
+            {'files': ['/a.py'], 'formula': 'max(lint, 1)'}, {'files': ['/a.py'], 'formula': 'lint.__class__'},
+            {'files': ['/a.py'], 'formula': '(lambda: lint)()'}, {'files': ['/a.py'], 'formula': '[x for x in lint]'}]:
+        assert 'error' in service.handle(request)
+    assert_equal({'error': 'Files not found: /missing.py'}, service.handle({'files': ['/a.py', '/missing.py']}))
+
+    apply_async.return_value.get.assert_called_with(quality.server.REQUEST_TIMEOUT)
+    apply_async.return_value.get.side_effect = ValueError('broken')
+    assert_equal({'error': 'Scoring failed: ValueError: broken'}, service.handle({'files': ['/a.py']}))
+    apply_async.return_value.get.side_effect = multiprocessing.TimeoutError()
+    assert_equal({'error': 'Scoring timed out after 600 seconds'}, service.handle({'files': ['/a.py']}))
+
+    with assert_raises(ValueError):
+        quality.server.ScoringService('coverage.xml', formula='nope')
+
+def _die_in_worker(src_paths, formula):
+    'a scoring worker that dies, taking its request with it'
+    os._exit(9)
+
+def _echo_in_worker(src_paths, formula):
+    'a scoring worker that answers without scoring'
+    return {'results': [], 'echo': src_paths}
+
+def test_scoringservice_dead_worker():
+    'ScoringService.handle: answers with an error when a worker dies, and carries on'
+    service = quality.server.ScoringService('coverage.xml', jobs=1, timeout=1)
+    try:
+        with mock.patch('quality.server._score_request', _die_in_worker):
+            assert_equal({'error': 'Scoring timed out after 1 seconds'}, service.handle({'files': [__file__]}))
+        with mock.patch('quality.server._score_request', _echo_in_worker):
+            assert_equal([__file__], service.handle({'files': [__file__]})['echo'])
+    finally:
+        service.close()
+
+def test_scoringserver():
+    'ScoringServer: answers requests over its socket, one line of JSON each'
+    socket_dir = tempfile.mkdtemp()
+    try:
+        socket_path = os.path.join(socket_dir, 'quality.sock')
+        # a socket file left behind by a dead server is replaced
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(socket_path)
+        stale.close()
+
+        service = mock.MagicMock()
+        service.handle.side_effect = lambda request: {'results': [], 'echo': request} if request.get('files') else {'error': 'no files'}
+        server = quality.server.ScoringServer(socket_path, service)
+        assert_equal(0600, stat.S_IMODE(os.stat(socket_path).st_mode))
+        thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.start()
+        try:
+            response = quality.server.request(socket_path, ['a.py'], 'lint')
+            assert_equal({'files': [os.path.abspath('a.py')], 'formula': 'lint'}, response['echo'])
+            with assert_raises(ValueError):
+                quality.server.request(socket_path, [])
+
+            # one server per socket
+            with assert_raises(ValueError):
+                quality.server.ScoringServer(socket_path, service)
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        assert not os.path.exists(socket_path)
+    finally:
+        shutil.rmtree(socket_dir)
@@ -2,36 +2,62 @@
 
 from __future__ import absolute_import
 
+import quality.core
 import quality.tabnanny
 import quality.tests.compat # must come before import nose.tools
 
+import ast
 import mock
 from nose.tools import *
 import os
 import os.path
 import StringIO
+import tokenize
 
-CUR_PATH = os.path.abspath(__file__)
+CUR_PATH = os.path.abspath(__file__.replace('.pyc', '.py'))
 TABNANNY_PROB_PATH = os.path.join(os.path.dirname(CUR_PATH), 'data', 'tabnanny_problems.py')
 INDENT_ERROR_PATH = os.path.join(os.path.dirname(CUR_PATH), 'data', 'indentation_error.py')
 
+def tokens(source):
+    return tokenize.generate_tokens(StringIO.StringIO(source).readline)
+
+def test_check_tokens():
+    'check_tokens: reports the line and message of the first problem'
+    assert_equal([], quality.tabnanny.check_tokens(tokens('if True:\n    pass\n')))
+    assert_equal([(3, 'indent not greater e.g. at tab size 1')], 
+        quality.tabnanny.check_tokens(tokens('if True:\n    if True:\n\t\t\tpass\n')))
+    assert_equal([(3, 'Indentation Error: unindent does not match any outer indentation level')], 
+        quality.tabnanny.check_tokens(tokens('if True:\n  pass\n pass\n')))
+    assert_equal([(2, 'Token Error: EOF in multi-line statement')], 
+        quality.tabnanny.check_tokens(tokens('x = (1,\n')))
+
 def test_run_tabnanny():
-    'run_tabnanny: returns the captured stdout from tabnanny'
-    def get_file_len(fobj):
-        fobj.seek(0, os.SEEK_END)
-        return fobj.tell()
-    
-    # the current file should have no problems, and should result in an empty stdout
-    assert_equal(0, get_file_len(quality.tabnanny.run_tabnanny(CUR_PATH)))
-    # both of the two bad files should yield some output without exiting or raising
-    assert get_file_len(quality.tabnanny.run_tabnanny(TABNANNY_PROB_PATH))
-    assert get_file_len(quality.tabnanny.run_tabnanny(INDENT_ERROR_PATH))
+    'run_tabnanny: returns the findings from tabnanny'
+    # the current file should have no problems
+    assert_equal([], quality.tabnanny.run_tabnanny(CUR_PATH))
+    # both of the two bad files should yield some findings without exiting or raising
+    assert_equal([5], [line for line, message in quality.tabnanny.run_tabnanny(TABNANNY_PROB_PATH)])
+    assert_equal([5], [line for line, message in quality.tabnanny.run_tabnanny(INDENT_ERROR_PATH)])
 
 def test_tabnannyjudge_call():
-    'TabnannyJudge.run_tabnanny: correctly updates results cache'
+    'TabnannyJudge: scores contestants without a LineIndex by their whole module'
     j = quality.tabnanny.TabnannyJudge()
     # put some bogus data in the judge
-    j['abc'] = StringIO.StringIO('')
-    j['def'] = StringIO.StringIO('something happened!')
-    assert_equal(0, j(mock.MagicMock(src_file='abc')))
-    assert_equal(1, j(mock.MagicMock(src_file='def')))
\ No newline at end of file
+    j['abc'] = []
+    j['def'] = [(3, 'something happened!')]
+    assert_equal(0, j(mock.MagicMock(src_file='abc', line_index=None)))
+    assert_equal(1, j(mock.MagicMock(src_file='def', line_index=None)))
+
+def test_tabnannyjudge_line_index():
+    'TabnannyJudge: attributes findings to the contestant owning their line, or else the module'
+    source = 'def f():\n    pass\n\n@decorator\ndef g():\n    pass\n'
+    contestants = quality.core.annotate(ast.parse(source), 'abc')
+    j = quality.tabnanny.TabnannyJudge()
+
+    j['abc'] = [(2, 'in f')]
+    assert_equal([0, 1, 0], [j(c) for c in contestants])
+
+    # decorators aren't part of any contestant's lines
+    j = quality.tabnanny.TabnannyJudge()
+    j['abc'] = [(4, 'on the decorator')]
+    assert_equal([1, 0, 0], [j(c) for c in contestants])
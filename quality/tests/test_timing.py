@@ -0,0 +1,104 @@
+'Tests for timing.py'
+
+from __future__ import absolute_import
+
+import quality.timing
+import quality.tests.compat # must come before import nose.tools
+
+import json
+import mock
+from nose.tools import *
+import StringIO
+
+def make_profile(events):
+    'Return a Profile with `events`, given as (stage, src_path, wall) tuples, already recorded'
+    profile = quality.timing.Profile()
+    for stage, src_path, wall in events:
+        profile.record(quality.timing.TimingEvent(stage, src_path, wall, wall / 2))
+    return profile
+
+def test_profile_record():
+    'Profile.record: totals events by stage and by file, and passes them to listeners'
+    listener = mock.MagicMock()
+    profile = quality.timing.Profile([listener])
+    other = mock.MagicMock()
+    profile.add_listener(other)
+
+    events = [
+        quality.timing.TimingEvent('parse', 'a.py', 1.0, 0.5),
+        quality.timing.TimingEvent('parse', 'b.py', 2.0, 1.5),
+        quality.timing.TimingEvent('judge:crap', 'a.py', 0.25, 0.25),
+        quality.timing.TimingEvent('formula', None, 0.5, 0.5),
+    ]
+    for event in events:
+        profile.record(event)
+
+    assert_equal({'parse': [3.0, 2.0, 2], 'judge:crap': [0.25, 0.25, 1], 'formula': [0.5, 0.5, 1]}, profile.stages)
+    assert_equal({'a.py': 1.25, 'b.py': 2.0}, profile.files)
+    assert_equal([mock.call(event) for event in events], listener.call_args_list)
+    assert_equal([mock.call(event) for event in events], other.call_args_list)
+
+def test_profile_timed():
+    'Profile.timed: records the wall and CPU time of its block, even if it raises'
+    events = []
+    profile = quality.timing.Profile([events.append])
+    with mock.patch('timeit.default_timer', side_effect=[10.0, 12.5]):
+        with mock.patch('time.clock', side_effect=[1.0, 2.0]):
+            with profile.timed('parse', 'a.py'):
+                pass
+    assert_equal([quality.timing.TimingEvent('parse', 'a.py', 2.5, 1.0)], events)
+
+    with assert_raises(ValueError):
+        with profile.timed('judge:lint'):
+            raise ValueError()
+    assert_equal('judge:lint', events[-1].stage)
+    assert_equal(None, events[-1].src_path)
+
+def test_timer_exclude():
+    'StageTimer.exclude: leaves time recorded separately out of the block\'s'
+    events = []
+    profile = quality.timing.Profile([events.append])
+    with mock.patch('timeit.default_timer', side_effect=[10.0, 12.5]):
+        with mock.patch('time.clock', side_effect=[1.0, 2.0]):
+            with profile.timed('prefetch:lint') as timer:
+                timer.exclude(quality.timing.TimingEvent('prefetch:lint', 'a.py', 2.0, 0.75))
+    assert_equal([quality.timing.TimingEvent('prefetch:lint', None, 0.5, 0.25)], events)
+
+def test_profile_summary():
+    'Profile.summary: lists stages and the slowest files, slowest first'
+    profile = make_profile([('parse', 'a.py', 1.0), ('parse', 'b.py', 2.0), ('judge:lint', 'c.py', 5.0),
+        ('formula', None, 2.0)])
+    summary = profile.summary(top=2)
+
+    assert_equal(['judge:lint', 'parse', 'formula'], [row['stage'] for row in summary['stages']])
+    assert_equal([50.0, 30.0, 20.0], [row['percent'] for row in summary['stages']])
+    assert_equal([2, 1], [row['count'] for row in summary['stages']][1:])
+    assert_equal([{'file': 'c.py', 'wall': 5.0}, {'file': 'b.py', 'wall': 2.0}], summary['slowest_files'])
+    assert summary['elapsed'] >= 0
+
+    # an empty profile doesn't divide by zero
+    assert_equal([], quality.timing.Profile().summary()['stages'])
+
+def test_profile_write():
+    'Profile.write_summary, Profile.write_json: write the summary as text or JSON'
+    profile = make_profile([('parse', 'a.py', 1.0), ('formula', None, 1.0)])
+
+    output = StringIO.StringIO()
+    profile.write_summary(output)
+    lines = output.getvalue().splitlines()
+    assert lines[0].startswith('Elapsed: ')
+    assert_equal(['Stage', 'Wall', 'CPU', 'Count', '%'], lines[2].split())
+    assert_equal(['parse', '1.000', '0.500', '1', '50.000'], lines[3].split())
+    assert_equal(['a.py', '1.000'], lines[-1].split())
+
+    output = StringIO.StringIO()
+    profile.write_json(output)
+    written = json.loads(output.getvalue())
+    assert_equal(['elapsed', 'slowest_files', 'stages'], sorted(written))
+    assert_equal(['formula', 'parse'], sorted(row['stage'] for row in written['stages']))
+
+def test_null_profile():
+    'NullProfile: times nothing'
+    with quality.timing.NULL_PROFILE.timed('parse', 'a.py'):
+        pass
+    quality.timing.NULL_PROFILE.record(quality.timing.TimingEvent('parse', 'a.py', 1.0, 1.0))
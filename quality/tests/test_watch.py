@@ -0,0 +1,99 @@
+'Tests for watch.py'
+
+from __future__ import absolute_import
+
+import quality.watch
+import quality.tests.compat # must come before import nose.tools
+
+import mock
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+import os
+import os.path
+import shutil
+import tempfile
+
+def find_py_files(root):
+    'Return a function listing the .py files under `root`'
+    def find_files():
+        return [os.path.join(dirpath, filename) for dirpath, dirnames, filenames in os.walk(root) 
+            for filename in filenames if filename.endswith('.py')]
+    return find_files
+
+def write(path, text, mtime=None):
+    with open(path, 'w') as fobj:
+        fobj.write(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+def check_watcher(watcher_cls):
+    root = tempfile.mkdtemp()
+    try:
+        src_dir = os.path.join(root, 'src')
+        os.makedirs(os.path.join(src_dir, 'pkg'))
+        a_path = os.path.join(src_dir, 'pkg', 'a.py')
+        b_path = os.path.join(src_dir, 'b.py')
+        coverage_path = os.path.join(root, 'coverage.xml')
+        write(a_path, 'x = 1\n', 1000)
+        write(b_path, 'y = 1\n', 1000)
+
+        watcher = watcher_cls(src_dir, find_py_files(src_dir), [coverage_path], interval=0.01)
+        try:
+            assert_equal(set(), watcher.poll())
+
+            # same size, different modification time
+            write(a_path, 'x = 2\n', 2000)
+            assert_equal(set([a_path]), watcher.wait())
+            assert_equal(set(), watcher.poll())
+
+            # files that aren't found by find_files are ignored
+            write(os.path.join(src_dir, 'notes.txt'), 'nothing to see')
+            c_path = os.path.join(src_dir, 'pkg', 'c.py')
+            write(c_path, 'z = 1\n')
+            os.remove(b_path)
+            assert_equal(set([b_path, c_path]), watcher.wait())
+
+            write(coverage_path, '<coverage/>')
+            assert_equal(set([coverage_path]), watcher.wait())
+            assert_equal(set(), watcher.poll())
+        finally:
+            watcher.close()
+    finally:
+        shutil.rmtree(root)
+
+def test_pollingwatcher():
+    'PollingWatcher: reports files that change, appear or disappear'
+    check_watcher(quality.watch.PollingWatcher)
+
+def test_inotifywatcher():
+    'InotifyWatcher: reports the same changes as PollingWatcher'
+    if quality.watch.pyinotify is None:
+        raise SkipTest('pyinotify is not installed')
+    check_watcher(quality.watch.InotifyWatcher)
+
+def test_watch_contest():
+    'watch_contest: rescores changed files, with judges that forget them first'
+    judge = mock.MagicMock(spec=['forget'])
+    watcher = mock.MagicMock()
+    watcher.wait.side_effect = [set(['a.py']), set(['b.py', 'd.py']), set(['coverage.xml']), KeyboardInterrupt]
+    reports = []
+    def on_rescore(results, rescored, removed, elapsed):
+        reports.append((dict(results), rescored, removed))
+    def run_contest(src_paths, *args, **kwargs):
+        return dict((src_path, [src_path[0] + str(len(reports) + 1)]) for src_path in src_paths if src_path != 'c.py')
+
+    with mock.patch('quality.core.run_contest', side_effect=run_contest) as mock_run:
+        with mock.patch('os.path.isfile', side_effect=lambda path: path != 'b.py'):
+            with assert_raises(KeyboardInterrupt):
+                quality.watch.watch_contest(watcher, ['a.py', 'b.py', 'c.py'], {}, 'formula', [judge], on_rescore, 
+                    coverage_file='coverage.xml')
+
+    assert_equal([
+        ({'a.py': ['a1'], 'b.py': ['b1']}, ['a.py', 'b.py', 'c.py'], []),
+        ({'a.py': ['a2'], 'b.py': ['b1']}, ['a.py'], []),
+        ({'a.py': ['a2'], 'd.py': ['d3']}, ['d.py'], ['b.py']),
+        # unparsable files are still rescored, in case they've been fixed
+        ({'a.py': ['a4'], 'd.py': ['d4']}, ['a.py', 'c.py', 'd.py'], []),
+    ], reports)
+    assert_equal([mock.call('a.py'), mock.call('d.py'), mock.call('b.py'), mock.call(None)], 
+        judge.forget.call_args_list)
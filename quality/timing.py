@@ -0,0 +1,175 @@
+'''
+Timing instrumentation for quality contests: where the time goes, by stage,
+by judge and by file.
+'''
+
+import quality.report
+
+import collections
+import json
+import threading
+import time
+import timeit
+
+# the number of slowest files listed in a summary
+DEFAULT_TOP_FILES = 10
+
+class TimingEvent(collections.namedtuple('TimingEvent', ['stage', 'src_path', 'wall', 'cpu'])):
+    '''
+    One timed piece of work.
+
+    Attributes:
+    * stage - name of the stage, e.g. 'parse', or 'judge:crap' for one judge
+    * src_path - path to the source file worked on, or None for work on many files
+    * wall - elapsed time, in seconds
+    * cpu - CPU time used by the whole process meanwhile, in seconds
+    '''
+    __slots__ = ()
+
+class StageTimer(object):
+    'A context manager that times its block, and records it with a Profile'
+    def __init__(self, profile, stage, src_path):
+        self.profile = profile
+        self.stage = stage
+        self.src_path = src_path
+
+    def __enter__(self):
+        self.cpu = time.clock()
+        self.wall = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_val, tb):
+        wall = timeit.default_timer() - self.wall
+        cpu = time.clock() - self.cpu
+        self.profile.record(TimingEvent(self.stage, self.src_path, wall, cpu))
+
+    def exclude(self, event):
+        'Leave the time of `event`, recorded separately, out of this block\'s'
+        self.wall += event.wall
+        self.cpu += event.cpu
+
+class Profile(object):
+    '''
+    Collects TimingEvents from a contest, and totals them by stage and by
+    file.
+
+    The stages recorded by quality.core and quality.cmdline are:
+    * discover - finding the source files
+    * read - reading a source file
+    * cache - looking up or storing a file's results in the result cache
+    * parse - parsing and annotating a source file
+    * prefetch:<judge> - a judge's prefetch, over many files; judges that 
+        time each file they prefetch, like LintJudge, have those times 
+        recorded per file under the same stage, and the rest, such as 
+        pylint's start-up, without a file
+    * judge:<judge> - a judge scoring one file's contestants
+    * formula - calculating final scores, for a batch of files
+    * report - reporting results
+
+    Stages don't overlap when files are scored one at a time.  With worker
+    processes they do, so stage totals can add up to more than the elapsed 
+    time.
+
+    Listeners are called with each TimingEvent as it's recorded, e.g. to
+    forward them elsewhere; they may be called from any thread.
+
+    Attributes:
+    * listeners - list of callables, each taking a TimingEvent
+    * stages - dict mapping stage names to [wall, cpu, count] totals
+    * files - dict mapping source paths to total wall time
+    * started - time the profile was created, from timeit.default_timer
+    '''
+    def __init__(self, listeners=None):
+        self.listeners = list(listeners or [])
+        self.stages = {}
+        self.files = collections.defaultdict(float)
+        self.started = timeit.default_timer()
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        'Call `listener` with every TimingEvent recorded from now on'
+        self.listeners.append(listener)
+
+    def timed(self, stage, src_path=None):
+        'Return a context manager that records the time its block takes as `stage`'
+        return StageTimer(self, stage, src_path)
+
+    def record(self, event):
+        'Add a TimingEvent to the totals, and pass it on to the listeners'
+        with self._lock:
+            totals = self.stages.get(event.stage)
+            if totals is None:
+                totals = self.stages[event.stage] = [0.0, 0.0, 0]
+            totals[0] += event.wall
+            totals[1] += event.cpu
+            totals[2] += 1
+            if event.src_path is not None:
+                self.files[event.src_path] += event.wall
+        for listener in self.listeners:
+            listener(event)
+
+    def elapsed(self):
+        'Return the wall time since the profile was created, in seconds'
+        return timeit.default_timer() - self.started
+
+    def summary(self, top=DEFAULT_TOP_FILES):
+        '''
+        Return a summary of the totals, as a dict of plain values:
+        * elapsed - wall time since the profile was created
+        * stages - list of dicts with the stage, wall, cpu, count and percent
+            of the total wall time of all stages, slowest first
+        * slowest_files - list of dicts with the file and wall time of the
+            `top` slowest files, slowest first
+        '''
+        with self._lock:
+            stages = sorted(((wall, cpu, count, stage) for stage, (wall, cpu, count) in self.stages.iteritems()),
+                reverse=True)
+            files = sorted(((wall, src_path) for src_path, wall in self.files.iteritems()), reverse=True)[:top]
+        total = sum(wall for wall, cpu, count, stage in stages)
+        return {
+            'elapsed': self.elapsed(),
+            'stages': [{'stage': stage, 'wall': wall, 'cpu': cpu, 'count': count,
+                'percent': 100.0 * wall / total if total else 0.0} for wall, cpu, count, stage in stages],
+            'slowest_files': [{'file': src_path, 'wall': wall} for wall, src_path in files],
+        }
+
+    def write_summary(self, output, top=DEFAULT_TOP_FILES):
+        'Write the summary as text tables'
+        summary = self.summary(top)
+        output.write('Elapsed: %.3fs\n\n' % summary['elapsed'])
+        quality.report.write_minimal_columns([['Stage', 'Wall', 'CPU', 'Count', '%']] +
+            [[row['stage'], row['wall'], row['cpu'], row['count'], row['percent']] for row in summary['stages']],
+            output)
+        if summary['slowest_files']:
+            output.write('\n')
+            quality.report.write_minimal_columns([['File', 'Wall']] +
+                [[row['file'], row['wall']] for row in summary['slowest_files']], output)
+
+    def write_json(self, output, top=DEFAULT_TOP_FILES):
+        'Write the summary as JSON'
+        json.dump(self.summary(top), output, indent=2, sort_keys=True)
+        output.write('\n')
+
+class NullTimer(object):
+    'A context manager that does nothing; what NullProfile.timed returns'
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, tb):
+        pass
+
+    def exclude(self, event):
+        pass
+
+class NullProfile(object):
+    'Stands in for a Profile when nothing is being timed, at the cost of a method call'
+    _timer = NullTimer()
+
+    def timed(self, stage, src_path=None):
+        return self._timer
+
+    def record(self, event):
+        pass
+
+# shared by everything that isn't given a Profile
+NULL_PROFILE = NullProfile()
@@ -0,0 +1,218 @@
+'''
+Watching source files for changes, and rescoring them as they change.
+'''
+
+import quality.core
+
+import os
+import os.path
+import time
+import timeit
+
+# pyinotify lets watchers sleep until something changes, rather than waking
+# up to poll; it's Linux-only, and optional
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# seconds between polls, or the longest a watcher waits on inotify at once
+DEFAULT_INTERVAL = 0.5
+
+def file_signature(path):
+    'Return the (modification time, size) of `path`, or None if it doesn\'t exist'
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+class PollingWatcher(object):
+    '''
+    Notices changes to a set of files by comparing their modification times
+    and sizes from one poll to the next.
+
+    The files to watch are found by calling `find_files`, which returns a list
+    of paths.  It's only called again when one of the directories holding
+    those files changes, i.e. when files may have been added or removed; a
+    directory with no watched files in or below it isn't noticed until its
+    parent changes.  `extra_paths` are watched as well, whether they exist or
+    not, e.g. a coverage.xml that may be regenerated at any time.
+
+    Attributes:
+    * root - the directory the files are found under
+    * find_files - callable returning the list of paths to watch
+    * extra_paths - list of other paths to watch
+    * interval - seconds between polls
+    * files - dict mapping each watched path to its signature, or None if
+        it's gone
+    * dirs - dict mapping directories holding watched files to their signatures
+    '''
+    def __init__(self, root, find_files, extra_paths=(), interval=DEFAULT_INTERVAL):
+        self.root = root
+        self.find_files = find_files
+        self.extra_paths = list(extra_paths)
+        self.interval = interval
+        self.files = dict((path, file_signature(path)) for path in self.extra_paths)
+        self.dirs = {}
+        self.rescan()
+
+    def rescan(self):
+        'Find the files to watch again, and return the set of paths added or removed'
+        found = set(self.find_files())
+        found.update(self.extra_paths)
+        added = found.difference(self.files)
+        removed = set(self.files).difference(found)
+        for path in removed:
+            del self.files[path]
+        for path in added:
+            self.files[path] = file_signature(path)
+
+        dirs = set([self.root])
+        for path in found.difference(self.extra_paths):
+            dir_path = os.path.dirname(path)
+            while dir_path and dir_path not in dirs:
+                dirs.add(dir_path)
+                dir_path = os.path.dirname(dir_path)
+        self.dirs = dict((dir_path, file_signature(dir_path)) for dir_path in dirs)
+        return added | removed
+
+    def poll(self):
+        'Return the set of paths changed, added or removed since the last poll'
+        changed = set()
+        for path, signature in self.files.items():
+            current = file_signature(path)
+            if current != signature:
+                self.files[path] = current
+                changed.add(path)
+        if any(file_signature(dir_path) != signature for dir_path, signature in self.dirs.iteritems()):
+            changed |= self.rescan()
+        return changed
+
+    def sleep(self):
+        'Wait until it\'s worth polling again'
+        time.sleep(self.interval)
+
+    def wait(self):
+        'Wait until something changes, and return the set of paths that did'
+        while True:
+            changed = self.poll()
+            if changed:
+                return changed
+            self.sleep()
+
+    def close(self):
+        'Release any resources held by the watcher'
+        pass
+
+class InotifyWatcher(PollingWatcher):
+    '''
+    A PollingWatcher that sleeps until inotify reports activity under `root`,
+    or in the directories holding `extra_paths`, instead of polling every
+    `interval` seconds.  What changed is still found by polling, so both
+    watchers report changes in the same way.  Requires pyinotify.
+
+    inotify also reports new files in directories that had no watched files
+    before, so unlike with polling, those are noticed as soon as they appear.
+
+    Attributes, in addition to PollingWatcher's:
+    * notifier - pyinotify.Notifier, which reads the events
+    * unknown_paths - whether events arrived for Python files or directories
+        that aren't being watched yet, since the last poll
+    '''
+    MASK = 0
+    if pyinotify is not None:
+        MASK = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+
+    def __init__(self, root, find_files, extra_paths=(), interval=DEFAULT_INTERVAL):
+        super(InotifyWatcher, self).__init__(root, find_files, extra_paths, interval)
+        self.unknown_paths = False
+        manager = pyinotify.WatchManager()
+        manager.add_watch(root, self.MASK, rec=True, auto_add=True)
+        for path in self.extra_paths:
+            # watching the directory catches files being replaced by a rename
+            manager.add_watch(os.path.dirname(os.path.abspath(path)), self.MASK)
+        self.notifier = pyinotify.Notifier(manager, self.process_event, timeout=int(interval * 1000))
+
+    def process_event(self, event):
+        'Note events for paths that a rescan might find'
+        if (event.dir or event.pathname.endswith('.py')) and event.pathname not in self.files:
+            self.unknown_paths = True
+
+    def poll(self):
+        changed = super(InotifyWatcher, self).poll()
+        if self.unknown_paths:
+            self.unknown_paths = False
+            changed |= self.rescan()
+        return changed
+
+    def sleep(self):
+        # the timeout keeps KeyboardInterrupt from waiting for the next event
+        if self.notifier.check_events():
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def close(self):
+        self.notifier.stop()
+
+def make_watcher(root, find_files, extra_paths=(), interval=DEFAULT_INTERVAL):
+    'Return an InotifyWatcher if pyinotify is available, or a PollingWatcher otherwise'
+    if pyinotify is not None:
+        return InotifyWatcher(root, find_files, extra_paths, interval)
+    return PollingWatcher(root, find_files, extra_paths, interval)
+
+def watch_contest(watcher, src_paths, options, formula, recruited_judges, on_rescore, coverage_file=None,
+        cache=None):
+    '''
+    Score `src_paths`, then rescore files whenever `watcher` reports that
+    they've changed, until interrupted.
+
+    The same judges are used throughout, so whatever they keep from one file
+    to the next, like pylint's imports or the parsed coverage.xml, stays
+    warm.  Before a file is rescored, judges with a `forget` method are asked
+    to forget it.  If `coverage_file` changes, they're asked to forget
+    everything, with forget(None), and every file is rescored.
+
+    After the first run, and after each rescore, `on_rescore` is called as
+    on_rescore(results, rescored, removed, elapsed), where `results` maps
+    every file to its latest results, as from run_contest; `rescored` lists
+    the files just scored; `removed` lists files that are gone; and `elapsed`
+    is the time taken, in seconds.  Files that can no longer be parsed are
+    in `rescored`, but not in `results`.
+
+    `cache` is passed on to run_contest.
+    '''
+    start = timeit.default_timer()
+    results = quality.core.run_contest(src_paths, options, formula, recruited_judges,
+        cache=cache, compact=True)
+    on_rescore(results, list(src_paths), [], timeit.default_timer() - start)
+    known = set(src_paths)
+
+    while True:
+        changed = watcher.wait()
+        start = timeit.default_timer()
+
+        changed_sources = changed.difference([coverage_file])
+        removed = sorted(src_path for src_path in changed_sources if not os.path.isfile(src_path))
+        known.difference_update(removed)
+        known.update(changed_sources.difference(removed))
+        if coverage_file in changed:
+            forget = [None]
+            rescored = sorted(known)
+        else:
+            forget = rescored = sorted(changed_sources.difference(removed))
+
+        for judge in recruited_judges:
+            if hasattr(judge, 'forget'):
+                for src_path in forget + removed:
+                    judge.forget(src_path)
+
+        new_results = quality.core.run_contest(rescored, options, formula, recruited_judges,
+            cache=cache, compact=True)
+        for src_path in rescored + removed:
+            if src_path in new_results:
+                results[src_path] = new_results[src_path]
+            else:
+                results.pop(src_path, None)
+        on_rescore(results, rescored, removed, timeit.default_timer() - start)